@@ -1,12 +1,13 @@
 import requests
 import logging
+from collections import Counter
 
 import prometheus_client as prometheus
 
-GET_REQUESTS = ["get_mac", "get_ip", '', "get_device_info"]
-POST_REQUESTS = ["connect_user"]
-DELETE_REQUESTS = ["disconnect_user"]
-PUT_REQUESTS = ["set_mark"]
+GET_REQUESTS = ["get_mac", "get_ip", '', "get_device_info", "top_devices", "state"]
+POST_REQUESTS = ["connect_user", "connect_users", "heartbeat", "apply_state", "get_macs", "get_ips", "add_priority_devices"]
+DELETE_REQUESTS = ["disconnect_user", "delete_priority_devices"]
+PUT_REQUESTS = ["set_mark", "set_marks", "shaping", "priority"]
 
 connected_devices_gauge = prometheus.Gauge("langate_connected_devices", "Amount of connected devices", labelnames=["mark"])
 mark_table = {} # used to keep track of mark for MAC addresses between requests
@@ -15,9 +16,10 @@ class Netcontrol:
     """
     Class which interacts with the netcontrol API.
     """
-    def request(self, endpoint='', args={}):
+    def request(self, endpoint='', args={}, body=None, timeout=None):
         """
         Make a given request to the netcontrol API.
+        The body, if any, is sent as JSON, and the request fails after timeout seconds if one is given.
         """
         response = None
 
@@ -25,13 +27,13 @@ class Netcontrol:
         try:
             # Check the type of request
             if endpoint in GET_REQUESTS:
-                response = requests.get(self.REQUEST_URL + endpoint, params=args)
+                response = requests.get(self.REQUEST_URL + endpoint, params=args, json=body, timeout=timeout)
             elif endpoint in POST_REQUESTS:
-                response = requests.post(self.REQUEST_URL + endpoint, params=args)
+                response = requests.post(self.REQUEST_URL + endpoint, params=args, json=body, timeout=timeout)
             elif endpoint in DELETE_REQUESTS:
-                response = requests.delete(self.REQUEST_URL + endpoint, params=args)
+                response = requests.delete(self.REQUEST_URL + endpoint, params=args, json=body, timeout=timeout)
             elif endpoint in PUT_REQUESTS:
-                response = requests.put(self.REQUEST_URL + endpoint, params=args)
+                response = requests.put(self.REQUEST_URL + endpoint, params=args, json=body, timeout=timeout)
 
             response.raise_for_status()
             return response.json()
@@ -61,6 +63,22 @@ class Netcontrol:
         """
         self.logger.info(f"Getting IP address of {mac}...")
         return self.request("get_ip", {"mac": mac})["ip"]
+
+    def get_macs(self, ips: list[str]) -> dict:
+        """
+        Get the MAC addresses of several devices at once, from their IP addresses.
+        Returns the "macs" found indexed by IP address, and the "missing" IP addresses.
+        """
+        self.logger.info(f"Getting MAC addresses of {len(ips)} devices...")
+        return self.request("get_macs", body=ips)
+
+    def get_ips(self, macs: list[str]) -> dict:
+        """
+        Get the IP addresses of several devices at once, from their MAC addresses.
+        Returns the "ips" found indexed by MAC address, and the "missing" MAC addresses.
+        """
+        self.logger.info(f"Getting IP addresses of {len(macs)} devices...")
+        return self.request("get_ips", body=macs)
     
     def get_device_info(self, mac: str):
         """
@@ -69,6 +87,13 @@ class Netcontrol:
         self.logger.info(f"Getting info about {mac}...")
         return self.request("get_device_info", {"mac": mac})
 
+    def get_top_devices(self, count: int, interval: float, timeout: float = None):
+        """
+        Get the devices that sent the most bytes over at least the given interval, in seconds.
+        """
+        self.logger.info(f"Getting the top {count} devices...")
+        return self.request("top_devices", {"count": count, "interval": interval}, timeout=timeout)
+
     def connect_user(self, mac: str, mark: int, bypass: bool, name: str) -> None:
         """
         Connect the user with the given MAC address.
@@ -94,18 +119,130 @@ class Netcontrol:
         except:
             raise
 
-    def set_mark(self, mac: str, mark: int, bypass: bool) -> None:
+    def connect_users(self, devices: list[dict]) -> dict:
+        """
+        Connect several devices at once.
+        Each device is a dict with the "mac", "mark", "bypass" and "name" keys.
+        Returns the errors of the devices that could not be connected, indexed by MAC address.
+        """
+        self.logger.info(f"Connecting {len(devices)} devices...")
+        result = self.request("connect_users", body=devices)
+        marks = {device["mac"].lower(): device["mark"] for device in devices}
+        for mac in result["connected"]:
+            if mac in mark_table:
+                connected_devices_gauge.labels(str(mark_table[mac])).dec()
+            mark_table[mac] = marks[mac]
+            connected_devices_gauge.labels(str(marks[mac])).inc()
+        return result["failed"]
+
+    def get_state(self) -> dict:
+        """
+        Get the devices connected in netcontrol, with their mark and bypass, and the version of this state.
+        """
+        self.logger.info("Getting the state of netcontrol...")
+        return self.request("state")
+
+    def apply_state(self, devices: list[dict], version: str = None) -> dict:
+        """
+        Make the devices connected in netcontrol match the given ones, only the differences being applied.
+        Each device is a dict with the "mac", "mark", "bypass" and "name" keys, connected devices missing from the list are disconnected.
+        If a version is given, the request fails if the state of netcontrol changed since then.
+        Returns the errors of the devices that could not be applied, indexed by MAC address.
+        """
+        self.logger.info(f"Applying the state of {len(devices)} devices...")
+        args = {} if version is None else {"version": version}
+        result = self.request("apply_state", args, body=devices)
+        self.logger.info(
+            f"{result['connected']} devices connected, {result['disconnected']} disconnected and {result['updated']} updated"
+        )
+
+        mark_table.clear()
+        for device in devices:
+            if device["mac"].lower() not in result["failed"]:
+                mark_table[device["mac"].lower()] = device["mark"]
+        connected_devices_gauge.clear()
+        for mark, count in Counter(mark_table.values()).items():
+            connected_devices_gauge.labels(str(mark)).set(count)
+        return result["failed"]
+
+    def heartbeat(self, devices: list[dict]) -> dict:
+        """
+        Refresh the devices that are still active, so that they don't expire in netcontrol.
+        Each device is a dict with the "mac", "mark", "bypass" and "name" keys, devices which already expired are connected again.
+        Returns the errors of the devices that could not be refreshed, indexed by MAC address.
+        """
+        self.logger.info(f"Refreshing {len(devices)} devices...")
+        result = self.request("heartbeat", body=devices)
+        marks = {device["mac"].lower(): device["mark"] for device in devices}
+        for mac in result["refreshed"]:
+            if mac in mark_table:
+                connected_devices_gauge.labels(str(mark_table[mac])).dec()
+            mark_table[mac] = marks[mac]
+            connected_devices_gauge.labels(str(marks[mac])).inc()
+        return result["failed"]
+
+    def set_mark(self, mac: str, mark: int, bypass: bool, name: str) -> None:
         """
         Set the mark of the user with the given MAC address.
         """
         self.logger.info(f"Setting mark of user with MAC address {mac} to {mark}...")
-        self.request("set_mark", {"mac": mac, "mark": mark, "bypass": bypass})
+        self.request("set_mark", {"mac": mac, "mark": mark, "bypass": bypass, "name": name})
         if mac in mark_table:
             old_mark = mark_table[mac]
             connected_devices_gauge.labels(str(old_mark)).dec()
         mark_table[mac] = mark
         connected_devices_gauge.labels(str(mark)).inc()
 
+    def set_marks(self, devices: list[dict]) -> dict:
+        """
+        Set the mark of several devices at once.
+        Each device is a dict with the "mac", "mark", "bypass" and "name" keys.
+        Returns the errors of the devices whose mark could not be set, indexed by MAC address.
+        """
+        self.logger.info(f"Setting mark of {len(devices)} devices...")
+        result = self.request("set_marks", body=devices)
+        marks = {device["mac"].lower(): device["mark"] for device in devices}
+        for mac in result["updated"]:
+            if mac in mark_table:
+                connected_devices_gauge.labels(str(mark_table[mac])).dec()
+            mark_table[mac] = marks[mac]
+            connected_devices_gauge.labels(str(marks[mac])).inc()
+        return result["failed"]
+
+    def set_shaping(self, marks: list[dict]) -> None:
+        """
+        Apply the bandwidth limits of the given marks, replacing the previous ones.
+        Each mark is a settings entry, with the optional "rate_limit" (whole mark) and "device_rate_limit" (each device) keys in kbytes/s.
+        """
+        self.logger.info(f"Setting bandwidth limits of {len(marks)} marks...")
+        self.request("shaping", body=[
+            {"mark": mark["value"], "rate": mark.get("rate_limit"), "device_rate": mark.get("device_rate_limit")}
+            for mark in marks
+        ])
+
+    def set_priority(self, marks: list[int], macs: list[str]) -> None:
+        """
+        Prioritize the traffic of the given marks and devices, replacing the previous ones.
+        """
+        self.logger.info(f"Prioritizing {len(marks)} marks and {len(macs)} devices...")
+        self.request("priority", body={"marks": marks, "devices": macs})
+
+    def add_priority_devices(self, macs: list[str]) -> dict:
+        """
+        Prioritize the traffic of the given devices, without touching the other prioritized marks and devices.
+        Returns the errors of the devices that could not be prioritized, indexed by MAC address.
+        """
+        self.logger.info(f"Prioritizing {len(macs)} devices...")
+        return self.request("add_priority_devices", body=macs)["failed"]
+
+    def delete_priority_devices(self, macs: list[str]) -> dict:
+        """
+        Stop prioritizing the traffic of the given devices, without touching the other prioritized marks and devices.
+        Returns the errors of the devices that could not be removed, indexed by MAC address.
+        """
+        self.logger.info(f"Removing {len(macs)} devices from priority...")
+        return self.request("delete_priority_devices", body=macs)["failed"]
+
     def __init__(self):
         """
         Initialize HOST_IP to the docker's default route, set up REQUEST_URL and check the connection with the netcontrol API.
@@ -2,18 +2,51 @@
 Network module. This module is responsible for the device and user connexion management.
 """
 
-import requests
-import sys, logging
+import logging
 import os
+import sys
+import threading
+import time
+
+import requests
 
 from django.apps import AppConfig
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
 from django.utils.translation import gettext_lazy as _
 
 from langate.settings import netcontrol
-from langate.settings import SETTINGS
+from langate.settings import SETTINGS, NETCONTROL_HEARTBEAT_INTERVAL
+from langate.network.utils import get_game_priority
 
 logger = logging.getLogger(__name__)
 
+STATE_ATTEMPTS = 3 # times the devices are applied at startup if netcontrol's state keeps changing
+
+def heartbeat_loop():
+    """
+    Periodically refreshes the active devices, so that netcontrol only expires the inactive ones.
+    """
+    from langate.network.models import DeviceManager
+
+    while True:
+        time.sleep(NETCONTROL_HEARTBEAT_INTERVAL)
+        close_old_connections()
+        try:
+            DeviceManager.heartbeat(DeviceManager.active_devices())
+        except Exception as e:
+            # The loop must survive any failure, or devices would stop being refreshed and expire
+            logger.exception(f"[PortalConfig] Heartbeat failed: {e}")
+
+def is_server_process():
+    """
+    Whether the apps are loaded by the server serving requests,
+    as opposed to a management command or the autoreloader of runserver.
+    """
+    if "runserver" in sys.argv:
+        return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+    return any(server in sys.argv[0] for server in ["gunicorn", "uvicorn"])
+
 class NetworkConfig(AppConfig):
     """Configuration of the Network Django App"""
 
@@ -46,19 +79,43 @@ class NetworkConfig(AppConfig):
             ]
         ):
 
+            logger.info(_("[PortalConfig] Applying the bandwidth limits of the marks"))
+            try:
+                netcontrol.set_shaping(SETTINGS["marks"])
+            except requests.HTTPError as e:
+                logger.info(f"[PortalConfig] {e}")
+
             logger.info(_("[PortalConfig] Adding previously connected devices to netcontrol"))
-            for dev in Device.objects.all():
-                userdevice = UserDevice.objects.filter(mac=dev.mac).first()
+            for _attempt in range(STATE_ATTEMPTS):
                 try:
-                    if userdevice is not None:
-                        netcontrol.connect_user(userdevice.mac, userdevice.mark, userdevice.bypass, userdevice.user.username)
-                    else:
-                        netcontrol.connect_user(dev.mac, dev.mark, dev.bypass, dev.name)
+                    # The state is read before the devices, so that a device connected in between
+                    # by another worker changes the version and makes netcontrol reject the request
+                    version = netcontrol.get_state()["version"]
+                    usernames = dict(UserDevice.objects.values_list("id", "user__username"))
+                    devices = [
+                        {
+                            "mac": dev.mac,
+                            "mark": dev.mark,
+                            "bypass": dev.bypass,
+                            "name": usernames.get(dev.id, dev.name),
+                        }
+                        for dev in Device.objects.all()
+                    ]
+                    # Only the devices that differ from the state of netcontrol are sent to nftables
+                    failed = netcontrol.apply_state(devices, version)
+                    for mac, error in failed.items():
+                        logger.info(f"[PortalConfig] Could not connect {mac}: {error}")
+                    break
                 except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code == 409:
+                        logger.info("[PortalConfig] The state of netcontrol changed, applying it again")
+                        continue
                     logger.info(f"[PortalConfig] {e}")
+                    break
 
             logger.info(_("[PortalConfig] Adding default whitelist devices to netcontrol"))
             if os.path.exists("assets/misc/whitelist.txt"):
+                whitelisted = []
                 with open("assets/misc/whitelist.txt", "r") as f:
                     for line in f:
                         line = line.strip().split("|")
@@ -74,9 +131,28 @@ class NetworkConfig(AppConfig):
                                 dev.whitelisted = True
                                 dev.bypass = bypass
                                 dev.save()
-                                try:
-                                    netcontrol.connect_user(dev.mac, dev.mark, dev.bypass, dev.name)
-                                except requests.HTTPError as e:
-                                    logger.info(f"[PortalConfig] {e}")
+                                whitelisted.append(
+                                    {"mac": dev.mac, "mark": dev.mark, "bypass": dev.bypass, "name": dev.name}
+                                )
                         else:
                             logger.error("[PortalConfig] Invalid line in whitelist.txt: %s", line)
+                # The devices already registered are connected again in a single nftables transaction
+                if whitelisted:
+                    try:
+                        failed = netcontrol.connect_users(whitelisted)
+                        for mac, error in failed.items():
+                            logger.info(f"[PortalConfig] Could not connect {mac}: {error}")
+                    except requests.HTTPError as e:
+                        logger.info(f"[PortalConfig] {e}")
+
+            if any(get_game_priority().values()):
+                logger.info(_("[PortalConfig] Prioritizing game traffic"))
+                try:
+                    DeviceManager.apply_priority()
+                except ValidationError as e:
+                    logger.info(f"[PortalConfig] {e}")
+
+            if NETCONTROL_HEARTBEAT_INTERVAL > 0 and is_server_process():
+                threading.Thread(
+                    target=heartbeat_loop, name="netcontrol-heartbeat", daemon=True
+                ).start()
@@ -1,18 +1,20 @@
 import requests
 import random, logging
 import re
+from datetime import timedelta
 
 from django.contrib.auth.base_user import AbstractBaseUser as AbstractBaseUser
 
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 
-from langate.user.models import User
+from langate.user.models import User, Role
 from langate.settings import netcontrol
-from langate.settings import SETTINGS
+from langate.settings import SETTINGS, SESSION_COOKIE_AGE
 
-from .utils import generate_dev_name, get_mark
+from .utils import generate_dev_name, get_mark, get_game_priority
 
 logger = logging.getLogger(__name__)
 
@@ -104,6 +106,9 @@ class DeviceManager(models.Manager):
 
         device = Device.objects.get(mac=mac)
         device.delete()
+
+        if get_game_priority()["players"]:
+            DeviceManager.update_priority(mac, False)
         return device
 
     @staticmethod
@@ -143,7 +148,6 @@ class DeviceManager(models.Manager):
         try:
             device = UserDevice.objects.create(mac=mac, name=name, user=user, ip=ip, mark=mark, bypass=bypass)
             device.save()
-            return device
         except Exception as e:
             try:
                 netcontrol.disconnect_user(mac)
@@ -155,6 +159,16 @@ class DeviceManager(models.Manager):
               _("An error occurred while creating the device")
             ) from e
 
+        # The devices of players are prioritized as soon as they are connected
+        if (
+            get_game_priority()["players"]
+            and user.role == Role.PLAYER
+            and user.tournament in SETTINGS["games"]
+        ):
+            DeviceManager.update_priority(mac, True)
+
+        return device
+
     @staticmethod
     def delete_user_device(Device):
         """
@@ -197,7 +211,7 @@ class DeviceManager(models.Manager):
                 bypass = device.bypass
             
             try:
-                netcontrol.set_mark(device.mac, mark, bypass)
+                netcontrol.set_mark(device.mac, mark, bypass, device.name)
             except requests.HTTPError as e:
                 raise ValidationError(
                     _("Could not set mark")
@@ -208,6 +222,111 @@ class DeviceManager(models.Manager):
         except Exception as e:
             raise ValidationError(_("The data provided is invalid")) from e
     
+    @staticmethod
+    def move_devices(devices, marks):
+        """
+        Move several devices to new marks with a single netcontrol request.
+        marks gives the new mark of each device, in the same order.
+        Returns the number of devices that could not be moved.
+        """
+        try:
+            failed = netcontrol.set_marks([
+                {"mac": device.mac, "mark": mark, "bypass": device.bypass, "name": device.name}
+                for device, mark in zip(devices, marks)
+            ])
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not set mark")
+            ) from e
+
+        moved = []
+        for device, mark in zip(devices, marks):
+            if device.mac.lower() in failed:
+                logger.error("Could not move device %s to mark %s: %s", device.mac, mark, failed[device.mac.lower()])
+            else:
+                device.mark = mark
+                moved.append(device)
+
+        Device.objects.bulk_update(moved, ["mark"])
+        return len(failed)
+
+    @staticmethod
+    def active_devices():
+        """
+        Devices that must stay connected: devices that don't belong to a user,
+        and devices of active users who logged in during the last session cookie age.
+        """
+        since = timezone.now() - timedelta(seconds=SESSION_COOKIE_AGE)
+        return Device.objects.filter(
+            models.Q(userdevice__isnull=True)
+            | models.Q(userdevice__user__is_active=True, userdevice__user__last_login__gte=since)
+        )
+
+    @staticmethod
+    def heartbeat(devices):
+        """
+        Refresh the given devices in netcontrol with a single request, so that they don't expire.
+        Devices which already expired are connected again.
+        Returns the number of devices that could not be refreshed.
+        """
+        try:
+            failed = netcontrol.heartbeat([
+                {"mac": device.mac, "mark": device.mark, "bypass": device.bypass, "name": device.name}
+                for device in devices
+            ])
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not refresh devices")
+            ) from e
+
+        for mac, error in failed.items():
+            logger.error("Could not refresh device %s: %s", mac, error)
+        return len(failed)
+
+    @staticmethod
+    def apply_priority():
+        """
+        Send the marks of the games and the devices of their players to netcontrol with a single request,
+        depending on what the game priority settings prioritize.
+        """
+        priority = get_game_priority()
+
+        marks = []
+        if priority["marks"]:
+            marks = sorted({mark for game_marks in SETTINGS["games"].values() for mark in game_marks})
+
+        macs = []
+        if priority["players"]:
+            macs = list(UserDevice.objects.filter(
+                user__role=Role.PLAYER,
+                user__tournament__in=list(SETTINGS["games"].keys()),
+            ).values_list("mac", flat=True))
+
+        try:
+            netcontrol.set_priority(marks, macs)
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not set priority")
+            ) from e
+
+    @staticmethod
+    def update_priority(mac, prioritized):
+        """
+        Add a single device to the prioritized devices of netcontrol, or remove it,
+        without sending the whole list like apply_priority.
+        A failure is only logged, the device being fixed by the next apply_priority.
+        """
+        try:
+            if prioritized:
+                failed = netcontrol.add_priority_devices([mac])
+            else:
+                failed = netcontrol.delete_priority_devices([mac])
+        except requests.HTTPError as e:
+            failed = {mac: str(e)}
+
+        for failed_mac, error in failed.items():
+            logger.error("Could not update the priority of device %s: %s", failed_mac, error)
+
     @staticmethod
     def get_device_info(mac):
         """
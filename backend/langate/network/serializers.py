@@ -128,3 +128,5 @@ class DeviceInfoSerializer(serializers.Serializer):
     switch_name = serializers.CharField(read_only=True)
     switch_ip = serializers.IPAddressField(read_only=True)
     switch_port = serializers.IntegerField(read_only=True)
+    packets = serializers.IntegerField(read_only=True)
+    bytes = serializers.IntegerField(read_only=True)
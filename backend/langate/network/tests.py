@@ -1,8 +1,12 @@
 import json
+from datetime import timedelta
+
+import requests
 
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.urls import reverse
+from django.utils import timezone
 
 from unittest.mock import patch, MagicMock
 
@@ -10,6 +14,7 @@ from rest_framework import status
 from rest_framework.test import APIClient
 
 from langate.network.models import DeviceManager, Device, UserDevice
+from langate.network.views import top_devices_gauge
 from langate.network.utils import get_mark
 from langate.user.models import User, Role
 from .serializers import FullDeviceSerializer
@@ -601,23 +606,59 @@ class TestMarkAPI(TestCase):
             self.assertEqual(response.data[i]["devices"], Device.objects.filter(mark=self.settings["marks"][i]["value"], whitelisted=False).count())
             self.assertEqual(response.data[i]["whitelisted"], Device.objects.filter(mark=self.settings["marks"][i]["value"], whitelisted=True).count())
 
-    @patch('langate.settings.netcontrol.set_mark', return_value=None)
+    @patch('langate.settings.netcontrol.set_shaping', return_value=None)
+    @patch('langate.settings.netcontrol.set_marks', return_value={})
     @patch('langate.network.views.save_settings')
-    def test_patch_marks(self, mock_save_settings, mock_set_mark):
+    def test_patch_marks(self, mock_save_settings, mock_set_marks, mock_set_shaping):
         mock_save_settings.side_effect = lambda x: None
 
         new_marks = [
           {"value": 102, "name": "Mark 3", "priority": 0.3},
           {"value": 103, "name": "Mark 4", "priority": 0.7}
         ]
-        response = self.client.patch(self.url, new_marks, format='json')
+        with patch.dict('langate.settings.SETTINGS', {"marks": self.settings["marks"]}):
+            response = self.client.patch(self.url, new_marks, format='json')
+
+            from langate.settings import SETTINGS as ORIGINAL_SETTINGS
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(ORIGINAL_SETTINGS["marks"]), 2)
+            self.assertEqual(ORIGINAL_SETTINGS["marks"][0]["value"], 102)
+            self.assertEqual(ORIGINAL_SETTINGS["marks"][1]["value"], 103)
+
+        # The new marks, without limits, are sent to netcontrol
+        mock_set_shaping.assert_called_once_with(new_marks)
 
-        from langate.settings import SETTINGS as ORIGINAL_SETTINGS
+        # The devices of the removed marks are moved with a single request
+        mock_set_marks.assert_called_once()
+        self.assertEqual(len(mock_set_marks.call_args[0][0]), 3)
+        self.assertEqual(Device.objects.filter(mark__in=[100, 101]).count(), 0)
+
+    @patch('langate.settings.netcontrol.set_shaping', return_value=None)
+    @patch('langate.settings.netcontrol.set_marks', return_value={})
+    @patch('langate.network.views.save_settings')
+    def test_patch_marks_rate_limits(self, _mock_save_settings, _mock_set_marks, mock_set_shaping):
+        new_marks = [
+          {
+            "value": 100, "name": "Mark 1", "priority": 0.5,
+            "rate_limit": 10000, "device_rate_limit": 1000
+          },
+          {"value": 101, "name": "Mark 2", "priority": 0.5, "device_rate_limit": None}
+        ]
+        response = self.client.patch(self.url, new_marks, format='json')
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(ORIGINAL_SETTINGS["marks"]), 2)
-        self.assertEqual(ORIGINAL_SETTINGS["marks"][0]["value"], 102)
-        self.assertEqual(ORIGINAL_SETTINGS["marks"][1]["value"], 103)
+        self.assertEqual(response.data[0]["rate_limit"], 10000)
+        self.assertEqual(response.data[0]["device_rate_limit"], 1000)
+        self.assertNotIn("device_rate_limit", response.data[1])
+        mock_set_shaping.assert_called_once_with(response.data)
+
+    def test_patch_invalid_rate_limit(self):
+        invalid_marks = [
+          {"value": 100, "name": "Mark 1", "priority": 0.5, "rate_limit": 0}
+        ]
+        response = self.client.patch(self.url, invalid_marks, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     def test_patch_invalid_marks(self):
         invalid_marks = [
@@ -634,6 +675,59 @@ class TestMarkAPI(TestCase):
         response = self.client.patch(self.url, [], format='json')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+class TestMarkMoveAPI(TestCase):
+    """
+    Test cases for the MarkMove and MarkSpread views
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.user.role = Role.STAFF
+        self.user.save()
+        self.client.force_authenticate(user=self.user)
+        self.settings = {"marks":[
+          {"value": 100, "name": "Mark 1", "priority": 0.5},
+          {"value": 101, "name": "Mark 2", "priority": 0.5}
+        ]}
+        Device.objects.create(mac="00:00:00:00:00:01", mark=100, whitelisted=False)
+        Device.objects.create(mac="00:00:00:00:00:02", mark=100, whitelisted=True)
+        Device.objects.create(mac="00:00:00:00:00:03", mark=100, whitelisted=False)
+
+    @patch('langate.settings.netcontrol.set_marks', return_value={})
+    @patch('langate.network.views.SETTINGS')
+    def test_move_mark(self, mock_settings, mock_set_marks):
+        mock_settings.__getitem__.side_effect = self.settings.__getitem__
+
+        response = self.client.post(reverse('mark-move', args=[100, 101]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_set_marks.assert_called_once()
+        self.assertEqual(len(mock_set_marks.call_args[0][0]), 2)
+        self.assertEqual(Device.objects.filter(mark=101).count(), 2)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:02").mark, 100)
+
+    @patch('langate.settings.netcontrol.set_marks', return_value={"00:00:00:00:00:03": "Error"})
+    @patch('langate.network.views.SETTINGS')
+    def test_move_mark_partial_failure(self, mock_settings, _mock_set_marks):
+        mock_settings.__getitem__.side_effect = self.settings.__getitem__
+
+        response = self.client.post(reverse('mark-move', args=[100, 101]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:01").mark, 101)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:03").mark, 100)
+
+    @patch('langate.settings.netcontrol.set_marks', return_value={})
+    @patch('langate.network.views.SETTINGS')
+    def test_spread_mark_invalid(self, mock_settings, mock_set_marks):
+        mock_settings.__getitem__.side_effect = self.settings.__getitem__
+
+        response = self.client.post(reverse('mark-spread', args=[102]))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_set_marks.assert_not_called()
+
 class TestsGameMarkAPI(TestCase):
   def setUp(self):
     self.settings = {
@@ -705,3 +799,170 @@ class TestsGameMarkAPI(TestCase):
     self.client.force_authenticate(user=None)
     response = self.client.patch(self.url, data=json.dumps({}), content_type='application/json')
     self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class TestGamePriorityAPI(TestCase):
+    """
+    Test cases for the GamePriority view
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('game-priority')
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.user.role = Role.STAFF
+        self.user.save()
+        self.client.force_authenticate(user=self.user)
+        self.player = User.objects.create_user(
+          username='player', password='testpass', tournament="game2"
+        )
+        UserDevice.objects.create(
+          mac="00:00:00:00:00:01", user=self.player, ip="10.0.0.1", mark=101
+        )
+
+    @patch.dict('langate.settings.SETTINGS', {"games": {"game1": [100], "game2": [101, 102]}})
+    @patch('langate.settings.netcontrol.set_priority', return_value=None)
+    @patch('langate.network.views.save_settings')
+    def test_patch_priority(self, _mock_save_settings, mock_set_priority):
+        response = self.client.patch(self.url, {"marks": True, "players": True}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"marks": True, "players": True})
+        mock_set_priority.assert_called_once_with([100, 101, 102], ["00:00:00:00:00:01"])
+
+    def test_patch_invalid_priority(self):
+        response = self.client.patch(self.url, {"marks": "yes"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [{"name": "game2", "value": 101, "priority": 1}],
+      "games": {"game2": [101]}, "game_priority": {"marks": False, "players": True}
+    })
+    @patch('langate.settings.netcontrol.set_priority')
+    @patch('langate.settings.netcontrol.add_priority_devices', return_value={})
+    @patch('langate.settings.netcontrol.connect_user', return_value=None)
+    @patch('langate.settings.netcontrol.get_mac', return_value="00:00:00:00:00:02")
+    def test_player_device_prioritized(
+      self, _mock_get_mac, _mock_connect_user, mock_add_priority_devices, mock_set_priority
+    ):
+        DeviceManager.create_user_device(self.player, "10.0.0.2")
+
+        mock_add_priority_devices.assert_called_once_with(["00:00:00:00:00:02"])
+        mock_set_priority.assert_not_called()
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "games": {"game2": [101]}, "game_priority": {"marks": False, "players": True}
+    })
+    @patch('langate.settings.netcontrol.delete_priority_devices', return_value={})
+    @patch('langate.settings.netcontrol.disconnect_user', return_value=None)
+    def test_deleted_device_deprioritized(self, _mock_disconnect_user, mock_delete_priority_devices):
+        DeviceManager.delete_device("00:00:00:00:00:01")
+
+        mock_delete_priority_devices.assert_called_once_with(["00:00:00:00:00:01"])
+
+class TestMetricsAPI(TestCase):
+    """
+    Test cases for the Metrics view
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        Device.objects.create(mac="00:00:00:00:00:01", name="talker", mark=100)
+
+    @patch('langate.settings.netcontrol.get_top_devices', return_value={
+      "interval": 60,
+      "devices": [{"mac": "00:00:00:00:00:01", "mark": 100, "packets": 10, "bytes": 1234}]
+    })
+    def test_top_devices(self, _mock_get_top_devices):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+          'langate_top_devices_bytes{mac="00:00:00:00:00:01",name="talker"} 1234.0',
+          response.content.decode()
+        )
+
+    @patch('langate.settings.netcontrol.get_top_devices', return_value={
+      "interval": None,
+      "devices": [{"mac": "00:00:00:00:00:01", "mark": 100, "packets": 10, "bytes": 1234}]
+    })
+    def test_top_devices_absolute(self, _mock_get_top_devices):
+        top_devices_gauge.clear()
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('langate_top_devices_bytes{', response.content.decode())
+
+    @patch('langate.settings.netcontrol.get_top_devices', side_effect=requests.Timeout)
+    def test_top_devices_timeout(self, mock_get_top_devices):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(mock_get_top_devices.call_args.kwargs["timeout"], 2)
+
+class TestHeartbeat(TestCase):
+    """
+    Test cases for the refresh of active devices
+    """
+
+    def setUp(self):
+        self.active = User.objects.create_user(username='active', password='testpass')
+        self.active.last_login = timezone.now()
+        self.active.save()
+        self.idle = User.objects.create_user(username='idle', password='testpass')
+        self.idle.last_login = timezone.now() - timedelta(days=365)
+        self.idle.save()
+
+        Device.objects.create(
+          mac="00:00:00:00:00:01", name="whitelisted", mark=100, whitelisted=True
+        )
+        UserDevice.objects.create(
+          mac="00:00:00:00:00:02", user=self.active, ip="10.0.0.2", mark=100
+        )
+        UserDevice.objects.create(
+          mac="00:00:00:00:00:03", user=self.idle, ip="10.0.0.3", mark=100
+        )
+
+    def test_active_devices(self):
+        macs = sorted(device.mac for device in DeviceManager.active_devices())
+        self.assertEqual(macs, ["00:00:00:00:00:01", "00:00:00:00:00:02"])
+
+    @patch('langate.settings.netcontrol.heartbeat', return_value={
+      "00:00:00:00:00:02": "Error"
+    })
+    def test_heartbeat(self, mock_heartbeat):
+        failed = DeviceManager.heartbeat(DeviceManager.active_devices())
+
+        self.assertEqual(failed, 1)
+        mock_heartbeat.assert_called_once()
+        self.assertEqual(len(mock_heartbeat.call_args[0][0]), 2)
+
+class TestNetcontrolClient(TestCase):
+    """
+    Test cases for the bulk lookups of the netcontrol client
+    """
+
+    @patch('langate.modules.netcontrol.requests.post')
+    def test_get_macs(self, mock_post):
+        from langate.settings import netcontrol
+        mock_post.return_value.json.return_value = {
+          "macs": {"10.0.0.1": "00:00:00:00:00:01"}, "missing": ["10.0.0.2"]
+        }
+
+        result = netcontrol.get_macs(["10.0.0.1", "10.0.0.2"])
+
+        self.assertEqual(result, {"macs": {"10.0.0.1": "00:00:00:00:00:01"}, "missing": ["10.0.0.2"]})
+        self.assertEqual(mock_post.call_args.args[0], netcontrol.REQUEST_URL + "get_macs")
+        self.assertEqual(mock_post.call_args.kwargs["json"], ["10.0.0.1", "10.0.0.2"])
+
+    @patch('langate.modules.netcontrol.requests.post')
+    def test_get_ips(self, mock_post):
+        from langate.settings import netcontrol
+        mock_post.return_value.json.return_value = {
+          "ips": {"00:00:00:00:00:01": "10.0.0.1"}, "missing": ["00:00:00:00:00:02"]
+        }
+
+        result = netcontrol.get_ips(["00:00:00:00:00:01", "00:00:00:00:00:02"])
+
+        self.assertEqual(result, {"ips": {"00:00:00:00:00:01": "10.0.0.1"}, "missing": ["00:00:00:00:00:02"]})
+        self.assertEqual(mock_post.call_args.args[0], netcontrol.REQUEST_URL + "get_ips")
+        self.assertEqual(mock_post.call_args.kwargs["json"], ["00:00:00:00:00:01", "00:00:00:00:00:02"])
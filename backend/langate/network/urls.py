@@ -13,6 +13,7 @@ urlpatterns = [
     path("mark/<int:old>/move/<int:new>/", views.MarkMove.as_view(), name="mark-move"),
     path("mark/<int:old>/spread/", views.MarkSpread.as_view(), name="mark-spread"),
     path("games/", views.GameList.as_view(), name="game-list"),
+    path("games/priority/", views.GamePriority.as_view(), name="game-priority"),
     path("userdevices/<int:pk>/", views.UserDeviceDetail.as_view(), name="user-device-detail"),
     path("metrics/", views.Metrics.as_view(), name="metrics"),
 ]
@@ -86,6 +86,12 @@ def validate_marks(marks):
         if not isinstance(mark["name"], str) or not isinstance(mark["value"], int) or not (isinstance(mark["priority"], int) or isinstance(mark["priority"], float)):
             return False
 
+    # Check the optional bandwidth limits, in kbytes/s
+    for mark in marks:
+        for limit in ["rate_limit", "device_rate_limit"]:
+            if mark.get(limit) is not None and (not isinstance(mark[limit], int) or mark[limit] <= 0):
+                return False
+
     return True
 
 def validate_games(games):
@@ -118,6 +124,34 @@ def validate_games(games):
 
     return True
 
+def validate_game_priority(priority):
+    """
+    Validate the game priority data.
+    It tells whether the traffic on the marks of the games and the traffic of the players' devices is prioritized.
+    For example:
+    {
+        "marks": true,
+        "players": false
+    }
+    """
+    if not isinstance(priority, dict):
+        return False
+
+    for key in priority:
+        if key not in ["marks", "players"] or not isinstance(priority[key], bool):
+            return False
+
+    return True
+
+def get_game_priority():
+    """
+        Get the game priority settings, nothing being prioritized by default
+    """
+    # prevent circular import
+    from langate.settings import SETTINGS
+
+    return {"marks": False, "players": False} | SETTINGS.get("game_priority", {})
+
 def save_settings(new_settings):
     """
     Save the settings to the settings.json file
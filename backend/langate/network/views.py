@@ -1,4 +1,6 @@
 import copy
+import logging
+import requests
 from functools import reduce
 from operator import or_
 
@@ -18,13 +20,18 @@ from drf_yasg import openapi
 
 import prometheus_client as prometheus
 
-from langate.settings import SETTINGS
+from langate.settings import SETTINGS, netcontrol
 from langate.user.models import Role
 from langate.network.models import Device, UserDevice, DeviceManager
-from langate.network.utils import validate_marks, validate_games, save_settings, get_mark
+from langate.network.utils import validate_marks, validate_games, validate_game_priority, get_game_priority, save_settings, get_mark
 
 from langate.network.serializers import DeviceSerializer, UserDeviceSerializer, FullDeviceSerializer, DeviceInfoSerializer
 
+logger = logging.getLogger(__name__)
+
+TOP_DEVICES_TIMEOUT = 2 # seconds
+top_devices_gauge = prometheus.Gauge("langate_top_devices_bytes", "Bytes sent by the devices sending the most traffic over the last minute", labelnames=["mac", "name"])
+
 class Pagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
@@ -349,6 +356,9 @@ class MarkList(APIView):
               "value": mark["value"],
               "priority": mark["priority"]
             })
+            for limit in ["rate_limit", "device_rate_limit"]:
+                if mark.get(limit) is not None:
+                    marks[-1][limit] = mark[limit]
 
         # If some marks are removed, add the new marks first, spread the devices and then remove the old marks
         old_marks = [m["value"] for m in SETTINGS["marks"]]
@@ -358,12 +368,18 @@ class MarkList(APIView):
         SETTINGS["marks"] = marks
         save_settings(SETTINGS)
 
+        # The limits are applied again when the backend starts, the settings are kept if netcontrol can't be reached
+        try:
+            netcontrol.set_shaping(marks)
+        except requests.HTTPError as e:
+            logger.error("Could not apply the bandwidth limits: %s", e)
+
         if removed_marks:
-            for mark in removed_marks:
-                devices = Device.objects.filter(mark=mark)
-                for device in devices:
-                    new = get_mark(excluded_marks=[mark])
-                    DeviceManager.edit_device(device, device.mac, device.name, new)
+            devices = list(Device.objects.filter(mark__in=removed_marks))
+            try:
+                DeviceManager.move_devices(devices, [get_mark(excluded_marks=[device.mark]) for device in devices])
+            except ValidationError as e:
+                return Response({"error": e.message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         return Response(SETTINGS["marks"], status=status.HTTP_200_OK)
 
@@ -387,9 +403,11 @@ class MarkMove(APIView):
         if new not in marks:
             return Response({"error": _("Invalid destination mark")}, status=status.HTTP_400_BAD_REQUEST)
 
-        devices = Device.objects.filter(mark=old, whitelisted=False)
-        for device in devices:
-            DeviceManager.edit_device(device, device.mac, device.name, new)
+        devices = list(Device.objects.filter(mark=old, whitelisted=False))
+        try:
+            DeviceManager.move_devices(devices, [new] * len(devices))
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         return Response(status=status.HTTP_200_OK)
 
@@ -413,10 +431,11 @@ class MarkSpread(APIView):
         if sum([mark["priority"] for mark in SETTINGS["marks"] if mark["value"] != old]) == 0:
             return Response({"error": _("No mark to spread to")}, status=status.HTTP_400_BAD_REQUEST)
 
-        devices = Device.objects.filter(mark=old, whitelisted=False)
-        for device in devices:
-            new = get_mark(excluded_marks=[old])
-            DeviceManager.edit_device(device, device.mac, device.name, new)
+        devices = list(Device.objects.filter(mark=old, whitelisted=False))
+        try:
+            DeviceManager.move_devices(devices, [get_mark(excluded_marks=[old]) for _ in devices])
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         return Response(status=status.HTTP_200_OK)
 
@@ -443,8 +462,44 @@ class GameList(APIView):
 
         save_settings(SETTINGS)
 
+        # The marks of the games and their players may have changed
+        if any(get_game_priority().values()):
+            try:
+                DeviceManager.apply_priority()
+            except ValidationError as e:
+                logger.error("Could not apply the game priority: %s", e)
+
         return Response(SETTINGS["games"], status=status.HTTP_201_CREATED)
 
+class GamePriority(APIView):
+    """
+    API endpoint that allows the prioritization of game traffic to be viewed and modified.
+    """
+    permission_classes = [StaffPermission]
+
+    def get(self, request):
+        """
+        Return whether the marks of the games and the devices of their players are prioritized
+        """
+        return Response(get_game_priority())
+
+    def patch(self, request):
+        """
+        Modify what is prioritized, and apply it to every device at once
+        """
+        if not validate_game_priority(request.data):
+            return Response({"error": _("Invalid game priority")}, status=status.HTTP_400_BAD_REQUEST)
+
+        SETTINGS["game_priority"] = get_game_priority() | request.data
+        save_settings(SETTINGS)
+
+        try:
+            DeviceManager.apply_priority()
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response(SETTINGS["game_priority"], status=status.HTTP_200_OK)
+
 class UserDeviceDetail(APIView):
     """
     API endpoint that allows a user to edit or delete their devices
@@ -512,4 +567,17 @@ class Metrics(APIView):
     renderer_classes = [PlainTextRenderer]
 
     def get(self, request):
+        # Refresh the top devices from netcontrol's counters, without holding the scrape if netcontrol is slow
+        try:
+            top = netcontrol.get_top_devices(10, 60, timeout=TOP_DEVICES_TIMEOUT)
+        except requests.RequestException:
+            top = None
+
+        # Without a previous read in netcontrol the counters are absolute, not the traffic of the last minute
+        if top is not None and top["interval"] is not None:
+            names = dict(Device.objects.filter(mac__in=[d["mac"] for d in top["devices"]]).values_list("mac", "name"))
+            top_devices_gauge.clear()
+            for device in top["devices"]:
+                top_devices_gauge.labels(device["mac"], names.get(device["mac"], "")).set(device["bytes"])
+
         return HttpResponse(prometheus.generate_latest().decode("utf-8"), content_type=prometheus.CONTENT_TYPE_LATEST)
\ No newline at end of file
@@ -261,6 +261,8 @@ else:
         SETTINGS["games"] = {}
 
 NETCONTROL_SOCKET_FILE = getenv("NETCONTROL_SOCKET_FILE", "/var/run/langate3000-netcontrol.sock")
+# Seconds between two refreshes of the active devices in netcontrol (0 disables them)
+NETCONTROL_HEARTBEAT_INTERVAL = int(getenv("NETCONTROL_HEARTBEAT_INTERVAL", "300"))
 
 # Netcontrol interface
 netcontrol = Netcontrol()
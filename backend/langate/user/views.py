@@ -366,6 +366,14 @@ class UserLogin(APIView):
                     )
             login(request, user)
 
+            # The devices of a user coming back after a while may have expired in netcontrol
+            previous_devices = UserDevice.objects.filter(user=request.user)
+            if previous_devices.exists():
+                try:
+                    DeviceManager.heartbeat(previous_devices)
+                except ValidationError:
+                    logger.exception("Could not refresh the devices of %s", request.user.username)
+
             user = UserSerializer(user, context={"request": request}).data
 
             # handle user device
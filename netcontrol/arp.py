@@ -1,12 +1,310 @@
 from fastapi import HTTPException
+import errno
+import ipaddress
 import logging
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from . import netlink
+from .netlink import Addresses
+from .leases import Leases
+from .metrics import file_parse_duration
+
+REFRESH_INTERVAL = 0.25 # seconds during which a parse of the ARP table is reused
+PROBE_POLL_INTERVAL = 0.05 # seconds between two lookups while waiting for a probed neighbour
+PROBE_PORT = 9 # discard, the datagram only needs to trigger the neighbour resolution
+WATCH_RETRY_DELAY = 1 # seconds between two attempts to reopen the neighbour notifications
+
+class ArpIndex:
+    """
+    Snapshot of the ARP table, indexed by IP and by MAC address.
+    The table is parsed again at most every REFRESH_INTERVAL, or on a miss, and concurrent lookups share a single parse.
+    """
+    def __init__(self):
+        # Time at which the last parse started, MAC address of each IP and IP of each MAC address, replaced at once
+        self.state: tuple[float | None, dict[str, str], dict[str, str]] = (None, {}, {})
+        self.lock = threading.Lock()
+
+    def _is_recent(self, read_time: float | None, now: float, since: float | None) -> bool:
+        if read_time is None:
+            return False
+        if since is not None:
+            return read_time >= since
+        return now - read_time < REFRESH_INTERVAL
+
+    def snapshot(self, since: float | None = None) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        Gets the indexes, parsing the table again if they are too old.
+
+        :param since: Time after which the table must have been parsed, to look up an entry missing from an older parse.
+        :return: MAC address of each IP, and IP of each MAC address.
+        """
+        now = time.monotonic()
+        read_time, by_ip, by_mac = self.state
+        if self._is_recent(read_time, now, since):
+            return by_ip, by_mac
+        
+        with self.lock:
+            # Another lookup may have parsed the table while this one was waiting for the lock
+            read_time, by_ip, by_mac = self.state
+            if self._is_recent(read_time, now, since):
+                return by_ip, by_mac
+            
+            read_time = time.monotonic()
+            by_ip, by_mac = self._parse()
+            self.state = (read_time, by_ip, by_mac)
+            return by_ip, by_mac
+
+    def _parse(self) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        Reads /proc/net/arp.
+
+        :return: MAC address of each IP, and IP of each MAC address.
+        """
+        by_ip = {}
+        by_mac = {}
+        with file_parse_duration.labels("/proc/net/arp").time(), open('/proc/net/arp', 'r') as f: # Open arp table
+            for line in f.readlines()[1:]:
+                # IP address, HW type, flags, HW address, mask, device
+                fields = line.split()
+                if len(fields) < 4 or fields[2] == "0x0":
+                    continue # incomplete entry, whose MAC address is not known yet
+                by_ip[fields[0]] = fields[3]
+                by_mac.setdefault(fields[3], fields[0])
+        return by_ip, by_mac
+
+    def lookup_mac(self, ip: str) -> str | None:
+        """
+        :param ip: Ip address of the machine.
+        :return: Mac address of the machine, None if it is not in the table.
+        """
+        start = time.monotonic()
+        mac = self.snapshot()[0].get(ip)
+        if mac is None:
+            mac = self.snapshot(since=start)[0].get(ip)
+        return mac
+
+    def lookup_ip(self, mac: str) -> str | None:
+        """
+        :param mac: Mac address of the machine.
+        :return: Ip address of the machine, None if it is not in the table.
+        """
+        start = time.monotonic()
+        ip = self.snapshot()[1].get(mac)
+        if ip is None:
+            ip = self.snapshot(since=start)[1].get(mac)
+        return ip
+
+class NeighbourIndex:
+    """
+    Index of the neighbour table, by IP and by MAC address, kept current by the kernel's neighbour notifications.
+    Has the same lookups as ArpIndex, but never needs to read the table again.
+    """
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.by_ip: dict[str, str] = {}
+        self.by_mac: dict[str, str] = {}
+        self.lock = threading.Lock()
+        # Subscribing before the dump, so that no change is missed in between
+        self.socket = netlink.open_socket(netlink.RTMGRP_NEIGH)
+        self._load()
+        threading.Thread(target=self._watch, name="netlink-neighbours", daemon=True).start()
+
+    def _load(self) -> None:
+        """
+        Replaces the indexes with a dump of the neighbour table.
+        """
+        by_ip = {ip: mac for ip, mac in netlink.get_neighbours() if mac is not None}
+        by_mac = {}
+        for ip, mac in by_ip.items():
+            by_mac.setdefault(mac, ip)
+        with self.lock:
+            self.by_ip, self.by_mac = by_ip, by_mac
+        self.logger.info(f"Loaded {len(by_ip)} neighbours from netlink")
+
+    def _update(self, ip: str, mac: str | None) -> None:
+        """
+        Applies a change of the neighbour table.
+
+        :param ip: Ip address of the neighbour.
+        :param mac: Its new Mac address, None if it is gone.
+        """
+        with self.lock:
+            previous = self.by_ip.pop(ip, None)
+            if previous is not None and self.by_mac.get(previous) == ip:
+                del self.by_mac[previous]
+                # Another address of the same device, if any, takes over
+                other = next((other for other, other_mac in self.by_ip.items() if other_mac == previous), None)
+                if other is not None:
+                    self.by_mac[previous] = other
+            if mac is not None:
+                self.by_ip[ip] = mac
+                if self.by_mac.setdefault(mac, ip) != ip:
+                    self.logger.debug(f"Device {mac} also uses IP {ip}")
+                elif previous != mac:
+                    self.logger.debug(f"Device {mac} now uses IP {ip}")
+
+    def _watch(self) -> None:
+        """
+        Notification loop, applying every change to the indexes.
+        """
+        while True:
+            try:
+                data = self.socket.recv(netlink.BUFFER_SIZE)
+            except OSError as ex:
+                if ex.errno == errno.ENOBUFS:
+                    # Notifications were dropped because they came faster than they were read
+                    self.logger.warning("Neighbour notifications lost, reloading the neighbour table")
+                    self._resync(False)
+                else:
+                    self.logger.error(f"Neighbour notifications failed, reopening them: {ex}")
+                    self._resync(True)
+                continue
+            
+            for msg_type, body in netlink.parse_messages(data):
+                neighbour = netlink.parse_neighbour(msg_type, body)
+                if neighbour is not None:
+                    self._update(*neighbour)
+
+    def _resync(self, reopen: bool) -> None:
+        """
+        Reloads the neighbour table after notifications were missed, until it succeeds.
+
+        :param reopen: Whether the notification socket failed and is opened again first.
+        """
+        while True:
+            try:
+                if reopen:
+                    self.socket.close()
+                    self.socket = netlink.open_socket(netlink.RTMGRP_NEIGH)
+                    reopen = False
+                self._load()
+                return
+            except OSError as ex:
+                self.logger.error(f"Could not reload the neighbour table, retrying in {WATCH_RETRY_DELAY}s: {ex}")
+                time.sleep(WATCH_RETRY_DELAY)
+
+    def snapshot(self, since: float | None = None) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        Gets the indexes, which are always current.
+
+        :param since: Ignored, for compatibility with ArpIndex.
+        :return: Copies of the MAC address of each IP, and IP of each MAC address, as the notifications keep changing the indexes.
+        """
+        with self.lock:
+            return dict(self.by_ip), dict(self.by_mac)
+
+    def lookup_mac(self, ip: str) -> str | None:
+        return self.by_ip.get(ip)
+
+    def lookup_ip(self, mac: str) -> str | None:
+        return self.by_mac.get(mac)
+
+class Prober:
+    """
+    Resolves neighbours missing from the table, by sending them a datagram so that the kernel resolves their MAC address.
+    Concurrent lookups of the same IP wait for the same probe.
+    Only the IPs of the LAN and of the subnets of the gate's interfaces are probed, as only those can be neighbours.
+    """
+    def __init__(self, logger: logging.Logger, index: ArpIndex | NeighbourIndex, timeout: float,
+                 ip_range: str | None = None, addresses: Addresses | None = None):
+        """
+        :param index: Index in which the resolved neighbour appears.
+        :param timeout: Seconds to wait for the neighbour after the probe.
+        :param ip_range: Network of the LAN, whose IPs may be probed.
+        :param addresses: Addresses of the gate, the IPs of whose subnets may be probed.
+        """
+        self.logger = logger
+        self.index = index
+        self.timeout = timeout
+        self.ip_range = None if ip_range is None else ipaddress.IPv4Network(ip_range, strict=False)
+        self.addresses = addresses
+        self.probes: dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, ip: str) -> str | None:
+        """
+        Probes an IP, or waits for the probe already sent to it.
+
+        :param ip: Ip address of the machine.
+        :return: Mac address of the machine, None if it didn't appear in time.
+        """
+        with self.lock:
+            probe = self.probes.get(ip)
+            owner = probe is None
+            if owner:
+                probe = self.probes[ip] = Future()
+        if not owner:
+            return probe.result()
+        
+        try:
+            probe.set_result(self._probe(ip))
+        except Exception as ex:
+            probe.set_exception(ex)
+        finally:
+            with self.lock:
+                del self.probes[ip]
+        return probe.result()
+
+    def _is_neighbour(self, ip: str) -> bool:
+        """
+        :param ip: Ip address of the machine.
+        :return: Whether the IP is a literal of the LAN or of a subnet of the gate, and not an address of the gate itself.
+        """
+        try:
+            # Only an IP literal, to never trigger a DNS lookup
+            address = ipaddress.IPv4Address(ip)
+        except ValueError:
+            return False
+        if address.is_loopback:
+            return False
+        
+        interfaces = [] if self.addresses is None else self.addresses.get()
+        if any(address == ipaddress.IPv4Address(local) for _, local, _ in interfaces):
+            return False
+        if self.ip_range is not None and address in self.ip_range:
+            return True
+        return any(address in ipaddress.IPv4Network(f"{local}/{prefixlen}", strict=False) for _, local, prefixlen in interfaces)
+
+    def _probe(self, ip: str) -> str | None:
+        """
+        Sends the probe and polls the index until the neighbour appears or the timeout expires.
+        """
+        if not self._is_neighbour(ip):
+            self.logger.debug("Not probing IP %s, which is outside of the local networks", ip)
+            return None
+        
+        deadline = time.monotonic() + self.timeout
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b"", (ip, PROBE_PORT))
+        except OSError as ex:
+            self.logger.debug("Could not probe IP %s: %s", ip, ex)
+            return None
+        
+        while True:
+            mac = self.index.snapshot(since=time.monotonic())[0].get(ip)
+            if mac is not None or time.monotonic() >= deadline:
+                return mac
+            time.sleep(PROBE_POLL_INTERVAL)
 
 class Arp:
     """
     Class which interacts with the ARP table
     """
-    def __init__(self, logger: logging.Logger):
+    def __init__(self, logger: logging.Logger, probe_timeout: float = 0, leases: Leases | None = None,
+                 ip_range: str | None = None, addresses: Addresses | None = None):
+        """
+        :param probe_timeout: Seconds to wait for a probed IP missing from the table, 0 to not probe.
+        :param leases: DHCP leases, looked up for IPs missing from the table.
+        :param ip_range: Network of the LAN, whose IPs may be probed.
+        :param addresses: Addresses of the gate, the IPs of whose subnets may be probed.
+        """
         self.logger = logger
+        self.index = ArpIndex()
+        self.prober = Prober(logger, self.index, probe_timeout, ip_range, addresses) if probe_timeout > 0 else None
+        self.leases = leases
 
     def get_mac(self, ip: str):
         """
@@ -16,14 +314,19 @@ class Arp:
         :return: Mac address of the machine.
         """
         self.logger.info("Querying MAC for IP %s", ip)
-        with open('/proc/net/arp', 'r') as f: # Open arp table
-            lines = f.readlines()[1:]
-            for line in lines:
-                if line.startswith(ip + " "):
-                    mac = line[41:].split(" ")[0] # 41 is the position of the MAC address in the line
-                    self.logger.info("Found MAC %s for IP %s", mac, ip)
-                    return { "mac" : mac }
+        mac = self.index.lookup_mac(ip)
+        if mac is None and self.prober is not None:
+            # The first packets of a device can reach the gate before its neighbour entry is resolved
+            mac = self.prober.resolve(ip)
+        if mac is None and self.leases is not None:
+            # A lease may be stale and its IP reused by another device, so it only comes last
+            mac = self.leases.lookup_mac(ip)
+            if mac is not None:
+                self.logger.warning("IP %s not resolved, using the MAC %s of its DHCP lease", ip, mac)
+        if mac is None:
             raise HTTPException(status_code=404, detail="MAC not found")
+        self.logger.info("Found MAC %s for IP %s", mac, ip)
+        return { "mac" : mac }
     
     def get_ip(self, mac: str):
         """
@@ -33,14 +336,64 @@ class Arp:
         :return: Ip address of the machine.
         """
         self.logger.info("Querying IP for MAC %s", mac)
-        with open('/proc/net/arp', 'r') as f: # Open arp table
-            lines = f.readlines()[1:]
-            for line in lines:
-                if line[41:].split(" ")[0] == mac:
-                    ip = line.split(" ")[0] # Extracting IP address
-                    self.logger.info("Found IP %s for MAC %s", ip, mac)
-                    return { "ip" : ip }
+        ip = self.index.lookup_ip(mac)
+        if ip is None:
             raise HTTPException(status_code=404, detail="IP not found")
+        self.logger.info("Found IP %s for MAC %s", ip, mac)
+        return { "ip" : ip }
+
+    def get_macs(self, ips: list[str]):
+        """
+        Get the mac addresses associated with several ip addresses, from a single snapshot of the table.
+
+        :param ips: Ip addresses of the machines.
+        :return: Dict with the "macs" found indexed by ip, and the "missing" ips.
+        """
+        macs, missing = self._resolve(ips, 0)
+        if len(missing) > 0 and self.leases is not None:
+            by_ip = self.leases.snapshot()[1]
+            macs |= {ip: by_ip[ip] for ip in missing if ip in by_ip}
+            missing = [ip for ip in missing if ip not in macs]
+        self.logger.info("Found MACs for %d of %d IPs", len(macs), len(ips))
+        return { "macs": macs, "missing": missing }
+
+    def get_ips(self, macs: list[str]):
+        """
+        Get the ip addresses associated with several mac addresses, from a single snapshot of the table.
+
+        :param macs: Mac addresses of the machines.
+        :return: Dict with the "ips" found indexed by mac, and the "missing" macs.
+        """
+        ips, missing = self._resolve(macs, 1)
+        self.logger.info("Found IPs for %d of %d MACs", len(ips), len(macs))
+        return { "ips": ips, "missing": missing }
+
+    def _resolve(self, keys: list[str], side: int) -> tuple[dict[str, str], list[str]]:
+        """
+        Looks several addresses up in the same snapshot, reading the table once more if some are missing.
+
+        :param keys: Addresses to look up.
+        :param side: 0 to look up ip addresses, 1 to look up mac addresses.
+        :return: Value of each address found, and the addresses which are not in the table.
+        """
+        start = time.monotonic()
+        table = self.index.snapshot()[side]
+        found = {key: table.get(key) for key in keys if table.get(key) is not None}
+        if len(found) < len(set(keys)):
+            table = self.index.snapshot(since=start)[side]
+            found = {key: table.get(key) for key in keys if table.get(key) is not None}
+        return found, [key for key in keys if key not in found]
+
+class NetlinkArp(Arp):
+    """
+    Class which follows the neighbour table through rtnetlink instead of reading /proc/net/arp
+    """
+    def __init__(self, logger: logging.Logger, probe_timeout: float = 0, leases: Leases | None = None,
+                 ip_range: str | None = None, addresses: Addresses | None = None):
+        self.logger = logger
+        self.index = NeighbourIndex(logger)
+        self.prober = Prober(logger, self.index, probe_timeout, ip_range, addresses) if probe_timeout > 0 else None
+        self.leases = leases
 
 class MockedArp(Arp):
     """
@@ -59,4 +412,12 @@ class MockedArp(Arp):
         self.logger.info("Querying IP for MAC %s", mac)
         ip = "127.0.0.1"
         self.logger.info("Found IP %s for MAC %s", ip, mac)
-        return { "ip" : "127.0.0.1" }
\ No newline at end of file
+        return { "ip" : "127.0.0.1" }
+    
+    def get_macs(self, ips: list[str]):
+        self.logger.info("Found MACs for %d of %d IPs", len(ips), len(ips))
+        return { "macs": {ip: "00:00:00:00:00:00" for ip in ips}, "missing": [] }
+    
+    def get_ips(self, macs: list[str]):
+        self.logger.info("Found IPs for %d of %d MACs", len(macs), len(macs))
+        return { "ips": {mac: "127.0.0.1" for mac in macs}, "missing": [] }
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""
+Builders for libnftables JSON commands.
+
+Commands are plain dicts following the libnftables JSON schema (see libnftables-json(5)),
+they are wrapped in an {"nftables": [...]} object before being sent to nftables.
+Values are never formatted into a string, so MAC addresses or names can't inject nft syntax.
+"""
+
+import ipaddress
+
+FAMILY = "ip"
+TABLE = "insalan"
+
+def add_elements(name: str, elements: list) -> dict:
+    """
+    Adds elements to a set or map.
+
+    :param name: Name of the set or map.
+    :param elements: Set keys, or [key, value] pairs for a map.
+    :return: JSON command.
+    """
+    return {"add": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": elements}}}
+
+def delete_elements(name: str, elements: list) -> dict:
+    """
+    Deletes elements from a set or map.
+
+    :param name: Name of the set or map.
+    :param elements: Keys of the elements to delete.
+    :return: JSON command.
+    """
+    return {"delete": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": elements}}}
+
+def get_elements(name: str, elements: list) -> dict:
+    """
+    Gets elements of a set or map, with their value and counters, without listing the others.
+
+    :param name: Name of the set or map.
+    :param elements: Keys of the elements to get.
+    :return: JSON command.
+    """
+    return {"get": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": elements}}}
+
+def flush_set(name: str) -> dict:
+    """
+    Removes every element of a set or map.
+
+    :param name: Name of the set or map.
+    :return: JSON command.
+    """
+    return {"flush": {"set": {"family": FAMILY, "table": TABLE, "name": name}}}
+
+def list_set(name: str) -> dict:
+    """
+    Lists the content of a set.
+
+    :param name: Name of the set.
+    :return: JSON command.
+    """
+    return {"list": {"set": {"family": FAMILY, "table": TABLE, "name": name}}}
+
+def list_map(name: str) -> dict:
+    """
+    Lists the content of a map.
+
+    :param name: Name of the map.
+    :return: JSON command.
+    """
+    return {"list": {"map": {"family": FAMILY, "table": TABLE, "name": name}}}
+
+def list_counter(name: str) -> dict:
+    """
+    Lists a named counter.
+
+    :param name: Name of the counter.
+    :return: JSON command.
+    """
+    return {"list": {"counter": {"family": FAMILY, "table": TABLE, "name": name}}}
+
+def list_ruleset() -> dict:
+    """
+    Lists the whole ruleset.
+
+    :return: JSON command.
+    """
+    return {"list": {"ruleset": None}}
+
+def interval(value: str):
+    """
+    JSON expression of an IPv4 address, prefix or range, to be used as an element of an interval set.
+
+    :param value: Address ("10.0.0.1"), prefix ("10.0.0.0/8") or range ("10.0.0.1-10.0.0.9").
+    :return: JSON expression.
+    :raises ValueError: If the value is not a valid address, prefix or range.
+    """
+    if "-" in value:
+        start, end = (ipaddress.IPv4Address(bound.strip()) for bound in value.split("-", 1))
+        if start > end:
+            raise ValueError(f"Empty range {value}")
+        return {"range": [str(start), str(end)]}
+    
+    network = ipaddress.IPv4Network(value.strip(), strict=False)
+    if network.prefixlen == 32:
+        return str(network.network_address)
+    return {"prefix": {"addr": str(network.network_address), "len": network.prefixlen}}
+
+def interval_str(expr) -> str:
+    """
+    Text form of an element of an interval set, as listed by nftables.
+
+    :param expr: JSON expression of the element.
+    :return: Address, prefix or range.
+    """
+    if isinstance(expr, dict) and "elem" in expr:
+        expr = expr["elem"]["val"]
+    if isinstance(expr, dict) and "prefix" in expr:
+        return f"{expr['prefix']['addr']}/{expr['prefix']['len']}"
+    if isinstance(expr, dict) and "range" in expr:
+        return f"{expr['range'][0]}-{expr['range'][1]}"
+    return str(expr)
+
+def _element_key(element):
+    """
+    Key of a set or map element, as used in a command.
+    """
+    if isinstance(element, list):
+        element = element[0]
+    if isinstance(element, dict) and "elem" in element:
+        element = element["elem"]["val"]
+    return element
+
+def _is_plain_key(key) -> bool:
+    """
+    Whether a key stands for a single value, as opposed to a prefix or a range.
+    """
+    return isinstance(key, int) or (isinstance(key, str) and "/" not in key and "-" not in key)
+
+def merge_commands(cmds: list[dict]) -> list[dict]:
+    """
+    Merges element commands on the same set into as few commands as possible, without changing the result of the transaction.
+    A command is merged into the last command of the same kind on its set,
+    unless a command of another kind on that set touches one of its keys in between,
+    or the set itself is flushed, deleted or redefined in between.
+
+    :param cmds: JSON commands.
+    :return: Equivalent list of JSON commands.
+    """
+    merged = []
+    buckets = {} # (family, table, name) -> list of (op, elements, keys), keys being None if they can't be compared
+    for cmd in cmds:
+        op, obj = next(iter(cmd.items()))
+        if "element" not in obj:
+            # Elements can't be moved across a command on their whole set, or on the whole table
+            for kind in ["set", "map"]:
+                if kind in obj:
+                    buckets.pop((obj[kind].get("family"), obj[kind].get("table"), obj[kind].get("name")), None)
+            if "table" in obj or "ruleset" in obj:
+                buckets.clear()
+            merged.append(cmd)
+            continue
+
+        element = obj["element"]
+        keys = [_element_key(e) for e in element["elem"]]
+        # Prefixes, ranges and other expressions can overlap without being equal, only plain keys can be compared
+        keys = set(keys) if all(_is_plain_key(key) for key in keys) else None
+
+        target = buckets.setdefault((element["family"], element["table"], element["name"]), [])
+        for i in range(len(target) - 1, -1, -1):
+            bucket_op, elements, bucket_keys = target[i]
+            if bucket_op == op:
+                elements.extend(element["elem"])
+                target[i] = (op, elements, None if keys is None or bucket_keys is None else bucket_keys | keys)
+                break
+            if keys is None or bucket_keys is None or not keys.isdisjoint(bucket_keys):
+                i = -1
+                break
+        else:
+            i = -1
+
+        if i == -1:
+            elements = list(element["elem"])
+            target.append((op, elements, keys))
+            merged.append({op: {"element": dict(element, elem=elements)}})
+
+    return merged
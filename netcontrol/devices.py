@@ -1,15 +1,19 @@
+import asyncio
 import logging
 from .variables import Variables
 from .arp import Arp
+from .leases import Leases
 from .snmp import Snmp
+from .metrics import file_parse_duration
 from fastapi import HTTPException
 
 class Devices:
-    def __init__(self, logger: logging.Logger, variables: Variables, snmp: Snmp, arp: Arp):
+    def __init__(self, logger: logging.Logger, variables: Variables, snmp: Snmp, arp: Arp, leases: Leases):
         self.logger = logger
         self.variables = variables
         self.snmp = snmp
         self.arp = arp
+        self.leases = leases
         self.switches = {}
 
     async def get_device_info(self, mac: str):
@@ -21,11 +25,13 @@ class Devices:
         """
         
         try:
-            hostname = self.get_hostname(mac)
+            # The leases file may have to be parsed again, which must not block the event loop
+            hostname = await asyncio.to_thread(self.get_hostname, mac)
         except HTTPException:
             hostname = "not_found"
         
-        ip = self.arp.get_ip(mac)["ip"]
+        # get_ip never probes, but the ARP table may be read again for a missing MAC address, which must not block the event loop either
+        ip = (await asyncio.to_thread(self.arp.get_ip, mac))["ip"]
         vlan = self.get_vlan(ip)
         
         switches = self.get_all_switches()
@@ -56,17 +62,18 @@ class Devices:
         """
         
         if self.switches == {}:
-            with open("/hosts", "r") as file:
-                lines = file.readlines()
-            
-            for line in lines:
-                if line[0] != "#":
-                    if len(line.split()) > 1:
-                        ip = line.split()[0]
-                        name = line.split()[1]
-                        if len(ip.split(".")) == 4:
-                            if int(ip.split(".")[0]) == 172 and int(ip.split(".")[3]) > 20 and int(ip.split(".")[3]) < 200:
-                                self.switches[ip] = name.strip()
+            with file_parse_duration.labels("/hosts").time():
+                with open("/hosts", "r") as file:
+                    lines = file.readlines()
+                
+                for line in lines:
+                    if line[0] != "#":
+                        if len(line.split()) > 1:
+                            ip = line.split()[0]
+                            name = line.split()[1]
+                            if len(ip.split(".")) == 4:
+                                if int(ip.split(".")[0]) == 172 and int(ip.split(".")[3]) > 20 and int(ip.split(".")[3]) < 200:
+                                    self.switches[ip] = name.strip()
         
         return self.switches
     
@@ -78,13 +85,9 @@ class Devices:
         :return: Hostname of the device.
         """
         
-        with open("/dnsmasq.leases") as file:
-            lines = file.readlines()
-        
-        for line in lines:
-            parts = line.split()
-            if parts[1] == mac:
-                return parts[3]
+        hostname = self.leases.get_hostname(mac)
+        if hostname is not None:
+            return hostname
         
         self.logger.error(f"Could not find device {mac} in dnsmasq.leases")
         raise HTTPException(status_code=404, detail="Device not found")
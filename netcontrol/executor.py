@@ -0,0 +1,105 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+INTERVAL = 0.005 # seconds during which operations are gathered before being applied
+
+class NftExecutor:
+    """
+    Single writer of the nftables handle, which can't be used from several threads.
+    Request handlers queue their operations, and a worker thread applies them:
+    element commands queued within a few milliseconds of each other are merged into a single transaction.
+    """
+    def __init__(self, logger: logging.Logger, execute_batch: Callable[[list[tuple]], dict]):
+        """
+        :param logger: Logger.
+        :param execute_batch: Function applying groups of commands in a single transaction, and returning the error of each failed group by key.
+            Groups are passed as submitted, with their key made unique.
+        """
+        self.logger = logger
+        self.execute_batch = execute_batch
+        self.queue = queue.SimpleQueue()
+        self.worker = threading.Thread(target=self._run, name="nft-executor", daemon=True)
+        self.worker.start()
+
+    def submit(self, batch: list[tuple]) -> dict:
+        """
+        Queues groups of element commands and waits for them to be applied.
+
+        :param batch: List of (key, commands, ...) groups, the items after the commands being passed along to execute_batch.
+        :return: Error of each failed group, indexed by key.
+        """
+        future = Future()
+        self.queue.put((batch, future))
+        return future.result()
+
+    def call(self, function: Callable, *args):
+        """
+        Runs a function with exclusive access to the nftables handle, and waits for its result.
+
+        :param function: Function to run in the worker thread.
+        :return: Return value of the function.
+        """
+        future = Future()
+        self.queue.put(((function, args), future))
+        return future.result()
+
+    def _run(self):
+        """
+        Worker loop, draining the queue every few milliseconds.
+        """
+        while True:
+            items = [self.queue.get()]
+            time.sleep(INTERVAL)
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Consecutive element operations are applied together, calls are run on their own in queue order
+            pending = []
+            for item in items:
+                if isinstance(item[0], list):
+                    pending.append(item)
+                else:
+                    self._apply(pending)
+                    pending = []
+                    self._call(*item)
+            self._apply(pending)
+
+    def _apply(self, pending: list[tuple[list, Future]]):
+        """
+        Applies queued element operations in a single transaction.
+        """
+        if len(pending) == 0:
+            return
+
+        groups = [((i, key), *group) for i, (batch, _) in enumerate(pending) for key, *group in batch]
+        try:
+            failed = self.execute_batch(groups)
+        except Exception as ex:
+            for _, future in pending:
+                future.set_exception(ex)
+            return
+
+        results = [{} for _ in pending]
+        for (i, key), error in failed.items():
+            results[i][key] = error
+        for (_, future), result in zip(pending, results):
+            future.set_result(result)
+
+        self.logger.debug(f"Applied {len(groups)} operations from {len(pending)} requests in one transaction")
+
+    def _call(self, call: tuple[Callable, tuple], future: Future):
+        """
+        Runs a queued call.
+        """
+        function, args = call
+        try:
+            future.set_result(function(*args))
+        except Exception as ex:
+            future.set_exception(ex)
@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+from .metrics import file_parse_duration
+
+LEASES_FILE = "/dnsmasq.leases"
+
+class Leases:
+    """
+    DHCP leases of dnsmasq, indexed by MAC and by IP address.
+    The file is parsed again only when its modification time or size changes.
+    """
+    def __init__(self, logger: logging.Logger, path: str = LEASES_FILE):
+        self.logger = logger
+        self.path = path
+        # Version of the file parsed, (IP, hostname) of each MAC address and MAC address of each IP, replaced at once
+        self.state: tuple[tuple | None, dict[str, tuple[str, str]], dict[str, str]] = (None, {}, {})
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> tuple[dict[str, tuple[str, str]], dict[str, str]]:
+        """
+        Gets the indexes, parsing the file again if it changed.
+        The stat and the parse block, so this is run off the event loop by async callers.
+
+        :return: (IP, hostname) of each MAC address, and MAC address of each IP.
+        """
+        try:
+            stat = os.stat(self.path)
+            version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError as ex:
+            self.logger.error(f"Could not read {self.path}: {ex}")
+            version = None
+
+        current, by_mac, by_ip = self.state
+        if version is None or version == current:
+            return by_mac, by_ip
+
+        with self.lock:
+            # Another lookup may have parsed the file while this one was waiting for the lock
+            current, by_mac, by_ip = self.state
+            if version == current:
+                return by_mac, by_ip
+
+            by_mac, by_ip = self._parse()
+            self.state = (version, by_mac, by_ip)
+            return by_mac, by_ip
+
+    def _parse(self) -> tuple[dict[str, tuple[str, str]], dict[str, str]]:
+        """
+        Reads the leases file.
+
+        :return: (IP, hostname) of each MAC address, and MAC address of each IP.
+        """
+        by_mac = {}
+        by_ip = {}
+        with file_parse_duration.labels("/dnsmasq.leases").time():
+            with open(self.path) as file:
+                lines = file.readlines()
+
+            for line in lines:
+                # Expiry time, MAC address, IP address, hostname ("*" if unknown), client ID
+                parts = line.split()
+                if len(parts) < 4:
+                    continue
+                by_mac.setdefault(parts[1], (parts[2], parts[3]))
+                by_ip[parts[2]] = parts[1]
+        return by_mac, by_ip
+
+    def get_hostname(self, mac: str) -> str | None:
+        """
+        :param mac: MAC address of the device.
+        :return: Hostname of the device, None if it has no lease.
+        """
+        lease = self.snapshot()[0].get(mac)
+        return None if lease is None else lease[1]
+
+    def lookup_mac(self, ip: str) -> str | None:
+        """
+        :param ip: IP address of the device.
+        :return: MAC address of the device, None if no lease has this IP.
+        """
+        return self.snapshot()[1].get(ip)
@@ -1,15 +1,26 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
 from contextlib import asynccontextmanager
+import prometheus_client as prometheus
 import os
 import logging
+import time
 from .variables import Variables
 from .nft import Nft, MockedNft
-from .arp import Arp, MockedArp
+from .arp import Arp, NetlinkArp, MockedArp
+from .leases import Leases
 from .snmp import Snmp
 from .devices import Devices, MockedDevices
+from .metrics import DevicesCollector, request_duration, errors_counter
 
 mock = os.getenv("MOCK_NETWORK", "0") == "1"
 snmp_community = os.getenv("SNMP_COMMUNITY", "")
+arp_backend = os.getenv("ARP_BACKEND", "proc") # "proc" to read /proc/net/arp, "netlink" to follow the neighbour table
+arp_probe_timeout = float(os.getenv("ARP_PROBE_TIMEOUT", "1")) # seconds to wait for an IP missing from the ARP table, 0 to not probe it
 
 logger = logging.getLogger('uvicorn.error')
 # for some reason, default loggers are not working with FastAPI
@@ -23,12 +34,17 @@ if mock:
     devices = MockedDevices(logger)
 else:
     nft = Nft(logger, variables)
-    arp = Arp(logger)
-    devices = Devices(logger, variables, snmp, arp)
+    leases = Leases(logger)
+    # Only the IPs of the LAN and of the gate's subnets are probed
+    arp_class = NetlinkArp if arp_backend == "netlink" else Arp
+    arp = arp_class(logger, arp_probe_timeout, leases, variables.ip_range(), nft.addresses)
+    devices = Devices(logger, variables, snmp, arp, leases)
 
 logger.info("Checking that nftables is working...")
 nft.check_nftables()
 
+prometheus.REGISTRY.register(DevicesCollector(logger, nft))
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -41,10 +57,52 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    nft.remove_portail()
+    if variables.hitless_restart():
+        # Devices stay connected while netcontrol restarts, the next setup adopts the gate
+        logger.info("Hitless restart enabled, the gate nftables are left in place.")
+    else:
+        nft.remove_portail()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    """
+    Records the duration of every request by endpoint, and counts the exceptions left unhandled
+    """
+    start = time.perf_counter()
+    try:
+        return await call_next(request)
+    except Exception as ex:
+        # The nftables errors of a batch are counted by failed group, only the others get here
+        errors_counter.labels(type(ex).__name__).inc()
+        raise
+    finally:
+        route = request.scope.get("route")
+        request_duration.labels(route.name if route is not None else "unknown").observe(time.perf_counter() - start)
+
+# Registered for the Starlette class, so that the 404 and 405 of the routing are counted too
+@app.exception_handler(StarletteHTTPException)
+async def count_http_exception(request: Request, ex: StarletteHTTPException):
+    errors_counter.labels("HTTPException").inc()
+    return await http_exception_handler(request, ex)
+
+@app.exception_handler(RequestValidationError)
+async def count_validation_error(request: Request, ex: RequestValidationError):
+    errors_counter.labels("RequestValidationError").inc()
+    return await request_validation_exception_handler(request, ex)
+
+class Device(BaseModel):
+    mac: str
+    mark: int
+    bypass: bool = False
+    name: str = ""
+
+class MarkLimit(BaseModel):
+    mark: int
+    rate: int | None = None # kbytes/s for the whole mark
+    device_rate: int | None = None # kbytes/s for each device of the mark
+
 @app.get("/")
 def root():
     return "netcontrol is running"
@@ -57,9 +115,117 @@ def connect_user(mac: str, mark: int, bypass: bool, name: str) -> None:
 def delete_user(mac: str) -> None:
     nft.delete_user(mac)
 
+@app.post("/connect_users")
+def connect_users(devices: list[Device]) -> dict:
+    return nft.connect_users([(d.mac, d.mark, d.bypass, d.name) for d in devices])
+
+@app.delete("/disconnect_users")
+def delete_users(macs: list[str]) -> dict:
+    return nft.delete_users(macs)
+
 @app.put("/set_mark")
-def set_mark(mac: str, mark: int, bypass: bool) -> None:
-    nft.set_mark(mac, mark, bypass)
+def set_mark(mac: str, mark: int, bypass: bool, name: str = "previously_connected_device") -> None:
+    nft.set_mark(mac, mark, bypass, name)
+
+@app.put("/set_marks")
+def set_marks(devices: list[Device]) -> dict:
+    return nft.set_marks([(d.mac, d.mark, d.bypass, d.name) for d in devices])
+
+@app.get("/state")
+def get_state() -> dict:
+    return nft.get_state()
+
+@app.post("/apply_state")
+def apply_state(devices: list[Device], version: str | None = None) -> dict:
+    return nft.apply_state([(d.mac, d.mark, d.bypass, d.name) for d in devices], version)
+
+@app.post("/heartbeat")
+def heartbeat(devices: list[Device]) -> dict:
+    return nft.heartbeat([(d.mac, d.mark, d.bypass, d.name) for d in devices])
+
+@app.get("/get_mark")
+def get_mark(mac: str) -> dict:
+    return nft.get_device_mark(mac)
+
+@app.get("/mark_counts")
+def get_mark_counts() -> dict[int, int]:
+    return nft.get_mark_counts()
+
+@app.get("/flowtable")
+def get_flowtable() -> dict:
+    return { "devices": nft.flowtable_devices, "enabled": nft.flowtable_enabled }
+
+@app.put("/flowtable")
+def set_flowtable(enabled: bool) -> None:
+    nft.set_flowtable(enabled)
+
+@app.get("/shaping")
+def get_shaping() -> list[MarkLimit]:
+    return [MarkLimit(mark=mark, rate=rate, device_rate=device_rate) for mark, rate, device_rate in nft.shaping]
+
+@app.put("/shaping")
+def set_shaping(limits: list[MarkLimit]) -> None:
+    nft.set_shaping([(l.mark, l.rate, l.device_rate) for l in limits])
+
+class Priority(BaseModel):
+    marks: list[int] = []
+    devices: list[str] = []
+
+@app.get("/priority")
+def get_priority() -> Priority:
+    return Priority(**nft.priority)
+
+@app.put("/priority")
+def set_priority(priority: Priority) -> None:
+    nft.set_priority(priority.marks, priority.devices)
+
+@app.post("/add_priority_devices")
+def add_priority_devices(macs: list[str]) -> dict:
+    return nft.add_priority_devices(macs)
+
+@app.delete("/delete_priority_devices")
+def delete_priority_devices(macs: list[str]) -> dict:
+    return nft.delete_priority_devices(macs)
+
+@app.get("/bypass_destinations")
+def get_bypass_destinations() -> list[str]:
+    return nft.get_bypass_destinations()
+
+@app.put("/bypass_destinations")
+def set_bypass_destinations(destinations: list[str]) -> None:
+    nft.set_bypass_destinations(destinations)
+
+@app.post("/bypass_destinations")
+def add_bypass_destinations(destinations: list[str]) -> dict:
+    return nft.add_bypass_destinations(destinations)
+
+@app.delete("/bypass_destinations")
+def delete_bypass_destinations(destinations: list[str]) -> dict:
+    return nft.delete_bypass_destinations(destinations)
+
+@app.post("/bypass_destinations/reload")
+def reload_bypass_destinations() -> None:
+    nft.reload_bypass_destinations()
+
+@app.get("/portal")
+def get_portal_stats() -> dict:
+    return nft.get_portal_stats()
+
+@app.put("/portal")
+def set_portal_limit(rate: int, burst: int) -> None:
+    nft.set_portal_limit(rate, burst)
+
+@app.get("/addresses")
+def get_addresses() -> dict:
+    return nft.get_addresses()
+
+@app.post("/addresses/refresh")
+def refresh_addresses() -> None:
+    nft.refresh_addresses()
+
+@app.get("/metrics")
+def metrics() -> Response:
+    return Response(prometheus.generate_latest(), media_type=prometheus.CONTENT_TYPE_LATEST)
 
 @app.get("/get_mac")
 def get_mac(ip: str):
@@ -69,6 +235,19 @@ def get_mac(ip: str):
 def get_ip(mac: str):
     return arp.get_ip(mac)
 
+@app.post("/get_macs")
+def get_macs(ips: list[str]) -> dict:
+    return arp.get_macs(ips)
+
+@app.post("/get_ips")
+def get_ips(macs: list[str]) -> dict:
+    return arp.get_ips(macs)
+
 @app.get("/get_device_info")
 async def get_device_info(mac:str):
-    return await devices.get_device_info(mac)
+    info = await devices.get_device_info(mac)
+    return info | await run_in_threadpool(nft.get_device_counters, mac)
+
+@app.get("/top_devices")
+def top_devices(count: int = 10, interval: float = 60) -> dict:
+    return nft.get_top_devices(count, interval)
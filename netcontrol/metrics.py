@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+import prometheus_client as prometheus
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+if TYPE_CHECKING:
+    # The nft module records its own metrics, so it can't be imported from here at runtime
+    from .nft import Nft
+
+CACHE_DURATION = 5 # seconds during which a read of the map is reused by the following scrapes
+# Most operations take well under the default lowest bucket of 5 ms
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, float("inf"))
+
+request_duration = prometheus.Histogram("netcontrol_request_duration_seconds", "Duration of the requests handled by netcontrol", labelnames=["endpoint"], buckets=FAST_BUCKETS)
+nft_duration = prometheus.Histogram("netcontrol_nft_duration_seconds", "Duration of the commands run by libnftables", labelnames=["kind"], buckets=FAST_BUCKETS)
+snmp_duration = prometheus.Histogram("netcontrol_snmp_duration_seconds", "Duration of the SNMP queries to each switch", labelnames=["switch"])
+file_parse_duration = prometheus.Histogram("netcontrol_file_parse_duration_seconds", "Duration of the reads and parses of system files", labelnames=["file"], buckets=FAST_BUCKETS)
+errors_counter = prometheus.Counter("netcontrol_errors", "Errors raised by netcontrol, by type", labelnames=["type"])
+
+class DevicesCollector(Collector):
+    """
+    Exposes the number of connected devices of each mark and bypass state, read from the kernel map on scrape.
+    The read is cached for a few seconds, so that several scrapers don't each cause one.
+    """
+    def __init__(self, logger: logging.Logger, nft: "Nft"):
+        self.logger = logger
+        self.nft = nft
+        self.counts = {}
+        self.read_time = None
+        self.lock = threading.Lock()
+
+    def _counts(self) -> dict[tuple[int, bool], int] | None:
+        """
+        Gets the device counts, reading the map again if the cached ones are too old.
+
+        :return: Number of devices of each (mark, bypass), None if the map could not be read.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.read_time is None or now - self.read_time > CACHE_DURATION:
+                try:
+                    self.counts = self.nft.get_device_counts()
+                except Exception as ex:
+                    self.logger.error(f"Could not read the connected devices for the metrics: {ex}")
+                    return None
+                self.read_time = now
+            return self.counts
+
+    @staticmethod
+    def _gauge() -> GaugeMetricFamily:
+        return GaugeMetricFamily("netcontrol_connected_devices", "Devices connected in the nftables map", labels=["mark", "bypass"])
+
+    def describe(self):
+        # Registering a collector without describe makes the registry collect it, which would read nftables before the gate is set up
+        yield self._gauge()
+
+    def collect(self):
+        gauge = self._gauge()
+        counts = self._counts()
+        if counts is not None:
+            for (mark, bypass), count in sorted(counts.items()):
+                gauge.add_metric([str(mark), str(bypass).lower()], count)
+        yield gauge
@@ -0,0 +1,93 @@
+import threading
+from collections import Counter
+
+class DeviceMirror:
+    """
+    In-memory copy of the devices connected in the map, kept in sync with every write and rebuilt from every full read.
+    MAC addresses are stored as 48-bit integers, and the mark and bypass of each device are packed in a single integer,
+    so that looking a device up or counting the devices of a mark doesn't need an nftables read.
+    """
+    def __init__(self) -> None:
+        self.devices: dict[int, int] = {} # (mark << 1 | bypass), indexed by MAC address
+        self.marks = Counter() # number of devices of each mark
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(mac: str) -> int:
+        return int(mac.replace(":", ""), 16)
+
+    @staticmethod
+    def _mac(key: int) -> str:
+        return ":".join(f"{key:012x}"[i:i + 2] for i in range(0, 12, 2))
+
+    def get(self, mac: str) -> tuple[int, bool] | None:
+        """
+        Looks a device up
+
+        Args:
+            mac (str): lowercase MAC address
+
+        Returns:
+            tuple[int, bool] | None: mark and bypass of the device, None if it isn't connected
+        """
+        value = self.devices.get(self._key(mac))
+        if value is None:
+            return None
+        return value >> 1, bool(value & 1)
+
+    def update(self, mac: str, mark: int | None, bypass: bool = False) -> None:
+        """
+        Records the state of a device after a successful write
+
+        Args:
+            mac (str): lowercase MAC address
+            mark (int | None): mark of the device, None if it was disconnected
+            bypass (bool): whether the device has bypass on
+        """
+        key = self._key(mac)
+        with self.lock:
+            previous = self.devices.pop(key, None)
+            if previous is not None:
+                self.marks[previous >> 1] -= 1
+                if self.marks[previous >> 1] == 0:
+                    del self.marks[previous >> 1]
+            if mark is not None:
+                self.devices[key] = mark << 1 | bypass
+                self.marks[mark] += 1
+
+    def replace(self, devices: dict[str, dict]) -> list[str]:
+        """
+        Replaces the whole content with the result of a read
+
+        Args:
+            devices (dict[str, dict]): "mark" and "bypass" of each device, indexed by MAC address
+
+        Returns:
+            list[str]: MAC addresses which were in the mirror but not in the read, because they expired
+        """
+        content = {self._key(mac): device["mark"] << 1 | device["bypass"] for mac, device in devices.items()}
+        with self.lock:
+            removed = self.devices.keys() - content.keys()
+            self.devices = content
+            self.marks = Counter(value >> 1 for value in content.values())
+        return [self._mac(key) for key in removed]
+
+    def items(self) -> list[tuple[str, int, bool]]:
+        """
+        Returns:
+            list[tuple[str, int, bool]]: MAC address, mark and bypass of every connected device
+        """
+        with self.lock:
+            devices = list(self.devices.items())
+        return [(self._mac(key), value >> 1, bool(value & 1)) for key, value in devices]
+
+    def counts(self) -> dict[int, int]:
+        """
+        Returns:
+            dict[int, int]: number of connected devices of each mark
+        """
+        with self.lock:
+            return dict(self.marks)
+
+    def __len__(self) -> int:
+        return len(self.devices)
@@ -0,0 +1,291 @@
+import errno
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Iterator
+
+# Message types and flags, from linux/netlink.h, linux/rtnetlink.h and linux/netfilter/nfnetlink_conntrack.h
+NETLINK_ROUTE = 0
+NETLINK_NETFILTER = 12
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+RTM_GETADDR = 22
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_IFADDR = 0x10
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+NDA_DST = 1
+NDA_LLADDR = 2
+# Neighbour states whose link layer address is known, from linux/neighbour.h
+NUD_VALID = 0x02 | 0x04 | 0x08 | 0x10 | 0x40 | 0x80
+IPCTNL_MSG_CT_GET = 1 << 8 | 1 # conntrack subsystem, get message
+IPCTNL_MSG_CT_DELETE = 1 << 8 | 2 # conntrack subsystem, delete message
+CTA_TUPLE_ORIG = 1
+CTA_TUPLE_IP = 1
+CTA_IP_V4_SRC = 1
+
+NLMSGHDR = struct.Struct("=IHHII") # length, type, flags, sequence number, port id
+RTATTR = struct.Struct("=HH") # length, type
+IFADDRMSG = struct.Struct("=BBBBI") # family, prefix length, flags, scope, interface index
+NDMSG = struct.Struct("=BBHiHBB") # family, padding, padding, interface index, state, flags, type
+NFGENMSG = struct.Struct("=BBH") # family, version, resource id
+
+BUFFER_SIZE = 65536
+DEBOUNCE = 1 # seconds during which interface changes are gathered before being notified
+WATCH_RETRY_DELAY = 1 # seconds between two attempts to reopen the address notifications
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+def open_socket(groups: int = 0, protocol: int = NETLINK_ROUTE) -> socket.socket:
+    """
+    Opens a netlink socket.
+
+    :param groups: Multicast groups to subscribe to, 0 to only send requests.
+    :param protocol: NETLINK_ROUTE, or NETLINK_NETFILTER for conntrack.
+    :return: Bound socket.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+    sock.bind((0, groups))
+    return sock
+
+def parse_messages(data: bytes) -> Iterator[tuple[int, bytes]]:
+    """
+    Splits a buffer received from netlink into messages.
+
+    :param data: Received buffer.
+    :return: (type, payload) of each message.
+    """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield msg_type, data[offset + NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+def parse_attributes(data: bytes) -> dict[int, bytes]:
+    """
+    Parses the attributes following the fixed part of a message.
+
+    :param data: Attributes.
+    :return: Value of each attribute, indexed by type.
+    """
+    attributes = {}
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[attr_type & NLA_TYPE_MASK] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attributes
+
+def dump(msg_type: int, payload: bytes, protocol: int = NETLINK_ROUTE) -> list[tuple[int, bytes]]:
+    """
+    Sends a dump request, and reads every message of the answer.
+
+    :param msg_type: Request type, such as RTM_GETADDR.
+    :param payload: Fixed part of the request.
+    :param protocol: Netlink protocol of the request.
+    :return: (type, payload) of each message of the answer.
+    """
+    messages = []
+    with open_socket(protocol=protocol) as sock:
+        sock.sendall(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + payload)
+        while True:
+            for reply_type, body in parse_messages(sock.recv(BUFFER_SIZE)):
+                if reply_type == NLMSG_DONE:
+                    return messages
+                if reply_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", body)[0]
+                    if error != 0:
+                        raise OSError(error, os.strerror(error))
+                    continue
+                messages.append((reply_type, body))
+
+def get_addresses() -> list[tuple[str, str, int]]:
+    """
+    Lists the IPv4 addresses of the host's interfaces.
+
+    :return: (interface label, address, prefix length) of each address.
+    """
+    addresses = []
+    for _, body in dump(RTM_GETADDR, IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)):
+        _, prefixlen, _, _, _ = IFADDRMSG.unpack_from(body)
+        attributes = parse_attributes(body[IFADDRMSG.size:])
+        address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+        if address is None:
+            continue
+        label = attributes.get(IFA_LABEL, b"").split(b"\0", 1)[0].decode()
+        addresses.append((label, str(ipaddress.IPv4Address(address)), prefixlen))
+    return addresses
+
+def parse_neighbour(msg_type: int, body: bytes) -> tuple[str, str | None] | None:
+    """
+    Parses an IPv4 neighbour message, from a dump or a notification.
+
+    :param msg_type: Message type, RTM_NEWNEIGH or RTM_DELNEIGH.
+    :param body: Message payload.
+    :return: IP address and MAC address of the neighbour, with a None MAC address if it is gone or not resolved,
+        or None if the message is not about an IPv4 neighbour.
+    """
+    if msg_type not in (RTM_NEWNEIGH, RTM_DELNEIGH) or len(body) < NDMSG.size:
+        return None
+    family, _, _, _, state, _, _ = NDMSG.unpack_from(body)
+    attributes = parse_attributes(body[NDMSG.size:])
+    if family != socket.AF_INET or NDA_DST not in attributes:
+        return None
+    
+    ip = str(ipaddress.IPv4Address(attributes[NDA_DST]))
+    lladdr = attributes.get(NDA_LLADDR)
+    if msg_type == RTM_DELNEIGH or not state & NUD_VALID or lladdr is None or len(lladdr) != 6 or not any(lladdr):
+        return ip, None
+    return ip, ":".join(f"{byte:02x}" for byte in lladdr)
+
+def get_neighbours() -> list[tuple[str, str | None]]:
+    """
+    Lists the IPv4 neighbour table.
+
+    :return: IP address and MAC address of each neighbour, with a None MAC address if it is not resolved.
+    """
+    neighbours = []
+    for msg_type, body in dump(RTM_GETNEIGH, NDMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0)):
+        neighbour = parse_neighbour(msg_type, body)
+        if neighbour is not None:
+            neighbours.append(neighbour)
+    return neighbours
+
+def delete_connections(ips: set[str]) -> int:
+    """
+    Deletes the conntrack entries of the connections opened by the given addresses.
+    This also removes them from the flowtable, so that their packets go through the ruleset again.
+
+    :param ips: IPv4 addresses, matched against the original source of each connection.
+    :return: Number of connections deleted.
+    """
+    header = NFGENMSG.pack(socket.AF_INET, 0, 0)
+    deleted = 0
+    with open_socket(protocol=NETLINK_NETFILTER) as sock:
+        for _, body in dump(IPCTNL_MSG_CT_GET, header, NETLINK_NETFILTER):
+            tuple_orig = parse_attributes(body[NFGENMSG.size:]).get(CTA_TUPLE_ORIG)
+            if tuple_orig is None:
+                continue
+            source = parse_attributes(parse_attributes(tuple_orig).get(CTA_TUPLE_IP, b"")).get(CTA_IP_V4_SRC)
+            if source is None or str(ipaddress.IPv4Address(source)) not in ips:
+                continue
+            
+            # The connection is designated by its original tuple, sent back as it was dumped
+            attribute = RTATTR.pack(RTATTR.size + len(tuple_orig), CTA_TUPLE_ORIG | NLA_F_NESTED) + tuple_orig
+            attribute += b"\0" * (_align(len(attribute)) - len(attribute))
+            payload = header + attribute
+            sock.sendall(NLMSGHDR.pack(NLMSGHDR.size + len(payload), IPCTNL_MSG_CT_DELETE, NLM_F_REQUEST | NLM_F_ACK, 1, 0) + payload)
+            for reply_type, reply in parse_messages(sock.recv(BUFFER_SIZE)):
+                if reply_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", reply)[0]
+                    if error == 0:
+                        deleted += 1
+                    elif error != errno.ENOENT:
+                        # The connection may have ended since the dump, anything else is an actual error
+                        raise OSError(error, os.strerror(error))
+    return deleted
+
+class Addresses:
+    """
+    IPv4 addresses of the host's interfaces, read from rtnetlink and cached until they change
+    """
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.addresses = None
+        self.lock = threading.Lock()
+
+    def get(self) -> list[tuple[str, str, int]]:
+        """
+        Gets the cached addresses, reading them on first use.
+
+        :return: (interface label, address, prefix length) of each address.
+        """
+        with self.lock:
+            if self.addresses is None:
+                self.addresses = get_addresses()
+            return self.addresses
+
+    def refresh(self) -> bool:
+        """
+        Reads the addresses again.
+
+        :return: Whether they changed.
+        """
+        addresses = get_addresses()
+        with self.lock:
+            changed = addresses != self.addresses
+            self.addresses = addresses
+        return changed
+
+    def watch(self, callback: Callable[[], None]) -> None:
+        """
+        Starts a thread refreshing the addresses when the kernel notifies a change, and calling back when they changed.
+
+        :param callback: Function called after a change, from the watching thread.
+        """
+        sock = open_socket(RTMGRP_IPV4_IFADDR)
+        threading.Thread(target=self._watch, args=(sock, callback), name="netlink-addresses", daemon=True).start()
+
+    def _watch(self, sock: socket.socket, callback: Callable[[], None]) -> None:
+        """
+        Watching loop, see watch.
+        """
+        while True:
+            try:
+                # Only address changes are received, their content doesn't matter as every address is read again
+                sock.settimeout(None)
+                sock.recv(BUFFER_SIZE)
+                # Interfaces coming up often get several changes at once
+                sock.settimeout(DEBOUNCE)
+                try:
+                    while True:
+                        sock.recv(BUFFER_SIZE)
+                except socket.timeout:
+                    pass
+            except OSError as ex:
+                # Either way, the addresses are read again below to catch up with the missed changes
+                if ex.errno == errno.ENOBUFS:
+                    # Notifications were dropped because they came faster than they were read
+                    self.logger.warning("Address notifications lost, reading the interface addresses again")
+                else:
+                    self.logger.error(f"Address notifications failed, reopening them: {ex}")
+                    sock = self._reopen(sock)
+
+            try:
+                if self.refresh():
+                    callback()
+            except Exception as ex:
+                self.logger.error(f"Could not refresh the interface addresses: {ex}")
+
+    def _reopen(self, sock: socket.socket) -> socket.socket:
+        """
+        Opens the address notifications again after their socket failed, until it succeeds.
+
+        :param sock: Failed socket, closed.
+        :return: New socket.
+        """
+        sock.close()
+        while True:
+            try:
+                return open_socket(RTMGRP_IPV4_IFADDR)
+            except OSError as ex:
+                self.logger.error(f"Could not reopen the address notifications, retrying in {WATCH_RETRY_DELAY}s: {ex}")
+                time.sleep(WATCH_RETRY_DELAY)
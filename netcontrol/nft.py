@@ -1,10 +1,27 @@
 import nftables
+import hashlib
 import json
 import logging
-import subprocess
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Hashable
 from .variables import Variables
+from . import commands
+from .executor import NftExecutor
+from .mirror import DeviceMirror
+from . import netlink
+from .netlink import Addresses
+from .metrics import nft_duration, errors_counter
 from fastapi import HTTPException
 
+MAC_REGEX = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$")
+# Kinds of objects of the gate, in an order in which they can be deleted
+OBJECT_KINDS = ["chain", "flowtable", "set", "map", "counter"]
+COUNTER_HISTORY = 600 # seconds during which counter snapshots are kept
+COUNTER_SNAPSHOT_MIN_AGE = 10 # seconds before a new counter snapshot is kept, if one was just taken
+
 class Nft:
     """
     Class which interacts with the nftables backend
@@ -14,92 +31,981 @@ class Nft:
         self.variables = variables
         self.nft = nftables.Nftables()
         self.nft.set_json_output(True)
+        self.executor = NftExecutor(logger, self._apply_groups)
+        self.mirror = DeviceMirror()
+        self.addresses = Addresses(logger)
+        self.flowtable_devices = variables.flowtable()["devices"]
+        self.flowtable_enabled = variables.flowtable()["enabled"] and len(self.flowtable_devices) > 0
+        self.session_timeout = variables.session_timeout()
+        self.shaping = [] # (mark, rate, device rate) limits currently applied
+        self.portal_limit = variables.portal_limit()
+        self.game_priority = variables.game_priority()
+        self.priority = {"marks": [], "devices": []} # marks and MAC addresses currently prioritized
+        self.priority_lock = threading.Lock()
+        self.bypass_mark = variables.bypass_mark()
+        self.bypass_destinations_file = variables.bypass_destinations_file()
+        self.counter_snapshots = deque() # (time, (packets, bytes) of each MAC address) pairs, oldest first
+        self.counter_lock = threading.Lock()
 
     def check_nftables(self) -> None:
-        data = self._execute_nft_cmd("list ruleset")
+        data = self.executor.call(self._execute_json_cmd, [commands.list_ruleset()], True)
         metainfo = data[0]["metainfo"]
         self.logger.info(f"Found running nftables version {metainfo['version']} with {len(data)} ruleset entries.")
     
-    def _execute_nft_cmd(self, cmd: str) -> dict:
+    def _execute_nft_cmd(self, cmd: str) -> None:
         """
-        Executes an nft command, handles the exception properly and returns an object
+        Executes an nft script and handles the exception properly.
+        Only used for scripts rendered from the configuration, device data goes through _execute_json_cmd.
+        Must be run by the executor.
 
         Args:
-            cmd (str): string representation of the command
+            cmd (str): string representation of the commands
+
+        Raises:
+            NftablesException: if the command returned an exception
+        """
+        with nft_duration.labels("script").time():
+            rc, output, error = self.nft.cmd(cmd)
+        if rc != 0 or (error is not None and error != ""):
+            raise NftablesException(rc, error)
+
+    def _execute_json_cmd(self, cmds: list[dict], read: bool = False) -> list:
+        """
+        Executes JSON commands in a single transaction, handles the exception properly and returns an object.
+        Must be run by the executor.
+
+        Args:
+            cmds (list[dict]): JSON commands, built with the commands module
+            read (bool): whether the output is needed. Write commands don't return anything, so their output isn't parsed.
 
         Raises:
             NftablesException: if the command returned an exception
 
         Returns:
-            dict: parsed JSON output
+            list: parsed JSON output if read is set, an empty list otherwise
         """
         output: str
-        rc, output, error = self.nft.cmd(cmd)
+        with nft_duration.labels("json").time():
+            rc, output, error = self.nft.cmd(json.dumps({"nftables": commands.merge_commands(cmds)}))
         if rc != 0 or (error is not None and error != ""):
             raise NftablesException(rc, error)
-        if output == "":
-            return {}
+        if not read or output == "":
+            return []
         else:
             return json.loads(output)["nftables"]
 
+    def _execute_nft_batch(self, batch: list[tuple[Hashable, list[dict]]]) -> dict[Hashable, str]:
+        """
+        Executes groups of JSON commands in a single transaction.
+        If the transaction fails, it is split in halves until the failing groups are isolated,
+        so that every valid group still gets applied.
+        Must be run by the executor.
+
+        Args:
+            batch (list[tuple[Hashable, list[dict]]]): list of (key, commands) groups
+
+        Returns:
+            dict[Hashable, str]: error message of each failed group, indexed by key
+        """
+        if len(batch) == 0:
+            return {}
+        
+        try:
+            self._execute_json_cmd([cmd for _, cmds in batch for cmd in cmds])
+            return {}
+        except NftablesException as ex:
+            if len(batch) == 1:
+                # Counted once the failing group is isolated, not on every attempt of the bisection
+                errors_counter.labels("NftablesException").inc()
+                return {batch[0][0]: str(ex.args[-1]).strip()}
+        
+        middle = len(batch) // 2
+        return self._execute_nft_batch(batch[:middle]) | self._execute_nft_batch(batch[middle:])
+
+    def _apply_groups(self, batch: list[tuple[Hashable, list[dict], tuple | None]]) -> dict[Hashable, str]:
+        """
+        Executes groups of JSON commands like _execute_nft_batch, then records the devices of the successful groups in the mirror.
+        Run by the executor on every batch of queued operations, so that the mirror follows the order of the transactions.
+
+        Args:
+            batch (list[tuple[Hashable, list[dict], tuple | None]]): list of (key, commands, device) groups,
+                device being the (MAC address, mark, bypass) the group leads to, with a None mark for a disconnection,
+                or None if the group doesn't change a device
+
+        Returns:
+            dict[Hashable, str]: error message of each failed group, indexed by key
+        """
+        failed = self._execute_nft_batch([(key, cmds) for key, cmds, _ in batch])
+        dropped = []
+        for key, _, device in batch:
+            if device is None or key in failed:
+                continue
+            previous = self.mirror.get(device[0])
+            if previous is not None and (device[1] is None or (device[1], device[2]) != previous):
+                dropped.append(device[0])
+            self.mirror.update(*device)
+        self._drop_connections(dropped)
+        return failed
+
+    def _drop_connections(self, macs: list[str]) -> None:
+        """
+        Deletes the connections of devices which were disconnected or whose traffic is handled differently, if authenticated traffic is offloaded.
+        Offloaded packets skip every chain, so their connections would otherwise stay open, on their old path, as long as they carry traffic.
+        The connection table is read in a separate thread, so that the executor is not blocked.
+        
+        Args:
+            macs (list[str]): MAC addresses of the devices
+        """
+        if not self.flowtable_enabled or len(macs) == 0:
+            return
+        threading.Thread(target=self._delete_connections, args=(set(macs),), name="nft-connections", daemon=True).start()
+
+    def _delete_connections(self, macs: set[str]) -> None:
+        """
+        Deletes the connections opened by the current addresses of the given devices, see _drop_connections
+        
+        Args:
+            macs (set[str]): MAC addresses of the devices
+        """
+        try:
+            ips = {ip for ip, mac in netlink.get_neighbours() if mac in macs}
+            deleted = netlink.delete_connections(ips) if len(ips) > 0 else 0
+        except OSError as ex:
+            self.logger.error(f"Could not delete the connections of {len(macs)} devices: {ex}")
+            return
+        self.logger.info(f"Deleted {deleted} connections of {len(macs)} devices")
+
     def setup_portail(self) -> None:
         """
-        Sets up the necessary nftables rules that block network access to unauthenticated devices, and marks packets based on the map
+        Sets up the necessary nftables rules that block network access to unauthenticated devices, and marks packets based on the map.
+        The whole ruleset is loaded in a single transaction, so the gate is either fully set up or not at all.
+        A gate left in place by a previous run is adopted: its chains are rewritten, but its sets keep their elements,
+        and the limits set at runtime are kept.
         """
         
-        # Set up table, set and map
-        self._execute_nft_cmd("add table ip insalan")
-        self._execute_nft_cmd("add set insalan netcontrol-auth { type ether_addr; comment \"Lists authenticated MAC addresses.\"; }")
-        self._execute_nft_cmd("add map insalan netcontrol-mac2mark { type ether_addr : mark; comment \"Maps devices to marks.\"; }")
+        try:
+            ruleset = self.executor.call(self._execute_json_cmd, [commands.list_ruleset()], True)
+            self._adopt_limits(ruleset)
+            changed, obsolete = self._render_reconciliation(ruleset)
+            self.executor.call(self._execute_nft_cmd, self._render_portail(changed) + self._render_addresses() + obsolete)
+        except NftablesException as ex:
+            self.logger.error(f"Could not set up the gate nftables: {ex}")
+            raise
         
-        # Marks packets from authenticated users using the map
-        self._execute_nft_cmd("add chain insalan netcontrol-filter { type filter hook prerouting priority -2; comment \"Forbids outbound packets from unauthenticated devices.\"; }")
-        self._execute_nft_cmd("add rule insalan netcontrol-filter ip daddr != 172.16.1.0/24 ether saddr @netcontrol-auth meta mark set ether saddr map @netcontrol-mac2mark")
+        self.logger.info("Gate nftables set up.")
+        
+        # Rebuilds the mirror from the devices adopted from a previous run
+        self.executor.call(self._read_devices, True)
+        self.logger.info(f"{len(self.mirror)} devices connected.")
+        
+        self.addresses.watch(self._update_addresses)
+        
+        if self.bypass_destinations_file is not None:
+            try:
+                self.reload_bypass_destinations()
+            except HTTPException as ex:
+                self.logger.error(f"Could not load the bypass destinations: {ex.detail}")
+
+    def _render_portail(self, changed: str = "") -> str:
+        """
+        Renders the gate ruleset as a single nft script.
+        Chains are flushed before their rules are added, so the script can be loaded over an existing gate.
+        The addresses of the host are kept in sets, filled by _render_addresses.
+
+        Args:
+            changed (str): script deleting existing sets whose definition changed, once no rule uses them
 
-        # Let traffic with "bypass" pass through if no external rules have been added
-        self._execute_nft_cmd("add chain insalan netcontrol-debypass { type filter hook prerouting priority 0; comment \"Removes the bypass mark for packets that are not bounds to blacklisted services.\"; }")
-        self._execute_nft_cmd("add rule insalan netcontrol-debypass meta mark > 1024 meta mark set meta mark & 0xFFFFFBFF")
+        Returns:
+            str: nft script
+        """
+        # Elements added to the sets then expire unless they are refreshed by a heartbeat
+        timeout = "" if self.session_timeout is None else f"""
+        flags timeout
+        timeout {self.session_timeout}s"""
         
+        return f"""
+add table ip insalan
+add chain insalan netcontrol-filter {{ type filter hook prerouting priority -2; comment "Forbids outbound packets from unauthenticated devices."; }}
+add chain insalan netcontrol-nat {{ type nat hook prerouting priority 0; comment "Redirects HTTP traffic to the gate for unauthenticated devices."; }}
+add chain insalan netcontrol-forward {{ type filter hook forward priority 0; comment "Blocks access to langate-netcontrol from the outside world."; }}
+add chain insalan netcontrol-shaping {{ type filter hook forward priority 5; comment "Limits the bandwidth of marks and of their devices, rewritten at runtime."; }}
+add chain insalan netcontrol-priority {{ type filter hook forward priority -5; comment "Sets the DSCP class or priority of game traffic, for the uplink to favour it."; }}
+add chain insalan netcontrol-bypass-route {{ type filter hook prerouting priority -1; comment "Routes the traffic of devices with bypass to the bypass destinations differently."; }}
+flush chain insalan netcontrol-filter
+flush chain insalan netcontrol-nat
+flush chain insalan netcontrol-forward
+flush chain insalan netcontrol-priority
+flush chain insalan netcontrol-bypass-route
+{changed}
+table ip insalan {{
+    set netcontrol-auth {{
+        type ether_addr{timeout}
+        comment "Lists authenticated MAC addresses, only looked up for traffic to the local network."
+    }}
+
+    set netcontrol-bypass {{
+        type ether_addr{timeout}
+        comment "Lists devices allowed to bypass the blacklist, to be matched by the blacklisted services rules."
+    }}
+
+    set netcontrol-bypass-dst {{
+        type ipv4_addr
+        flags interval
+        auto-merge
+        comment "Lists the destination prefixes reached with the bypass mark by devices with bypass."
+    }}
+
+    set netcontrol-api-addrs {{
+        type ipv4_addr
+        comment "Lists the addresses netcontrol listens on, updated when the interfaces change."
+    }}
+
+    set netcontrol-local-addrs {{
+        type ipv4_addr
+        flags interval
+        auto-merge
+        comment "Lists the addresses of the network head and the docker subnet, allowed to reach netcontrol."
+    }}
+
+    set netcontrol-docker-subnet {{
+        type ipv4_addr
+        flags interval
+        comment "Contains the docker subnet of netcontrol and the backend."
+    }}
+
+    set netcontrol-shaped {{
+        type mark
+        comment "Lists the marks whose bandwidth is limited, their traffic is not offloaded to the flowtable."
+    }}
+
+    set netcontrol-priority-marks {{
+        type mark
+        comment "Lists the marks of games, whose traffic is prioritized."
+    }}
+
+    set netcontrol-priority-devices {{
+        type ether_addr
+        comment "Lists the devices of players, whose traffic is prioritized."
+    }}
+
+    set netcontrol-portal-meter {{
+        type ether_addr
+        flags dynamic, timeout
+        timeout 1m
+        comment "Rate of new HTTP connections of each unauthenticated device redirected to the gate."
+    }}
+
+    counter netcontrol-portal-redirected {{
+        comment "HTTP connections of unauthenticated devices redirected to the gate."
+    }}
+
+    counter netcontrol-portal-dropped {{
+        comment "HTTP connections of unauthenticated devices dropped by the rate limit."
+    }}
+
+    map netcontrol-mac2mark {{
+        type ether_addr : mark{timeout}
+        counter
+        comment "Maps devices to marks, and counts the packets they send."
+    }}
+
+    chain netcontrol-filter {{
+        # Marks packets from authenticated users using the map.
+        # The lookup fails for unauthenticated devices, whose packets keep mark 0: later chains test the mark instead of looking up the MAC again.
+        ip daddr != 172.16.1.0/24 meta mark set ether saddr map @netcontrol-mac2mark
         # Block external requests to the netcontrol module
-        ips = subprocess.run('ip addr | grep -o "[0-9]*\\.[0-9]*\\.[0-9]*\\.[0-9]*/[0-9]*" | grep -o "[0-9]*\\.[0-9]*\\.[0-9]*\\.[0-9]*"', shell=True, capture_output=True).stdout.decode("utf-8").split("\n")[:-1]
-        docker0_ip = subprocess.run("ip addr show docker0 | awk '/inet / {print $2}' | cut -d'/' -f1", shell=True, capture_output=True).stdout.decode("utf-8").strip()
-        docker_subnet = ".".join(docker0_ip.split(".")[:2]) + ".0.0/16"
-        self._execute_nft_cmd(f"add rule insalan netcontrol-filter ip daddr {{ {docker0_ip},172.16.1.1 }} tcp dport 6784 ip saddr != {{ {','.join(ips)}, {docker_subnet} }} drop")
+        ip daddr @netcontrol-api-addrs tcp dport 6784 ip saddr != @netcontrol-local-addrs drop
+    }}
+
+    chain netcontrol-forward {{
+        # Block other traffic from users that are not authenticated.
+        # Packets to the local network are not marked, so only them need the set lookup.
+        ip daddr != 172.16.1.0/24 ip daddr != @netcontrol-docker-subnet ip saddr {self.variables.ip_range()} ip saddr != 172.16.1.1 ip saddr != @netcontrol-docker-subnet meta mark 0 reject
+        ip daddr 172.16.1.0/24 ip daddr != 172.16.1.1 ip saddr {self.variables.ip_range()} ip saddr != 172.16.1.1 ip saddr != @netcontrol-docker-subnet ether saddr != @netcontrol-auth reject
+    }}
+
+    chain netcontrol-bypass-route {{
+        # Runs after netcontrol-filter, and overrides the mark of the device for the bypass destinations only
+        # Devices missing from the map keep mark 0: a bypass element outliving the map element must not let them through the forward gate
+        meta mark != 0 ether saddr @netcontrol-bypass ip daddr @netcontrol-bypass-dst meta mark set {self.bypass_mark}
+    }}
+
+    chain netcontrol-priority {{
+        # Only packets sent by devices are marked, towards the uplink{self._render_priority()}
+    }}
+}}
+""" + self._render_nat(self.portal_limit) + self._render_shaping([], self.shaping) + self._render_flowtable()
+
+    def _protected_addresses(self) -> dict[str, list[str]]:
+        """
+        Computes the content of the address sets from the cached addresses of the host
+        
+        Returns:
+            dict[str, list[str]]: elements of each address set, indexed by name
+        """
+        addresses = self.addresses.get()
+        docker0 = [address for label, address, _ in addresses if label == "docker0"]
+        docker_subnets = [".".join(address.split(".")[:2]) + ".0.0/16" for address in docker0[:1]]
+        if len(docker0) == 0:
+            self.logger.warning("No address found on docker0, netcontrol is only reachable on 172.16.1.1.")
+        
+        return {
+            "netcontrol-api-addrs": list(dict.fromkeys(docker0[:1] + ["172.16.1.1"])),
+            "netcontrol-local-addrs": sorted({address for _, address, _ in addresses}) + docker_subnets,
+            "netcontrol-docker-subnet": docker_subnets,
+        }
+
+    def _render_addresses(self) -> str:
+        """
+        Renders the content of the address sets, replacing their previous content
+        
+        Returns:
+            str: nft script
+        """
+        script = ""
+        for name, elements in self._protected_addresses().items():
+            script += f"flush set insalan {name}\n"
+            if len(elements) > 0:
+                script += f"add element insalan {name} {{ {', '.join(elements)} }}\n"
+        return script
+
+    def _update_addresses(self) -> None:
+        """
+        Rewrites the address sets after the addresses of the host changed, without touching the rest of the gate.
+        Called by the address watcher, or by refresh_addresses.
+        """
+        self.executor.call(self._execute_nft_cmd, self._render_addresses())
+        self.logger.info(f"Addresses of the host updated: {', '.join(address for _, address, _ in self.addresses.get())}")
+
+    def get_addresses(self) -> dict[str, list[str]]:
+        """
+        Lists the cached addresses of the host, and the content of the address sets computed from them
+        """
+        return {
+            "addresses": [f"{address}/{prefixlen} ({label})" for label, address, prefixlen in self.addresses.get()],
+        } | self._protected_addresses()
+
+    def refresh_addresses(self) -> None:
+        """
+        Reads the addresses of the host again, and updates the address sets if they changed
+        """
+        if not self.addresses.refresh():
+            return
+        
+        try:
+            self._update_addresses()
+        except NftablesException as ex:
+            self.logger.error(f"Could not update the addresses of the host: {ex}")
+            raise HTTPException(status_code=500, detail="Could not update the addresses of the host")
+
+    def _render_flowtable(self) -> str:
+        """
+        Renders the flowtable and the chain offloading authenticated traffic to it, if a flowtable is configured.
+        Offloaded packets skip every chain, so the offload rule comes last in the forward hook.
+
+        Returns:
+            str: nft script
+        """
+        if len(self.flowtable_devices) == 0:
+            return ""
+        
+        return f"""
+add chain insalan netcontrol-offload {{ type filter hook forward priority 10; comment "Offloads established connections of authenticated devices to the flowtable."; }}
+
+table ip insalan {{
+    flowtable netcontrol-ft {{
+        hook ingress priority 0
+        devices = {{ {", ".join(self.flowtable_devices)} }}
+    }}
+}}
+""" + self._render_offload(self.flowtable_enabled)
+
+    def _render_offload(self, enabled: bool) -> str:
+        """
+        Renders the content of the offload chain.
+
+        Args:
+            enabled (bool): whether authenticated traffic is offloaded to the flowtable
+
+        Returns:
+            str: nft script
+        """
+        script = "flush chain insalan netcontrol-offload\n"
+        if enabled:
+            # Packets from unauthenticated devices and to the local network are not marked
+            # Offloaded packets would skip the shaping and priority chains
+            script += "add rule insalan netcontrol-offload meta mark != 0 meta mark != @netcontrol-shaped meta mark != @netcontrol-priority-marks ether saddr != @netcontrol-priority-devices ip protocol { tcp, udp } counter flow add @netcontrol-ft\n"
+        return script
+
+    def set_flowtable(self, enabled: bool) -> None:
+        """
+        Enables or disables the offload of authenticated traffic to the flowtable, without touching the rest of the gate.
+        Allows comparing throughput with and without the fast path.
+        Connections already offloaded stay in the flowtable until they time out.
+        While offload is enabled, the connections of devices which are disconnected, expire, change mark or bypass,
+        or whose priority or bypass destinations change, are deleted.
+
+        Args:
+            enabled (bool): whether authenticated traffic is offloaded to the flowtable
+        """
+        if len(self.flowtable_devices) == 0:
+            raise HTTPException(status_code=409, detail="No flowtable configured")
+        
+        try:
+            self.executor.call(self._execute_nft_cmd, self._render_offload(enabled))
+        except NftablesException as ex:
+            self.logger.error(f"Could not change the flowtable offload: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
         
+        self.flowtable_enabled = enabled
+        self.logger.info(f"Flowtable offload {'enabled' if enabled else 'disabled'}.")
+        
+    def _render_priority(self) -> str:
+        """
+        Renders the rules of the priority chain, which mark packets from prioritized marks and devices as configured.
+
+        Returns:
+            str: rules, empty if neither a DSCP class nor a priority is configured
+        """
+        statements = []
+        if self.game_priority["dscp"] is not None:
+            statements.append(f"ip dscp set {self.game_priority['dscp']}")
+        if self.game_priority["meta_priority"] is not None:
+            statements.append(f"meta priority set {self.game_priority['meta_priority']}")
+        if len(statements) == 0:
+            return ""
+        
+        return f"""
+        meta mark @netcontrol-priority-marks {" ".join(statements)}
+        ether saddr @netcontrol-priority-devices {" ".join(statements)}"""
+
+    def set_priority(self, marks: list[int], macs: list[str]) -> None:
+        """
+        Replaces the prioritized marks and devices in a single transaction.
+
+        Args:
+            marks (list[int]): marks whose traffic is prioritized
+            macs (list[str]): MAC addresses of devices whose traffic is prioritized
+        """
+        macs = [self._check_mac(mac) for mac in macs]
+        
+        cmds = [commands.flush_set("netcontrol-priority-marks"), commands.flush_set("netcontrol-priority-devices")]
+        if len(marks) > 0:
+            cmds.append(commands.add_elements("netcontrol-priority-marks", marks))
+        if len(macs) > 0:
+            cmds.append(commands.add_elements("netcontrol-priority-devices", macs))
+        
+        try:
+            self.executor.call(self._execute_json_cmd, cmds)
+        except NftablesException as ex:
+            self.logger.error(f"Could not change the prioritized devices: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
+        
+        with self.priority_lock:
+            previous = self.priority
+            self.priority = {"marks": marks, "devices": macs}
+        self.logger.info(f"Prioritized {len(marks)} marks and {len(macs)} devices.")
+        
+        changed_marks = set(marks) ^ set(previous["marks"])
+        changed = set(macs) ^ set(previous["devices"])
+        changed.update(mac for mac, mark, _ in self.mirror.items() if mark in changed_marks)
+        self._drop_connections(list(changed))
+
+    def add_priority_devices(self, macs: list[str]) -> dict:
+        """
+        Prioritizes devices, without touching the other prioritized marks and devices
+        
+        Args:
+            macs (list[str]): MAC addresses
+        
+        Returns:
+            dict: added MAC addresses, and the error of each device that could not be added
+        """
+        macs = [self._check_mac(mac) for mac in macs]
+        failed = self.executor.submit([
+            (mac, [commands.add_elements("netcontrol-priority-devices", [mac])], None) for mac in macs
+        ])
+        
+        added = [mac for mac in macs if mac not in failed]
+        with self.priority_lock:
+            devices = self.priority["devices"]
+            self.priority = {
+                "marks": self.priority["marks"],
+                "devices": devices + [mac for mac in added if mac not in devices],
+            }
+        self.logger.info(f"{len(added)} devices prioritized, {len(failed)} failed")
+        self._drop_connections([mac for mac in added if mac not in devices])
+        return { "added": added, "failed": failed }
+
+    def delete_priority_devices(self, macs: list[str]) -> dict:
+        """
+        Stops prioritizing devices, without touching the other prioritized marks and devices.
+        Devices which were not prioritized are ignored.
+        
+        Args:
+            macs (list[str]): MAC addresses
+        
+        Returns:
+            dict: deleted MAC addresses, and the error of each device that could not be deleted
+        """
+        macs = [self._check_mac(mac) for mac in macs]
+        # Deleting an element that isn't in the set fails, so it is added first
+        failed = self.executor.submit([
+            (mac, [
+                commands.add_elements("netcontrol-priority-devices", [mac]),
+                commands.delete_elements("netcontrol-priority-devices", [mac]),
+            ], None) for mac in macs
+        ])
+        
+        deleted = [mac for mac in macs if mac not in failed]
+        with self.priority_lock:
+            devices = self.priority["devices"]
+            self.priority = {
+                "marks": self.priority["marks"],
+                "devices": [mac for mac in devices if mac not in deleted],
+            }
+        self.logger.info(f"{len(deleted)} devices no longer prioritized, {len(failed)} failed")
+        self._drop_connections([mac for mac in deleted if mac in devices])
+        return { "deleted": deleted, "failed": failed }
+
+    def get_bypass_destinations(self) -> list[str]:
+        """
+        Lists the bypass destinations, as merged by nftables
+        
+        Returns:
+            list[str]: addresses, prefixes and ranges
+        """
+        data = self.executor.call(self._execute_json_cmd, [commands.list_set("netcontrol-bypass-dst")], True)
+        
+        destinations = []
+        for entry in data:
+            if "set" in entry:
+                destinations += [commands.interval_str(elem) for elem in entry["set"].get("elem", [])]
+        return destinations
+
+    def set_bypass_destinations(self, destinations: list[str]) -> None:
+        """
+        Replaces every bypass destination in a single transaction, so that traffic never sees a partial list.
+        
+        Args:
+            destinations (list[str]): addresses, prefixes and ranges
+        """
+        elements = self._parse_destinations(destinations)
+        
+        cmds = [commands.flush_set("netcontrol-bypass-dst")]
+        if len(elements) > 0:
+            cmds.append(commands.add_elements("netcontrol-bypass-dst", elements))
+        
+        try:
+            self.executor.call(self._execute_json_cmd, cmds)
+        except NftablesException as ex:
+            self.logger.error(f"Could not replace the bypass destinations: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
+        
+        self.logger.info(f"Bypass destinations replaced by {len(elements)} entries.")
+        self._drop_connections([mac for mac, _, bypass in self.mirror.items() if bypass])
+
+    def reload_bypass_destinations(self) -> None:
+        """
+        Replaces the bypass destinations by the content of the configured file.
+        Empty lines and comments starting with # are ignored.
+        """
+        if self.bypass_destinations_file is None:
+            raise HTTPException(status_code=409, detail="No bypass destinations file configured")
+        
+        try:
+            with open(self.bypass_destinations_file, "r") as file:
+                destinations = [line.split("#", 1)[0].strip() for line in file]
+        except OSError as ex:
+            self.logger.error(f"Could not read the bypass destinations file: {ex}")
+            raise HTTPException(status_code=500, detail="Could not read the bypass destinations file")
+        
+        self.set_bypass_destinations([destination for destination in destinations if destination != ""])
+
+    def add_bypass_destinations(self, destinations: list[str]) -> dict:
+        """
+        Adds bypass destinations, without touching the other ones
+        
+        Args:
+            destinations (list[str]): addresses, prefixes and ranges
+        
+        Returns:
+            dict: added destinations, and the error of each destination that could not be added
+        """
+        elements = self._parse_destinations(destinations)
+        failed = self.executor.submit([
+            (destination, [commands.add_elements("netcontrol-bypass-dst", [element])], None)
+            for destination, element in zip(destinations, elements)
+        ])
+        
+        self.logger.info(f"{len(destinations) - len(failed)} bypass destinations added, {len(failed)} failed")
+        if len(failed) < len(destinations):
+            self._drop_connections([mac for mac, _, bypass in self.mirror.items() if bypass])
+        return { "added": [d for d in destinations if d not in failed], "failed": failed }
+
+    def delete_bypass_destinations(self, destinations: list[str]) -> dict:
+        """
+        Deletes bypass destinations, without touching the other ones.
+        Deleting a part of a merged interval splits it.
+        
+        Args:
+            destinations (list[str]): addresses, prefixes and ranges
+        
+        Returns:
+            dict: deleted destinations, and the error of each destination that could not be deleted
+        """
+        elements = self._parse_destinations(destinations)
+        failed = self.executor.submit([
+            (destination, [commands.delete_elements("netcontrol-bypass-dst", [element])], None)
+            for destination, element in zip(destinations, elements)
+        ])
+        
+        self.logger.info(f"{len(destinations) - len(failed)} bypass destinations deleted, {len(failed)} failed")
+        if len(failed) < len(destinations):
+            self._drop_connections([mac for mac, _, bypass in self.mirror.items() if bypass])
+        return { "deleted": [d for d in destinations if d not in failed], "failed": failed }
+
+    def _parse_destinations(self, destinations: list[str]) -> list:
+        """
+        Parses bypass destinations, and rejects the request if one of them is invalid
+        
+        Args:
+            destinations (list[str]): addresses, prefixes and ranges
+        
+        Returns:
+            list: JSON expressions of the destinations
+        """
+        elements = []
+        for destination in destinations:
+            try:
+                elements.append(commands.interval(destination))
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid destination {destination}")
+        return elements
+
+    def _render_nat(self, limit: dict) -> str:
+        """
+        Renders the content of the nat chain, which redirects HTTP traffic from unauthenticated devices to the gate.
+        Only the first packet of each connection goes through a nat chain, so the meter limits the rate of new connections of each device.
+
+        Args:
+            limit (dict): "rate" of new connections per second and "burst" allowed for each device, no limit if rate is 0
+
+        Returns:
+            str: nft script
+        """
+        # Flushing the meter makes a new limit apply to every device
+        script = "flush chain insalan netcontrol-nat\nflush set insalan netcontrol-portal-meter\n"
+        if limit["rate"] > 0:
+            # Captive portal probes beyond the limit are dropped before reaching the backend
+            script += f"add rule insalan netcontrol-nat ip daddr != 172.16.1.0/24 meta mark 0 tcp dport 80 update @netcontrol-portal-meter {{ ether saddr limit rate over {limit['rate']}/second burst {limit['burst']} packets }} counter name netcontrol-portal-dropped drop\n"
         # Allow traffic to port 80 from unauthenticated devices and redirect it to the network head, to allow access to the langate webpage
-        self._execute_nft_cmd("add chain insalan netcontrol-nat { type nat hook prerouting priority 0; comment \"Redirects HTTP traffic to the gate for unauthenticated devices.\"; }")
-        self._execute_nft_cmd("add rule insalan netcontrol-nat ip daddr != 172.16.1.0/24 ether saddr != @netcontrol-auth tcp dport 80 redirect to :80")
+        script += "add rule insalan netcontrol-nat ip daddr != 172.16.1.0/24 meta mark 0 tcp dport 80 counter name netcontrol-portal-redirected redirect to :80\n"
+        return script
+
+    def set_portal_limit(self, rate: int, burst: int) -> None:
+        """
+        Changes the rate of new HTTP connections each unauthenticated device may open towards the gate, without touching the rest of the gate.
+
+        Args:
+            rate (int): new connections per second allowed for each device, 0 for no limit
+            burst (int): extra connections allowed above the rate
+        """
+        if rate < 0 or burst < 0:
+            raise HTTPException(status_code=400, detail="Invalid rate")
+        
+        limit = {"rate": rate, "burst": burst}
+        try:
+            self.executor.call(self._execute_nft_cmd, self._render_nat(limit))
+        except NftablesException as ex:
+            self.logger.error(f"Could not change the portal rate limit: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
         
-        # Block other traffic from users that are not authenticated
-        self._execute_nft_cmd("add chain insalan netcontrol-forward { type filter hook forward priority 0; comment \"Blocks access to langate-netcontrol from the outside world.\"; }")
-        self._execute_nft_cmd(f"add rule insalan netcontrol-forward ip daddr != {{ 172.16.1.1,{docker_subnet} }} ip saddr {self.variables.ip_range()} ip saddr != {{ 172.16.1.1,{docker_subnet} }} ether saddr != @netcontrol-auth reject")
+        self.portal_limit = limit
+        self.logger.info(f"Portal rate limit set to {rate}/s (burst {burst}).")
 
-        self.logger.info("Gate nftables set up.")
+    def get_portal_stats(self) -> dict:
+        """
+        Reads the counters of the HTTP redirect to the gate, to tune its rate limit
         
+        Returns:
+            dict: current "limit", "redirected" and "dropped" packets and bytes, and number of "tracked" devices in the meter
+        """
+        data = self.executor.call(self._execute_json_cmd, [
+            commands.list_counter("netcontrol-portal-redirected"),
+            commands.list_counter("netcontrol-portal-dropped"),
+            commands.list_set("netcontrol-portal-meter"),
+        ], True)
+        
+        stats = {
+            "limit": self.portal_limit,
+            "redirected": {"packets": 0, "bytes": 0},
+            "dropped": {"packets": 0, "bytes": 0},
+            "tracked": 0,
+        }
+        for entry in data:
+            if "counter" in entry:
+                key = entry["counter"]["name"].removeprefix("netcontrol-portal-")
+                stats[key] = {"packets": entry["counter"]["packets"], "bytes": entry["counter"]["bytes"]}
+            elif "set" in entry:
+                stats["tracked"] = len(entry["set"].get("elem", []))
+        return stats
+
+    def _render_shaping(self, previous: list[tuple[int, int | None, int | None]], limits: list[tuple[int, int | None, int | None]]) -> str:
+        """
+        Renders the content of the shaping chain, replacing the previous limits.
+        Marks are limited as a whole, and each of their devices on its own with a meter keyed by its address.
+        Uploads are matched on the packet mark, downloads on the mark saved in the connection.
+
+        Args:
+            previous (list[tuple[int, int | None, int | None]]): limits currently applied, whose meters are deleted
+            limits (list[tuple[int, int | None, int | None]]): (mark, rate, device rate) limits, rates being in kbytes/s
+
+        Returns:
+            str: nft script
+        """
+        script = "flush chain insalan netcontrol-shaping\nflush set insalan netcontrol-shaped\n" + self._render_meter_deletion(previous)
+        
+        shaped = [str(mark) for mark, rate, device_rate in limits if rate is not None or device_rate is not None]
+        if len(shaped) == 0:
+            return script
+        
+        script += f"add element insalan netcontrol-shaped {{ {', '.join(shaped)} }}\n"
+        # Only the packets sent by devices are marked, the mark is saved in the connection to recognize the downloads
+        script += f"add rule insalan netcontrol-shaping ct direction original meta mark {{ {', '.join(shaped)} }} ct mark set meta mark\n"
+        
+        for mark, rate, device_rate in limits:
+            # Devices are limited before the mark, so that packets they drop don't count in the mark's limit
+            if device_rate is not None:
+                limit = f"limit rate over {device_rate} kbytes/second burst {device_rate} kbytes"
+                script += f"""add set insalan netcontrol-shaping-up-{mark} {{ type ether_addr; flags dynamic, timeout; timeout 1m; }}
+add set insalan netcontrol-shaping-down-{mark} {{ type ipv4_addr; flags dynamic, timeout; timeout 1m; }}
+add rule insalan netcontrol-shaping meta mark {mark} update @netcontrol-shaping-up-{mark} {{ ether saddr {limit} }} drop
+add rule insalan netcontrol-shaping ct direction reply ct mark {mark} update @netcontrol-shaping-down-{mark} {{ ip daddr {limit} }} drop
+"""
+            if rate is not None:
+                limit = f"limit rate over {rate} kbytes/second burst {rate} kbytes"
+                script += f"""add rule insalan netcontrol-shaping meta mark {mark} {limit} drop
+add rule insalan netcontrol-shaping ct direction reply ct mark {mark} {limit} drop
+"""
+        return script
+
+    def _render_meter_deletion(self, limits: list[tuple[int, int | None, int | None]]) -> str:
+        """
+        Renders the deletion of the per-device meters of the given limits, once no rule uses them anymore.
+
+        Args:
+            limits (list[tuple[int, int | None, int | None]]): (mark, rate, device rate) limits
+
+        Returns:
+            str: nft script
+        """
+        script = ""
+        for mark, _, device_rate in limits:
+            if device_rate is not None:
+                script += f"delete set insalan netcontrol-shaping-up-{mark}\ndelete set insalan netcontrol-shaping-down-{mark}\n"
+        return script
+
+    def set_shaping(self, limits: list[tuple[int, int | None, int | None]]) -> None:
+        """
+        Replaces the bandwidth limits of every mark in a single transaction, without touching the rest of the gate.
+        The meters are recreated, so new limits apply immediately to every device.
+
+        Args:
+            limits (list[tuple[int, int | None, int | None]]): (mark, rate, device rate) limits, rates being in kbytes/s and None for no limit
+        """
+        marks = [mark for mark, _, _ in limits]
+        if len(set(marks)) != len(marks):
+            raise HTTPException(status_code=400, detail="Duplicate mark")
+        if any(rate is not None and rate <= 0 for _, *rates in limits for rate in rates):
+            raise HTTPException(status_code=400, detail="Invalid rate")
+        
+        try:
+            self.executor.call(self._execute_nft_cmd, self._render_shaping(self.shaping, limits))
+        except NftablesException as ex:
+            self.logger.error(f"Could not change the bandwidth limits: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
+        
+        self.shaping = limits
+        self.logger.info(f"Bandwidth limits set on {len(limits)} marks.")
+
+    def _gate_objects(self) -> list[tuple[str, str]]:
+        """
+        Lists the objects of the gate in the insalan table
+
+        Returns:
+            list[tuple[str, str]]: (kind, name) of each object, sorted in an order in which they can be deleted
+        """
+        objects = [("chain", name) for name in [
+            "netcontrol-filter", "netcontrol-nat", "netcontrol-forward", "netcontrol-shaping", "netcontrol-priority", "netcontrol-bypass-route",
+        ]]
+        if len(self.flowtable_devices) > 0:
+            objects += [("chain", "netcontrol-offload"), ("flowtable", "netcontrol-ft")]
+        objects += [("set", name) for name in [
+            "netcontrol-auth", "netcontrol-bypass", "netcontrol-bypass-dst", "netcontrol-shaped",
+            "netcontrol-priority-marks", "netcontrol-priority-devices", "netcontrol-portal-meter",
+            "netcontrol-api-addrs", "netcontrol-local-addrs", "netcontrol-docker-subnet",
+        ]]
+        objects += [
+            ("set", f"netcontrol-shaping-{direction}-{mark}")
+            for mark, _, device_rate in self.shaping if device_rate is not None
+            for direction in ["up", "down"]
+        ]
+        objects += [("map", "netcontrol-mac2mark"), ("counter", "netcontrol-portal-redirected"), ("counter", "netcontrol-portal-dropped")]
+        return objects
+
+    def _adopt_limits(self, ruleset: list[dict]) -> None:
+        """
+        Reads back the bandwidth limits and the portal rate limit from the rules of a gate left in place by a previous run,
+        so that limits changed at runtime survive a restart, and the meters of the limited marks are not deleted as obsolete.
+
+        Args:
+            ruleset (list[dict]): current ruleset, as listed by nftables
+        """
+        chains = set()
+        sets = set()
+        rules = {}
+        for entry in ruleset:
+            kind, obj = next(iter(entry.items()))
+            if obj.get("family") != commands.FAMILY or obj.get("table") != commands.TABLE:
+                continue
+            if kind == "chain":
+                chains.add(obj["name"])
+            elif kind == "set":
+                sets.add(obj["name"])
+            elif kind == "rule":
+                rules.setdefault(obj["chain"], []).append(obj.get("expr", []))
+        
+        if "netcontrol-shaping" in chains:
+            limits = {} # [rate, device rate] of each mark
+            for expr in rules.get("netcontrol-shaping", []):
+                # Upload rules are enough, download rules use the same limits
+                mark = next((
+                    stmt["match"]["right"] for stmt in expr
+                    if "match" in stmt and stmt["match"]["left"] == {"meta": {"key": "mark"}} and isinstance(stmt["match"]["right"], int)
+                ), None)
+                limit = self._find_limit(expr)
+                if mark is None or limit is None:
+                    continue
+                rate = limit["rate"] * {"bytes": 1, "kbytes": 1024, "mbytes": 1024 * 1024}[limit.get("rate_unit", "bytes")] // 1024
+                limits.setdefault(mark, [None, None])[f"@netcontrol-shaping-up-{mark}" in json.dumps(expr)] = rate
+            self.shaping = [(mark, rate, device_rate) for mark, (rate, device_rate) in sorted(limits.items())]
+            if len(self.shaping) > 0:
+                self.logger.info(f"Adopting the bandwidth limits of {len(self.shaping)} marks.")
+        
+        if "netcontrol-nat" in chains:
+            if "netcontrol-portal-meter" in sets:
+                # Without a meter rule, the portal limit was turned off at runtime
+                limit = {"rate": 0, "burst": self.portal_limit["burst"]}
+            else:
+                # The gate predates the portal rate limit, the configured one is applied
+                limit = self.portal_limit
+            for expr in rules.get("netcontrol-nat", []):
+                meter = self._find_limit(expr) if "@netcontrol-portal-meter" in json.dumps(expr) else None
+                if meter is not None:
+                    limit = {"rate": meter["rate"], "burst": meter.get("burst", 0)}
+            self.portal_limit = limit
+            self.logger.info(f"Adopting the portal rate limit of {limit['rate']}/s (burst {limit['burst']}).")
+
+    @staticmethod
+    def _find_limit(expr) -> dict | None:
+        """
+        Finds the first limit statement of a rule, including the ones nested in a meter update
+        
+        Args:
+            expr: statements of the rule, as listed by nftables
+        """
+        if isinstance(expr, dict):
+            if "limit" in expr:
+                return expr["limit"]
+            expr = list(expr.values())
+        if isinstance(expr, list):
+            for value in expr:
+                limit = Nft._find_limit(value)
+                if limit is not None:
+                    return limit
+        return None
+
+    def _render_reconciliation(self, ruleset: list[dict]) -> tuple[str, str]:
+        """
+        Compares the gate left in place by a previous run to the one about to be set up, to adopt it.
+        Sets whose definition changed can't be declared again and are recreated, losing their elements.
+        Objects of the gate which are not used anymore are deleted.
+
+        Args:
+            ruleset (list[dict]): current ruleset, as listed by nftables
+
+        Returns:
+            tuple[str, str]: script deleting the sets whose definition changed, and script deleting the obsolete objects
+        """
+        expected = self._gate_objects()
+        existing = []
+        changed = ""
+        for entry in ruleset:
+            kind, obj = next(iter(entry.items()))
+            if kind not in OBJECT_KINDS or obj.get("family") != commands.FAMILY or obj.get("table") != commands.TABLE or not obj["name"].startswith("netcontrol-"):
+                continue
+            existing.append((kind, obj["name"]))
+            
+            elements = [e["elem"]["val"] if isinstance(e, dict) and "elem" in e else e for e in obj.get("elem", [])]
+            if obj["name"] in ["netcontrol-auth", "netcontrol-bypass", "netcontrol-mac2mark"]:
+                # Their timeout depends on the configuration, and only the map counts the traffic of its elements
+                flags = obj.get("flags", [])
+                flags = [flags] if isinstance(flags, str) else flags
+                counter = any("counter" in stmt for stmt in obj.get("stmt", []))
+                if (
+                    ("timeout" in flags) != (self.session_timeout is not None) or obj.get("timeout") != self.session_timeout
+                    or counter != (obj["name"] == "netcontrol-mac2mark")
+                ):
+                    self.logger.warning(f"Definition of {obj['name']} changed, recreating it without its {len(elements)} elements.")
+                    changed += f"delete {kind} insalan {obj['name']}\n"
+                elif obj["name"] == "netcontrol-mac2mark":
+                    self.logger.info(f"Adopting the existing gate with {len(elements)} connected devices.")
+            elif obj["name"] == "netcontrol-priority-marks":
+                self.priority["marks"] = elements
+            elif obj["name"] == "netcontrol-priority-devices":
+                self.priority["devices"] = elements
+        
+        obsolete = sorted((o for o in existing if o not in expected), key=lambda o: OBJECT_KINDS.index(o[0]))
+        return changed, "".join(f"delete {kind} insalan {name}\n" for kind, name in obsolete)
+
     def remove_portail(self) -> None:
         """
-        Removes netcontrol-related chains, sets and maps from insalan table
+        Removes netcontrol-related chains, sets and maps from insalan table, in a single transaction
         """
-        self._execute_nft_cmd("delete chain insalan netcontrol-filter")
-        self._execute_nft_cmd("delete chain insalan netcontrol-nat")
-        self._execute_nft_cmd("delete chain insalan netcontrol-forward")
-        self._execute_nft_cmd("delete chain insalan netcontrol-debypass")
-        self._execute_nft_cmd("delete set insalan netcontrol-auth")
-        self._execute_nft_cmd("delete map insalan netcontrol-mac2mark")
+        script = "".join(f"delete {kind} insalan {name}\n" for kind, name in self._gate_objects())
+        
+        try:
+            self.executor.call(self._execute_nft_cmd, script)
+        except NftablesException as ex:
+            self.logger.error(f"Could not remove the gate nftables: {ex}")
+            raise
         
         self.logger.info("Gate nftables removed.")
 
-    def set_mark(self, mac: str, mark: int, bypass: bool) -> None:
+    def set_mark(self, mac: str, mark: int, bypass: bool, name: str) -> None:
         """
-        Changes mark of the given MAC address
+        Changes mark of the given MAC address.
+        The map element is replaced in a single transaction, so the device is never seen disconnected.
         
         Args:
             mac (str): MAC address
             mark (int): mark to set
+            bypass (bool): whether the device has bypass on
+            name (str): name of the device
         """
         
-        self.delete_user(mac)
-        self.connect_user(mac, mark, bypass, "previously_connected_device")
+        mac = self._check_mac(mac)
+        if self._is_redundant(mac, mark, bypass):
+            self.logger.info(f"Device {mac} (name: {name}) already has mark {mark}")
+            return
+        
+        failed = self.executor.submit([(mac, self._set_mark_cmds(mac, mark, bypass), (mac, mark, bypass))])
+        if mac in failed:
+            self.logger.error(f"Tried to set mark of device {mac} (name: {name}) which was not previously connected: {failed[mac]}")
+            raise HTTPException(status_code=404, detail="Device was not previously connected")
+        
+        self.logger.info(f"Device {mac} (name: {name}) moved to mark {mark}")
 
     def connect_user(self, mac: str, mark: int, bypass: bool, name: str) -> None:
         """
@@ -109,15 +1015,14 @@ class Nft:
             mac (str): MAC address
         """
         
-        if bypass and mark < 1024:
-            mark += 1024
+        mac = self._check_mac(mac)
+        if self._is_redundant(mac, mark, bypass):
+            self.logger.info(f"Device {mac} (name: {name}) already connected with mark {mark}")
+            return
         
-        mac = mac.lower()
-        try:
-            self._execute_nft_cmd(f"add element insalan netcontrol-mac2mark {{ {mac} : {str(mark)} }}")
-            self._execute_nft_cmd(f"add element insalan netcontrol-auth {{ {mac} }}")
-        except NftablesException as ex:
-            self.logger.error(f"Tried to add device {mac} (name: {name}), unexpected nftables error occurred: {ex}")
+        failed = self.executor.submit([(mac, self._connect_cmds(mac, mark, bypass), (mac, mark, bypass))])
+        if mac in failed:
+            self.logger.error(f"Tried to add device {mac} (name: {name}), unexpected nftables error occurred: {failed[mac]}")
             raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
         
         self.logger.info(f"Device {mac} (name: {name}) connected with mark {mark}")
@@ -130,15 +1035,518 @@ class Nft:
             mac (str): MAC address
         """
         
+        mac = self._check_mac(mac)
+        failed = self.executor.submit([(mac, self._delete_cmds(mac), (mac, None))])
+        if mac in failed:
+            self.logger.error(f"Tried to delete device {mac} which was not previously connected: {failed[mac]}")
+            raise HTTPException(status_code=404, detail="Device was not previously connected")
+        
+        self.logger.info(f"Device {mac} disconnected")
+
+    def connect_users(self, devices: list[tuple[str, int, bool, str]]) -> dict:
+        """
+        Connects several devices in a single nftables transaction
+        
+        Args:
+            devices (list[tuple[str, int, bool, str]]): list of (MAC address, mark, bypass, name)
+        
+        Returns:
+            dict: connected MAC addresses, and the error of each device that could not be connected
+        """
+        
+        connected, failed = self._apply_devices(self._connect_cmds, [
+            (mac, mark, bypass) for mac, mark, bypass, _ in devices
+        ])
+        for mac, error in failed.items():
+            self.logger.error(f"Tried to add device {mac}, unexpected nftables error occurred: {error}")
+        
+        self.logger.info(f"{len(connected)} devices connected, {len(failed)} failed")
+        return { "connected": connected, "failed": failed }
+
+    def delete_users(self, macs: list[str]) -> dict:
+        """
+        Disconnects several devices in a single nftables transaction
+        
+        Args:
+            macs (list[str]): MAC addresses
+        
+        Returns:
+            dict: disconnected MAC addresses, and the error of each device that could not be disconnected
+        """
+        
+        disconnected, failed = self._apply_devices(self._delete_cmds, [(mac,) for mac in macs])
+        for mac, error in failed.items():
+            self.logger.error(f"Tried to delete device {mac}, unexpected nftables error occurred: {error}")
+        
+        self.logger.info(f"{len(disconnected)} devices disconnected, {len(failed)} failed")
+        return { "disconnected": disconnected, "failed": failed }
+
+    def set_marks(self, devices: list[tuple[str, int, bool, str]]) -> dict:
+        """
+        Changes the mark of several devices in a single nftables transaction
+        
+        Args:
+            devices (list[tuple[str, int, bool, str]]): list of (MAC address, mark, bypass, name)
+        
+        Returns:
+            dict: updated MAC addresses, and the error of each device whose mark could not be changed
+        """
+        
+        updated, failed = self._apply_devices(self._set_mark_cmds, [
+            (mac, mark, bypass) for mac, mark, bypass, _ in devices
+        ])
+        for mac, error in failed.items():
+            self.logger.error(f"Tried to set mark of device {mac}, unexpected nftables error occurred: {error}")
+        
+        self.logger.info(f"{len(updated)} devices moved to a new mark, {len(failed)} failed")
+        return { "updated": updated, "failed": failed }
+
+    def heartbeat(self, devices: list[tuple[str, int, bool, str]]) -> dict:
+        """
+        Refreshes the timeout of several devices still considered active, in a single nftables transaction.
+        Devices which already expired are connected again.
+        
+        Args:
+            devices (list[tuple[str, int, bool, str]]): list of (MAC address, mark, bypass, name)
+        
+        Returns:
+            dict: refreshed MAC addresses, and the error of each device that could not be refreshed
+        """
+        
+        batch = []
+        failed = {}
+        for mac, mark, bypass, _ in devices:
+            mac = mac.lower()
+            if not MAC_REGEX.match(mac):
+                failed[mac] = "Invalid MAC address"
+                continue
+            batch.append((mac, mark, bypass))
+        
+        failed |= self.executor.call(self._heartbeat, batch)
+        for mac, error in failed.items():
+            self.logger.error(f"Tried to refresh device {mac}, unexpected nftables error occurred: {error}")
+        
+        refreshed = [mac for mac, _, _ in batch if mac not in failed]
+        self.logger.info(f"{len(refreshed)} devices refreshed, {len(failed)} failed")
+        return { "refreshed": refreshed, "failed": failed }
+
+    def _heartbeat(self, devices: list[tuple[str, int, bool]]) -> dict[str, str]:
+        """
+        Refreshes devices from the map's current content.
+        Must be run by the executor, so that no other operation happens between the read and the transaction.
+        
+        Args:
+            devices (list[tuple[str, int, bool]]): list of (MAC address, mark, bypass)
+        
+        Returns:
+            dict[str, str]: error of each device that could not be refreshed
+        """
+        connected = self._read_devices(bypass=True)
+        
+        batch = []
+        for mac, mark, bypass in devices:
+            if mac not in connected:
+                batch.append((mac, self._connect_cmds(mac, mark, bypass), (mac, mark, bypass)))
+            elif self.session_timeout is not None:
+                batch.append((mac, self._refresh_cmds(mac, mark, bypass, connected[mac]), (mac, mark, bypass)))
+        
+        return self._apply_groups(batch)
+
+    def _apply_devices(self, cmds: Callable[..., list[dict]], devices: list[tuple]) -> tuple[list[str], dict[str, str]]:
+        """
+        Applies an operation on several devices in a single transaction.
+        Devices already in the requested state are not written again.
+        
+        Args:
+            cmds (Callable[..., list[dict]]): function returning the commands for a device, called with the device's tuple
+            devices (list[tuple]): devices, as (MAC address, mark, bypass) tuples, or (MAC address,) ones to disconnect them
+        
+        Returns:
+            tuple[list[str], dict[str, str]]: MAC addresses successfully handled, and the error of each failed one
+        """
+        batch = []
+        unchanged = []
+        failed = {}
+        for mac, *args in devices:
+            mac = mac.lower()
+            if not MAC_REGEX.match(mac):
+                failed[mac] = "Invalid MAC address"
+                continue
+            if len(args) > 0 and self._is_redundant(mac, *args):
+                unchanged.append(mac)
+                continue
+            batch.append((mac, cmds(mac, *args), (mac, *args) if len(args) > 0 else (mac, None)))
+        
+        failed |= self.executor.submit(batch)
+        return unchanged + [mac for mac, _, _ in batch if mac not in failed], failed
+
+    def _is_redundant(self, mac: str, mark: int, bypass: bool) -> bool:
+        """
+        Whether a device is already connected with the given mark and bypass, so that writing it again can be skipped.
+        Elements expire in the kernel when a session timeout is set, without the mirror knowing it, so nothing is skipped then.
+        
+        Args:
+            mac (str): lowercase MAC address
+            mark (int): mark to set
+            bypass (bool): whether the device has bypass on
+        """
+        return self.session_timeout is None and self.mirror.get(mac) == (mark, bypass)
+
+    def _check_mac(self, mac: str) -> str:
+        """
+        Normalizes a MAC address, and rejects the request if it is invalid
+        
+        Args:
+            mac (str): MAC address
+        
+        Returns:
+            str: lowercase MAC address
+        """
         mac = mac.lower()
+        if not MAC_REGEX.match(mac):
+            raise HTTPException(status_code=400, detail="Invalid MAC address")
+        return mac
+
+    def _connect_cmds(self, mac: str, mark: int, bypass: bool) -> list[dict]:
+        """
+        Commands connecting a device
+        
+        Args:
+            mac (str): MAC address
+            mark (int): mark to set
+            bypass (bool): whether the device has bypass on
+        """
+        return [
+            commands.add_elements("netcontrol-mac2mark", [[mac, mark]]),
+            commands.add_elements("netcontrol-auth", [mac]),
+        ] + self._bypass_cmds(mac, bypass)
+
+    def _delete_cmds(self, mac: str) -> list[dict]:
+        """
+        Commands disconnecting a device
+        
+        Args:
+            mac (str): MAC address
+        """
+        return [
+            commands.delete_elements("netcontrol-mac2mark", [mac]),
+            commands.delete_elements("netcontrol-auth", [mac]),
+        ] + self._bypass_cmds(mac, False)
+
+    def _set_mark_cmds(self, mac: str, mark: int, bypass: bool) -> list[dict]:
+        """
+        Commands replacing the mark of a connected device, to be run in a single transaction
+        
+        Args:
+            mac (str): MAC address
+            mark (int): mark to set
+            bypass (bool): whether the device has bypass on
+        """
+        return [
+            commands.delete_elements("netcontrol-mac2mark", [mac]),
+            commands.add_elements("netcontrol-mac2mark", [[mac, mark]]),
+            commands.add_elements("netcontrol-auth", [mac]),
+        ] + self._bypass_cmds(mac, bypass)
+
+    def _refresh_cmds(self, mac: str, mark: int, bypass: bool, counter: dict | None = None) -> list[dict]:
+        """
+        Commands resetting the timeout of a connected device, by replacing its elements in a single transaction
+        
+        Args:
+            mac (str): MAC address
+            mark (int): mark to set
+            bypass (bool): whether the device has bypass on
+            counter (dict | None): "packets" and "bytes" the device's counter is restored to, as read before the refresh
+        """
+        # Adding an existing element doesn't reset its timeout on every kernel, so elements are deleted and added again
+        key = mac
+        if counter is not None:
+            key = {"elem": {"val": mac, "counter": {"packets": counter["packets"], "bytes": counter["bytes"]}}}
+        return [
+            commands.delete_elements("netcontrol-mac2mark", [mac]),
+            commands.add_elements("netcontrol-mac2mark", [[key, mark]]),
+            commands.add_elements("netcontrol-auth", [mac]),
+            commands.delete_elements("netcontrol-auth", [mac]),
+            commands.add_elements("netcontrol-auth", [mac]),
+        ] + self._bypass_cmds(mac, bypass, refresh=True)
+
+    def _bypass_cmds(self, mac: str, bypass: bool, refresh: bool = False) -> list[dict]:
+        """
+        Commands adding a device to the bypass set, or removing it whether it was there or not
+        
+        Args:
+            mac (str): MAC address
+            bypass (bool): whether the device has bypass on
+            refresh (bool): whether the element is added anew, to reset its timeout
+        """
+        cmds = [commands.add_elements("netcontrol-bypass", [mac])]
+        if not bypass or refresh:
+            # Deleting an element that isn't in the set fails, so it is added first
+            cmds.append(commands.delete_elements("netcontrol-bypass", [mac]))
+        if bypass and refresh:
+            cmds.append(commands.add_elements("netcontrol-bypass", [mac]))
+        return cmds
+
+    def read_devices(self) -> dict[str, dict]:
+        """
+        Reads the mark and counters of every connected device from the map, in a single read
+        
+        Returns:
+            dict[str, dict]: "mark", "packets" and "bytes" of each device, indexed by MAC address
+        """
+        return self.executor.call(self._read_devices)
+
+    def _read_devices(self, bypass: bool = False) -> dict[str, dict]:
+        """
+        Reads the map, see read_devices.
+        Must be run by the executor.
+        A read of both the map and the bypass set is complete, so it also rebuilds the mirror.
+        
+        Args:
+            bypass (bool): whether the bypass set is read in the same command, to add the "bypass" state of each device
+        """
+        cmds = [commands.list_map("netcontrol-mac2mark")]
+        if bypass:
+            cmds.append(commands.list_set("netcontrol-bypass"))
+        data = self._execute_json_cmd(cmds, True)
+        
+        devices = {}
+        bypassed = set()
+        for entry in data:
+            if "set" in entry:
+                bypassed.update(e["elem"]["val"] if isinstance(e, dict) else e for e in entry["set"].get("elem", []))
+            if "map" in entry:
+                devices.update(self._parse_devices(entry["map"]))
+        
+        if bypass:
+            for mac, device in devices.items():
+                device["bypass"] = mac in bypassed
+            expired = self.mirror.replace(devices)
+            if len(expired) > 0:
+                self.logger.info(f"{len(expired)} devices expired")
+                self._drop_connections(expired)
+        return devices
+
+    def _parse_devices(self, data: dict) -> dict[str, dict]:
+        """
+        Parses the elements of the map, as listed by nftables
+        
+        Args:
+            data (dict): "map" object of the output
+        
+        Returns:
+            dict[str, dict]: "mark", "packets" and "bytes" of each device, indexed by MAC address
+        """
+        devices = {}
+        for key, mark in data.get("elem", []):
+            counter = {}
+            if isinstance(key, dict):
+                counter = key["elem"].get("counter", {})
+                key = key["elem"]["val"]
+            devices[key] = {
+                "mark": mark,
+                "packets": counter.get("packets", 0),
+                "bytes": counter.get("bytes", 0),
+            }
+        return devices
+
+    def get_device_mark(self, mac: str) -> dict:
+        """
+        Looks a device up in the mirror, without reading nftables
+        
+        Args:
+            mac (str): MAC address
+        
+        Returns:
+            dict: whether the device is "connected", and its "mark" and "bypass" if it is
+        """
+        device = self.mirror.get(self._check_mac(mac))
+        if device is None:
+            return { "connected": False }
+        return { "connected": True, "mark": device[0], "bypass": device[1] }
+
+    def get_mark_counts(self) -> dict[int, int]:
+        """
+        Counts the connected devices of each mark from the mirror, without reading nftables
+        """
+        return self.mirror.counts()
+
+    def get_device_counts(self) -> dict[tuple[int, bool], int]:
+        """
+        Counts the connected devices of each mark and bypass state, from a single read of the map and the bypass set.
+        Unlike get_mark_counts, this reads nftables, so devices which expired are not counted.
+        
+        Returns:
+            dict[tuple[int, bool], int]: number of devices, indexed by (mark, bypass)
+        """
+        return dict(Counter(
+            (device["mark"], device["bypass"]) for device in self.executor.call(self._read_devices, True).values()
+        ))
+
+    def get_state(self) -> dict:
+        """
+        Lists the connected devices from a single read of the map and the bypass set
+        
+        Returns:
+            dict: "devices" indexed by MAC address with their "mark" and "bypass", and a "version" hash of this state
+        """
+        state = {
+            mac: {"mark": device["mark"], "bypass": device["bypass"]}
+            for mac, device in self.executor.call(self._read_devices, True).items()
+        }
+        return { "version": self._state_version(state), "devices": state }
+
+    def apply_state(self, devices: list[tuple[str, int, bool, str]], version: str | None = None) -> dict:
+        """
+        Makes the connected devices match a desired state, applying only the differences in a single transaction.
+        Devices missing from the desired state are disconnected.
+        
+        Args:
+            devices (list[tuple[str, int, bool, str]]): every device that should be connected, as (MAC address, mark, bypass, name)
+            version (str | None): version of the state the desired one was computed from, the request is rejected if it changed
+        
+        Returns:
+            dict: number of devices "connected", "disconnected" and "updated", the error of each device that could not be applied,
+                and the "version" of the desired state
+        """
+        desired = {}
+        failed = {}
+        for mac, mark, bypass, _ in devices:
+            mac = mac.lower()
+            if not MAC_REGEX.match(mac):
+                failed[mac] = "Invalid MAC address"
+                continue
+            desired[mac] = {"mark": mark, "bypass": bypass}
+        
+        result = self.executor.call(self._apply_state, desired, version)
+        result["failed"] |= failed
+        for mac, error in result["failed"].items():
+            self.logger.error(f"Could not apply the state of device {mac}: {error}")
+        
+        self.logger.info(f"State applied: {result['connected']} devices connected, {result['disconnected']} disconnected, {result['updated']} updated, {len(result['failed'])} failed")
+        return result | { "version": self._state_version(desired) }
+
+    def _apply_state(self, desired: dict[str, dict], version: str | None) -> dict:
+        """
+        Applies the difference between the map's current content and a desired state.
+        Must be run by the executor, so that no other operation happens between the read and the transaction.
+        """
+        current = self._read_devices(bypass=True)
+        current = {mac: {"mark": device["mark"], "bypass": device["bypass"]} for mac, device in current.items()}
+        if version is not None and version != self._state_version(current):
+            raise HTTPException(status_code=409, detail="State changed since the given version")
+        
+        batch = []
+        kinds = {} # kind of change of each device
+        for mac in current.keys() - desired.keys():
+            batch.append((mac, self._delete_cmds(mac), (mac, None)))
+            kinds[mac] = "disconnected"
+        for mac, device in desired.items():
+            state = (mac, device["mark"], device["bypass"])
+            if mac not in current:
+                batch.append((mac, self._connect_cmds(*state), state))
+                kinds[mac] = "connected"
+            elif current[mac]["mark"] != device["mark"]:
+                batch.append((mac, self._set_mark_cmds(*state), state))
+                kinds[mac] = "updated"
+            elif current[mac]["bypass"] != device["bypass"]:
+                batch.append((mac, self._bypass_cmds(mac, device["bypass"]), state))
+                kinds[mac] = "updated"
+        
+        failed = self._apply_groups(batch)
+        counts = {"connected": 0, "disconnected": 0, "updated": 0}
+        for mac, kind in kinds.items():
+            if mac not in failed:
+                counts[kind] += 1
+        return counts | { "failed": failed }
+
+    def _state_version(self, state: dict[str, dict]) -> str:
+        """
+        Compact hash of a state, identical for identical states
+        
+        Args:
+            state (dict[str, dict]): "mark" and "bypass" of each device, indexed by MAC address
+        """
+        data = json.dumps(sorted((mac, device["mark"], device["bypass"]) for mac, device in state.items()))
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def get_device_counters(self, mac: str) -> dict:
+        """
+        Gets the traffic counters of a device, since it was connected or its mark last changed
+        
+        Args:
+            mac (str): MAC address
+        
+        Returns:
+            dict: "packets" and "bytes" sent by the device
+        """
+        mac = self._check_mac(mac)
         try:
-            self._execute_nft_cmd(f"delete element insalan netcontrol-mac2mark {{ {mac} }}")
-            self._execute_nft_cmd(f"delete element insalan netcontrol-auth {{ {mac} }}")
+            data = self.executor.call(self._execute_json_cmd, [commands.get_elements("netcontrol-mac2mark", [mac])], True)
         except NftablesException as ex:
-            self.logger.error(f"Tried to delete device {mac} which was not previously connected: {ex}")
-            raise HTTPException(status_code=404, detail="Device was not previously connected")
+            if "No such file or directory" in str(ex):
+                # The device isn't connected
+                return { "packets": 0, "bytes": 0 }
+            self.logger.error(f"Could not get the counters of {mac}: {ex}")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
         
-        self.logger.info(f"Device {mac} disconnected")
+        device = {"packets": 0, "bytes": 0}
+        for entry in data:
+            if "map" in entry:
+                device = self._parse_devices(entry["map"]).get(mac, device)
+        return { "packets": device["packets"], "bytes": device["bytes"] }
+
+    def get_top_devices(self, count: int, interval: float) -> dict:
+        """
+        Gets the devices that sent the most bytes over an interval.
+        The map is read once, and compared to the newest snapshot taken at least interval seconds ago.
+        
+        Args:
+            count (int): number of devices to return
+            interval (float): minimum duration to compute the traffic over, in seconds
+        
+        Returns:
+            dict: the actual "interval" (None if there was no previous snapshot, counters are then absolute),
+                and the top "devices" with their MAC address, mark, and packets and bytes sent over the interval
+        """
+        if count <= 0:
+            raise HTTPException(status_code=400, detail="Invalid count")
+        if interval < 0:
+            raise HTTPException(status_code=400, detail="Invalid interval")
+        
+        devices = self.read_devices()
+        now = time.monotonic()
+        
+        with self.counter_lock:
+            baseline_time, baseline = None, {}
+            for snapshot_time, snapshot in self.counter_snapshots:
+                if baseline_time is None or snapshot_time <= now - interval:
+                    baseline_time, baseline = snapshot_time, snapshot
+            
+            # Frequent calls share the same snapshots, so that memory doesn't grow with their rate
+            if len(self.counter_snapshots) == 0 or self.counter_snapshots[-1][0] <= now - COUNTER_SNAPSHOT_MIN_AGE:
+                self.counter_snapshots.append((now, {mac: (device["packets"], device["bytes"]) for mac, device in devices.items()}))
+            while self.counter_snapshots[0][0] < now - COUNTER_HISTORY:
+                self.counter_snapshots.popleft()
+        
+        top = []
+        for mac, device in devices.items():
+            previous_packets, previous_bytes = baseline.get(mac, (0, 0))
+            if device["bytes"] < previous_bytes:
+                # Counters are reset when the element is replaced
+                previous_packets, previous_bytes = 0, 0
+            top.append({
+                "mac": mac,
+                "mark": device["mark"],
+                "packets": device["packets"] - previous_packets,
+                "bytes": device["bytes"] - previous_bytes,
+            })
+        top.sort(key=lambda device: device["bytes"], reverse=True)
+        
+        return {
+            "interval": None if baseline_time is None else now - baseline_time,
+            "devices": top[:count],
+        }
 
 class NftablesException(Exception):
     pass
@@ -149,12 +1557,51 @@ class MockedNft(Nft):
     """
     def __init__(self, logger: logging.Logger) -> None:
         self.logger = logger
+        self.executor = NftExecutor(logger, self._apply_groups)
+        self.mirror = DeviceMirror()
+        self.addresses = Addresses(logger)
+        self.counter_snapshots = deque()
+        self.counter_lock = threading.Lock()
+        # The flowtable endpoints go through the regular path, with nft commands mocked
+        self.flowtable_devices = ["mock0", "mock1"]
+        self.flowtable_enabled = False
+        self.session_timeout = None
+        self.shaping = []
+        self.portal_limit = {"rate": 10, "burst": 20}
+        self.game_priority = {"dscp": "cs4", "meta_priority": None}
+        self.priority = {"marks": [], "devices": []}
+        self.priority_lock = threading.Lock()
+        self.bypass_mark = 1024
+        self.bypass_destinations_file = None
     
     def check_nftables(self) -> None:
         self.logger.info("Mocked nftables OK.")
     
-    def _execute_nft_cmd(self, cmd: str) -> dict:
-        return {}
+    def _execute_nft_cmd(self, cmd: str) -> None:
+        pass
+    
+    def _execute_json_cmd(self, cmds: list[dict], read: bool = False) -> list:
+        # Reads of the devices return the content of the mirror, as if the map followed every write
+        if not read:
+            return []
+        devices = self.mirror.items()
+        output = []
+        for cmd in cmds:
+            element = cmd.get("get", {}).get("element", {})
+            if element.get("name") == "netcontrol-mac2mark":
+                found = [[mac, mark] for mac, mark, _ in devices if mac in element["elem"]]
+                if len(found) == 0:
+                    raise NftablesException(1, "Error: Could not process rule: No such file or directory")
+                output.append({"map": {"name": "netcontrol-mac2mark", "elem": found}})
+            obj = cmd.get("list", {})
+            if obj.get("map", {}).get("name") == "netcontrol-mac2mark":
+                output.append({"map": {"name": "netcontrol-mac2mark", "elem": [[mac, mark] for mac, mark, _ in devices]}})
+            elif obj.get("set", {}).get("name") == "netcontrol-bypass":
+                output.append({"set": {"name": "netcontrol-bypass", "elem": [mac for mac, _, bypass in devices if bypass]}})
+        return output
+    
+    def _delete_connections(self, macs: set[str]) -> None:
+        self.logger.info(f"Deleted the connections of {len(macs)} devices")
     
     def setup_portail(self) -> None:
         self.logger.info("Gate nftables set up.")
@@ -3,6 +3,7 @@ from .utilities import to_decimal_mac
 from puresnmp import Client, V2C, PyWrapper
 from fastapi import HTTPException
 import asyncio
+from .metrics import snmp_duration
 
 TIMEOUT = 2.5
 RETRIES = 2
@@ -28,7 +29,7 @@ class Snmp:
         async def check_switch(switch):
             try:
                 client = Client(switch, self.v2c)
-                with client.reconfigure(timeout=TIMEOUT,retries=RETRIES):
+                with snmp_duration.labels(switch).time(), client.reconfigure(timeout=TIMEOUT,retries=RETRIES):
                     client = PyWrapper(client)
                     oids = {}
                     async for (oid, port) in client.walk(mac_oid):
@@ -0,0 +1,1221 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+import prometheus_client as prometheus
+
+from . import commands
+from .arp import Arp, ArpIndex, NeighbourIndex, Prober
+from .devices import Devices
+from .executor import NftExecutor
+from .mirror import DeviceMirror
+from .netlink import Addresses
+from .nft import MockedNft, NftablesException
+
+logger = logging.getLogger(__name__)
+
+def errors(error_type: str) -> float:
+    """
+    Current value of the error counter of the given type
+    """
+    return prometheus.REGISTRY.get_sample_value("netcontrol_errors_total", {"type": error_type}) or 0
+
+class TestMergeCommands(unittest.TestCase):
+    """
+    Test cases for the merging of element commands
+    """
+
+    def test_merge_same_set(self):
+        """
+        Test that consecutive additions to a set are merged
+        """
+        merged = commands.merge_commands([
+            commands.add_elements("s", ["a"]),
+            commands.add_elements("s", ["b"]),
+            commands.add_elements("t", ["c"]),
+        ])
+
+        self.assertEqual(merged, [
+            commands.add_elements("s", ["a", "b"]),
+            commands.add_elements("t", ["c"]),
+        ])
+
+    def test_merge_disjoint_keys(self):
+        """
+        Test that an addition is merged across a deletion of other keys
+        """
+        merged = commands.merge_commands([
+            commands.add_elements("s", ["a"]),
+            commands.delete_elements("s", ["b"]),
+            commands.add_elements("s", ["c"]),
+        ])
+
+        self.assertEqual(merged, [
+            commands.add_elements("s", ["a", "c"]),
+            commands.delete_elements("s", ["b"]),
+        ])
+
+    def test_no_merge_same_key(self):
+        """
+        Test that an addition is not merged across a deletion of the same key
+        """
+        cmds = [
+            commands.add_elements("s", ["a"]),
+            commands.delete_elements("s", ["a"]),
+            commands.add_elements("s", ["a"]),
+        ]
+
+        self.assertEqual(commands.merge_commands(cmds), cmds)
+
+    def test_no_merge_intervals(self):
+        """
+        Test that prefixes, which can overlap other keys, are not merged across a deletion
+        """
+        cmds = [
+            commands.add_elements("s", [commands.interval("10.0.0.0/8")]),
+            commands.delete_elements("s", ["10.0.0.1"]),
+            commands.add_elements("s", [commands.interval("10.1.0.0/16")]),
+        ]
+
+        self.assertEqual(commands.merge_commands(cmds), cmds)
+
+    def test_no_merge_across_flush(self):
+        """
+        Test that an addition is not merged across a flush of its set
+        """
+        cmds = [
+            commands.add_elements("s", ["a"]),
+            commands.flush_set("s"),
+            commands.add_elements("s", ["b"]),
+        ]
+
+        self.assertEqual(commands.merge_commands(cmds), cmds)
+
+    def test_merge_across_other_flush(self):
+        """
+        Test that a flush of another set doesn't prevent merging
+        """
+        merged = commands.merge_commands([
+            commands.add_elements("s", ["a"]),
+            commands.flush_set("t"),
+            commands.add_elements("s", ["b"]),
+        ])
+
+        self.assertEqual(merged, [
+            commands.add_elements("s", ["a", "b"]),
+            commands.flush_set("t"),
+        ])
+
+class TestExecutor(unittest.TestCase):
+    """
+    Test cases for the gathering of operations by the executor
+    """
+
+    def setUp(self):
+        self.batches = []
+        self.executor = NftExecutor(logger, self.execute_batch)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def execute_batch(self, batch):
+        self.batches.append(batch)
+        return {key: "failed" for key, cmds in batch if cmds == ["bad"]}
+
+    def block(self):
+        """
+        Keeps the worker busy until released, so that the following operations are queued together
+        """
+        started = threading.Event()
+        def wait():
+            started.set()
+            self.release.wait()
+        threading.Thread(target=self.executor.call, args=(wait,)).start()
+        started.wait()
+
+    def queue(self, function, *args):
+        """
+        Runs a blocking executor method in a thread, once the previous ones are queued
+        """
+        results = {}
+        size = self.executor.queue.qsize()
+        thread = threading.Thread(target=lambda: results.setdefault("result", function(*args)))
+        thread.start()
+        while self.executor.queue.qsize() == size:
+            time.sleep(0.001)
+        return thread, results
+
+    def test_merge_submits(self):
+        """
+        Test that concurrent submits are applied in a single batch, each getting its own failures
+        """
+        self.block()
+        first, first_result = self.queue(self.executor.submit, [("a", ["ok"]), ("b", ["bad"])])
+        second, second_result = self.queue(self.executor.submit, [("a", ["bad"])])
+        self.release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual([key for key, _ in self.batches[0]], [(0, "a"), (0, "b"), (1, "a")])
+        self.assertEqual(first_result["result"], {"b": "failed"})
+        self.assertEqual(second_result["result"], {"a": "failed"})
+
+    def test_split_on_call(self):
+        """
+        Test that a call queued between two submits splits them in two batches, run in queue order
+        """
+        order = []
+        self.block()
+        first, _ = self.queue(self.executor.submit, [("a", ["ok"])])
+        call, _ = self.queue(self.executor.call, lambda: order.append(len(self.batches)))
+        second, _ = self.queue(self.executor.submit, [("b", ["ok"])])
+        self.release.set()
+        for thread in [first, call, second]:
+            thread.join()
+
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(order, [1])
+
+    def test_batch_exception(self):
+        """
+        Test that an exception while applying a batch is raised to every submitter
+        """
+        def fail(batch):
+            raise NftablesException(1, "error")
+        executor = NftExecutor(logger, fail)
+
+        with self.assertRaises(NftablesException):
+            executor.submit([("a", ["ok"])])
+
+class TestExecuteNftBatch(unittest.TestCase):
+    """
+    Test cases for the isolation of failing groups in a transaction
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.transactions = []
+        self.nft._execute_json_cmd = self.execute_json_cmd
+
+    def execute_json_cmd(self, cmds, read=False):
+        self.transactions.append(cmds)
+        if "bad" in cmds:
+            raise NftablesException(1, "Error: bad\n")
+        return []
+
+    def test_single_transaction(self):
+        """
+        Test that valid groups are applied in a single transaction
+        """
+        failed = self.nft._execute_nft_batch([(i, ["ok"]) for i in range(8)])
+
+        self.assertEqual(failed, {})
+        self.assertEqual(len(self.transactions), 1)
+
+    def test_isolate_failures(self):
+        """
+        Test that failing groups are isolated, and every valid group is still applied
+        """
+        batch = [(i, ["bad"] if i in (2, 5) else [f"ok{i}"]) for i in range(8)]
+
+        failed = self.nft._execute_nft_batch(batch)
+
+        self.assertEqual(failed, {2: "Error: bad", 5: "Error: bad"})
+        applied = {cmd for cmds in self.transactions if "bad" not in cmds for cmd in cmds}
+        self.assertEqual(applied, {f"ok{i}" for i in range(8) if i not in (2, 5)})
+
+    def test_errors_counted_once(self):
+        """
+        Test that a failing group is counted once, not on every attempt of the bisection
+        """
+        before = errors("NftablesException")
+
+        self.nft._execute_nft_batch([(i, ["bad"] if i in (2, 5) else [f"ok{i}"]) for i in range(8)])
+
+        self.assertEqual(errors("NftablesException") - before, 2)
+
+    def test_empty_batch(self):
+        """
+        Test that an empty batch doesn't run any transaction
+        """
+        self.assertEqual(self.nft._execute_nft_batch([]), {})
+        self.assertEqual(self.transactions, [])
+
+class TestDropConnections(unittest.TestCase):
+    """
+    Test cases for the deletion of the connections of devices leaving their mark while traffic is offloaded
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.nft.flowtable_enabled = True
+        self.dropped = []
+        self.done = threading.Event()
+        self.nft._delete_connections = mock.Mock(side_effect=self.delete_connections)
+        self.nft.connect_user("aa:bb:cc:dd:ee:ff", 3, False, "test")
+
+    def delete_connections(self, macs):
+        self.dropped.append(macs)
+        self.done.set()
+
+    def test_disconnect(self):
+        """
+        Test that disconnecting a device deletes its connections
+        """
+        self.nft.delete_user("aa:bb:cc:dd:ee:ff")
+
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.dropped, [{"aa:bb:cc:dd:ee:ff"}])
+
+    def test_mark_change(self):
+        """
+        Test that moving a device to another mark deletes its connections, but refreshing it doesn't
+        """
+        self.nft.heartbeat([("aa:bb:cc:dd:ee:ff", 3, False, "test")])
+        self.nft.set_mark("aa:bb:cc:dd:ee:ff", 4, False, "test")
+
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.dropped, [{"aa:bb:cc:dd:ee:ff"}])
+
+    def test_bypass_change(self):
+        """
+        Test that changing only the bypass of a device deletes its connections, as its traffic is routed differently
+        """
+        self.nft.set_mark("aa:bb:cc:dd:ee:ff", 3, True, "test")
+
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.dropped, [{"aa:bb:cc:dd:ee:ff"}])
+
+    def test_bypass_destinations_change(self):
+        """
+        Test that changing the bypass destinations deletes the connections of the devices with bypass only
+        """
+        self.nft.connect_user("00:11:22:33:44:55", 3, True, "test")
+        self.nft.set_bypass_destinations(["10.0.0.0/8"])
+
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.dropped, [{"00:11:22:33:44:55"}])
+
+    def test_priority_change(self):
+        """
+        Test that prioritizing a mark or a device deletes the connections of its devices
+        """
+        self.nft.connect_user("00:11:22:33:44:55", 4, False, "test")
+        self.nft.set_priority([3], [])
+        self.assertTrue(self.done.wait(1))
+        self.done.clear()
+        self.nft.add_priority_devices(["00:11:22:33:44:55"])
+        self.assertTrue(self.done.wait(1))
+        self.done.clear()
+        self.nft.add_priority_devices(["00:11:22:33:44:55"])
+
+        self.assertFalse(self.done.wait(0.1))
+        self.assertEqual(self.dropped, [{"aa:bb:cc:dd:ee:ff"}, {"00:11:22:33:44:55"}])
+
+    def test_expiry(self):
+        """
+        Test that a device missing from a full read, because it expired, has its connections deleted
+        """
+        self.nft._execute_json_cmd = lambda cmds, read=False: []
+        self.nft._read_devices(True)
+
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.dropped, [{"aa:bb:cc:dd:ee:ff"}])
+
+    def test_offload_disabled(self):
+        """
+        Test that connections are kept when traffic is not offloaded, as the forward chain sees every packet
+        """
+        self.nft.flowtable_enabled = False
+        self.nft.delete_user("aa:bb:cc:dd:ee:ff")
+
+        self.assertFalse(self.done.wait(0.1))
+        self.nft._delete_connections.assert_not_called()
+
+class TestRendering(unittest.TestCase):
+    """
+    Test cases for the rendering of the gate rules
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.nft.variables = mock.Mock(ip_range=mock.Mock(return_value="172.16.0.0/16"))
+
+    def test_flowtable(self):
+        """
+        Test that the flowtable is declared on the configured devices, and only offloads traffic which needs no chain
+        """
+        self.nft.flowtable_enabled = True
+        script = self.nft._render_portail()
+
+        self.assertIn("devices = { mock0, mock1 }", script)
+        self.assertIn(
+            "add rule insalan netcontrol-offload meta mark != 0 meta mark != @netcontrol-shaped meta mark != @netcontrol-priority-marks "
+            "ether saddr != @netcontrol-priority-devices ip protocol { tcp, udp } counter flow add @netcontrol-ft\n",
+            script
+        )
+
+    def test_flowtable_disabled(self):
+        """
+        Test that a disabled offload keeps the flowtable but empties its chain, and that no flowtable is rendered without devices
+        """
+        self.assertEqual(self.nft._render_offload(False), "flush chain insalan netcontrol-offload\n")
+        self.assertIn("flowtable netcontrol-ft", self.nft._render_flowtable())
+        self.assertNotIn("flow add", self.nft._render_flowtable())
+
+        self.nft.flowtable_devices = []
+        self.assertEqual(self.nft._render_flowtable(), "")
+
+    def test_portal_meter(self):
+        """
+        Test that probes above the portal limit are dropped before being redirected, and that the meter is reset
+        """
+        script = self.nft._render_nat({"rate": 5, "burst": 8})
+        lines = script.splitlines()
+
+        self.assertEqual(lines[:2], ["flush chain insalan netcontrol-nat", "flush set insalan netcontrol-portal-meter"])
+        self.assertIn("update @netcontrol-portal-meter { ether saddr limit rate over 5/second burst 8 packets } counter name netcontrol-portal-dropped drop", lines[2])
+        self.assertIn("redirect to :80", lines[3])
+
+    def test_portal_unlimited(self):
+        """
+        Test that a rate of 0 only redirects
+        """
+        script = self.nft._render_nat({"rate": 0, "burst": 8})
+
+        self.assertNotIn("update @netcontrol-portal-meter", script)
+        self.assertIn("counter name netcontrol-portal-redirected redirect to :80", script)
+
+    def test_bypass_destinations(self):
+        """
+        Test that devices with bypass get the bypass mark for the bypass destinations only, which are replaced as a whole
+        """
+        self.assertIn("ether saddr @netcontrol-bypass ip daddr @netcontrol-bypass-dst meta mark set 1024", self.nft._render_portail())
+
+        with mock.patch.object(self.nft, "_execute_json_cmd", return_value=[]) as mock_execute:
+            self.nft.set_bypass_destinations(["10.0.0.0/8", "192.168.1.1", "172.20.0.1-172.20.0.9"])
+
+        self.assertEqual(mock_execute.call_args.args[0], [
+            commands.flush_set("netcontrol-bypass-dst"),
+            commands.add_elements("netcontrol-bypass-dst", [
+                {"prefix": {"addr": "10.0.0.0", "len": 8}}, "192.168.1.1", {"range": ["172.20.0.1", "172.20.0.9"]},
+            ]),
+        ])
+
+    def test_bypass_route_authenticated(self):
+        """
+        Test that the bypass mark is only given to packets already marked from the map, so that unauthenticated devices stay blocked
+        """
+        script = self.nft._render_portail()
+        chain = script[script.index("chain netcontrol-bypass-route {"):]
+        chain = chain[:chain.index("}")]
+        rules = [line.strip() for line in chain.splitlines()[1:] if line.strip() != "" and not line.strip().startswith("#")]
+
+        self.assertEqual(rules, ["meta mark != 0 ether saddr @netcontrol-bypass ip daddr @netcontrol-bypass-dst meta mark set 1024"])
+
+    def test_invalid_bypass_destination(self):
+        """
+        Test that an invalid destination rejects the whole request
+        """
+        with self.assertRaises(HTTPException) as ctx:
+            self.nft.set_bypass_destinations(["10.0.0.0/8", "172.20.0.9-172.20.0.1"])
+        self.assertEqual(ctx.exception.status_code, 400)
+
+class TestMockedReads(unittest.TestCase):
+    """
+    Test cases for the reads of the mocked nftables
+    """
+
+    def test_read_follows_writes(self):
+        """
+        Test that a full read returns the connected devices instead of emptying the mirror
+        """
+        nft = MockedNft(logger)
+        nft.connect_user("aa:bb:cc:dd:ee:ff", 3, True, "test")
+        nft.connect_user("00:11:22:33:44:55", 4, False, "test")
+
+        state = nft.get_state()
+
+        self.assertEqual(state["devices"], {
+            "aa:bb:cc:dd:ee:ff": {"mark": 3, "bypass": True},
+            "00:11:22:33:44:55": {"mark": 4, "bypass": False},
+        })
+        self.assertEqual(len(nft.mirror), 2)
+
+class TestDeviceMirror(unittest.TestCase):
+    """
+    Test cases for the in-memory copy of the connected devices
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.nft.connect_user("aa:bb:cc:dd:ee:ff", 3, True, "test")
+
+    def test_update_counts(self):
+        """
+        Test that the devices of each mark are counted through connections, mark changes and disconnections
+        """
+        mirror = DeviceMirror()
+        mirror.update("aa:bb:cc:dd:ee:ff", 3, True)
+        mirror.update("00:11:22:33:44:55", 3)
+        mirror.update("aa:bb:cc:dd:ee:ff", 4, False)
+        mirror.update("00:11:22:33:44:55", None)
+
+        self.assertEqual(mirror.get("aa:bb:cc:dd:ee:ff"), (4, False))
+        self.assertIsNone(mirror.get("00:11:22:33:44:55"))
+        self.assertEqual(mirror.counts(), {4: 1})
+
+    def test_replace_returns_expired(self):
+        """
+        Test that a read replaces the content and returns the devices which are no longer connected
+        """
+        mirror = DeviceMirror()
+        mirror.update("aa:bb:cc:dd:ee:ff", 3, True)
+        mirror.update("00:11:22:33:44:55", 3)
+
+        expired = mirror.replace({"00:11:22:33:44:55": {"mark": 4, "bypass": False}})
+
+        self.assertEqual(expired, ["aa:bb:cc:dd:ee:ff"])
+        self.assertEqual(mirror.items(), [("00:11:22:33:44:55", 4, False)])
+        self.assertEqual(mirror.counts(), {4: 1})
+
+    def test_unchanged_not_written(self):
+        """
+        Test that connecting a device again or setting its current mark doesn't write to nftables
+        """
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            self.nft.connect_user("AA:BB:CC:DD:EE:FF", 3, True, "test")
+            self.nft.set_mark("aa:bb:cc:dd:ee:ff", 3, True, "test")
+            result = self.nft.connect_users([("aa:bb:cc:dd:ee:ff", 3, True, "test")])
+
+        mock_execute.assert_not_called()
+        self.assertEqual(result, {"connected": ["aa:bb:cc:dd:ee:ff"], "failed": {}})
+
+    def test_changed_written(self):
+        """
+        Test that a change of the bypass alone is written
+        """
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            self.nft.set_mark("aa:bb:cc:dd:ee:ff", 3, False, "test")
+
+        self.assertEqual(mock_execute.call_count, 1)
+        self.assertEqual(self.nft.mirror.get("aa:bb:cc:dd:ee:ff"), (3, False))
+
+    def test_session_timeout_not_skipped(self):
+        """
+        Test that nothing is skipped when a session timeout is set, as the element may have expired in the kernel
+        """
+        self.nft.session_timeout = 3600
+
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            self.nft.connect_user("aa:bb:cc:dd:ee:ff", 3, True, "test")
+            self.nft.set_mark("aa:bb:cc:dd:ee:ff", 3, True, "test")
+
+        self.assertEqual(mock_execute.call_count, 2)
+
+class TestBypassDestinations(unittest.TestCase):
+    """
+    Test cases for the parsing of the bypass destinations
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+
+    def test_parse_destinations(self):
+        """
+        Test that addresses, prefixes and ranges are parsed into interval elements
+        """
+        elements = self.nft._parse_destinations(["10.0.0.1", "10.0.0.0/8", "10.1.0.1/16", "10.0.0.1 - 10.0.0.9"])
+
+        self.assertEqual(elements, [
+            "10.0.0.1",
+            {"prefix": {"addr": "10.0.0.0", "len": 8}},
+            {"prefix": {"addr": "10.1.0.0", "len": 16}},
+            {"range": ["10.0.0.1", "10.0.0.9"]},
+        ])
+
+    def test_invalid_destinations(self):
+        """
+        Test that an invalid address, an IPv6 address or an empty range is rejected
+        """
+        for destination in ["300.0.0.1", "10.0.0.0/33", "::1", "10.0.0.9-10.0.0.1", "example.com"]:
+            with self.assertRaises(HTTPException) as ctx:
+                self.nft._parse_destinations(["10.0.0.1", destination])
+            self.assertEqual(ctx.exception.status_code, 400)
+            self.assertIn(destination, ctx.exception.detail)
+
+    def test_invalid_not_written(self):
+        """
+        Test that nothing is written when one of the destinations is invalid
+        """
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            with self.assertRaises(HTTPException):
+                self.nft.set_bypass_destinations(["10.0.0.1", "invalid"])
+            with self.assertRaises(HTTPException):
+                self.nft.add_bypass_destinations(["10.0.0.1", "invalid"])
+
+        mock_execute.assert_not_called()
+
+class TestBulkEndpoints(unittest.TestCase):
+    """
+    Test cases for the endpoints connecting and disconnecting several devices
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # The app is built at import, without the gate variables nor a real nftables
+        with mock.patch.dict(os.environ, {"MOCK_NETWORK": "1"}), mock.patch("netcontrol.variables.Variables"):
+            from . import main
+        cls.main = main
+
+    def setUp(self):
+        patcher = mock.patch.object(self.main, "nft", MockedNft(logger))
+        self.nft = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(self.main.app)
+
+    def test_connect_users(self):
+        """
+        Test that the valid devices are connected and the invalid ones reported by MAC address
+        """
+        response = self.client.post("/connect_users", json=[
+            {"mac": "AA:BB:CC:DD:EE:FF", "mark": 3, "bypass": True, "name": "test"},
+            {"mac": "00:11:22:33:44:55", "mark": 4},
+            {"mac": "invalid", "mark": 4},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "connected": ["aa:bb:cc:dd:ee:ff", "00:11:22:33:44:55"],
+            "failed": {"invalid": "Invalid MAC address"},
+        })
+        self.assertEqual(self.nft.get_state()["devices"], {
+            "aa:bb:cc:dd:ee:ff": {"mark": 3, "bypass": True},
+            "00:11:22:33:44:55": {"mark": 4, "bypass": False},
+        })
+
+    def test_connect_users_single_transaction(self):
+        """
+        Test that the devices are connected in a single nftables transaction
+        """
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            self.client.post("/connect_users", json=[
+                {"mac": "aa:bb:cc:dd:ee:ff", "mark": 3},
+                {"mac": "00:11:22:33:44:55", "mark": 4},
+            ])
+
+        self.assertEqual(mock_execute.call_count, 1)
+
+    def test_disconnect_users(self):
+        """
+        Test that the devices are disconnected, the others being left connected
+        """
+        self.nft.connect_user("aa:bb:cc:dd:ee:ff", 3, True, "test")
+        self.nft.connect_user("00:11:22:33:44:55", 4, False, "test")
+
+        response = self.client.request("DELETE", "/disconnect_users", json=["AA:BB:CC:DD:EE:FF"])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"disconnected": ["aa:bb:cc:dd:ee:ff"], "failed": {}})
+        self.assertEqual(self.nft.get_state()["devices"], {"00:11:22:33:44:55": {"mark": 4, "bypass": False}})
+
+    def test_invalid_body(self):
+        """
+        Test that a body which is not a list of devices is rejected before reaching nftables
+        """
+        response = self.client.post("/connect_users", json={"mac": "aa:bb:cc:dd:ee:ff", "mark": 3})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.nft.get_state()["devices"], {})
+
+    def test_errors_counted(self):
+        """
+        Test that the requests rejected by the routing or the validation are counted, once each
+        """
+        before = errors("HTTPException"), errors("RequestValidationError")
+
+        self.assertEqual(self.client.get("/unknown").status_code, 404)
+        self.assertEqual(self.client.get("/connect_users").status_code, 405)
+        self.assertEqual(self.client.post("/connect_users", json={}).status_code, 422)
+
+        self.assertEqual(errors("HTTPException") - before[0], 2)
+        self.assertEqual(errors("RequestValidationError") - before[1], 1)
+
+class TestCounters(unittest.TestCase):
+    """
+    Test cases for the traffic counters of the devices
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.nft.connect_user("aa:bb:cc:dd:ee:ff", 3, False, "test")
+
+    def test_device_counters(self):
+        """
+        Test that the counters of a device are read from its element only, and are zero for an unknown device
+        """
+        with mock.patch.object(self.nft, "_execute_json_cmd", wraps=self.nft._execute_json_cmd) as mock_execute:
+            self.assertEqual(self.nft.get_device_counters("AA:BB:CC:DD:EE:FF"), {"packets": 0, "bytes": 0})
+            self.assertEqual(self.nft.get_device_counters("00:11:22:33:44:55"), {"packets": 0, "bytes": 0})
+
+        for call in mock_execute.call_args_list:
+            self.assertEqual(list(call.args[0][0]), ["get"])
+
+    def test_invalid_top_devices(self):
+        """
+        Test that a count or an interval out of range is rejected
+        """
+        for count, interval in [(0, 60), (-1, 60), (10, -1)]:
+            with self.assertRaises(HTTPException) as ctx:
+                self.nft.get_top_devices(count, interval)
+            self.assertEqual(ctx.exception.status_code, 400)
+
+    def test_snapshot_min_age(self):
+        """
+        Test that frequent reads only keep one compact snapshot
+        """
+        first = self.nft.get_top_devices(10, 60)
+        second = self.nft.get_top_devices(10, 60)
+
+        self.assertIsNone(first["interval"])
+        self.assertIsNotNone(second["interval"])
+        self.assertEqual(len(self.nft.counter_snapshots), 1)
+        self.assertEqual(self.nft.counter_snapshots[0][1], {"aa:bb:cc:dd:ee:ff": (0, 0)})
+
+class TestApplyState(unittest.TestCase):
+    """
+    Test cases for the application of a desired state and its version
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        for mac in ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03", "00:00:00:00:00:04"]:
+            self.nft.connect_user(mac, 3, False, "test")
+
+    def groups(self, devices, version=None):
+        """
+        Applies a state, and returns its result and the commands of each group sent to nftables
+        """
+        with mock.patch.object(self.nft, "_execute_nft_batch", wraps=self.nft._execute_nft_batch) as mock_batch:
+            result = self.nft.apply_state(devices, version)
+        return result, {key: cmds for call in mock_batch.call_args_list for key, cmds in call.args[0]}
+
+    def test_differences(self):
+        """
+        Test that only the differences are applied: new devices connected, missing ones disconnected, mark and bypass changes updated
+        """
+        result, groups = self.groups([
+            ("00:00:00:00:00:01", 3, False, "unchanged"),
+            ("00:00:00:00:00:02", 4, False, "mark"),
+            ("00:00:00:00:00:03", 3, True, "bypass"),
+            ("00:00:00:00:00:05", 5, False, "new"),
+        ])
+
+        self.assertEqual({k: result[k] for k in ["connected", "disconnected", "updated", "failed"]},
+            {"connected": 1, "disconnected": 1, "updated": 2, "failed": {}})
+        self.assertEqual(sorted(groups), ["00:00:00:00:00:02", "00:00:00:00:00:03", "00:00:00:00:00:04", "00:00:00:00:00:05"])
+        # A bypass change only touches the bypass set
+        self.assertEqual({cmd[op]["element"]["name"] for cmd in groups["00:00:00:00:00:03"] for op in cmd}, {"netcontrol-bypass"})
+        self.assertEqual(self.nft.get_state()["devices"], {
+            "00:00:00:00:00:01": {"mark": 3, "bypass": False},
+            "00:00:00:00:00:02": {"mark": 4, "bypass": False},
+            "00:00:00:00:00:03": {"mark": 3, "bypass": True},
+            "00:00:00:00:00:05": {"mark": 5, "bypass": False},
+        })
+
+    def test_invalid_mac(self):
+        """
+        Test that an invalid MAC address fails without stopping the other devices
+        """
+        result, _ = self.groups([("invalid", 3, False, "test"), ("00:00:00:00:00:01", 3, False, "test")])
+
+        self.assertEqual(result["failed"], {"invalid": "Invalid MAC address"})
+        self.assertEqual(result["disconnected"], 3)
+
+    def test_stale_version(self):
+        """
+        Test that a state computed from an older version is rejected without being applied
+        """
+        version = self.nft.get_state()["version"]
+        self.nft.set_mark("00:00:00:00:00:01", 4, False, "test")
+
+        with self.assertRaises(HTTPException) as ctx:
+            self.nft.apply_state([], version)
+
+        self.assertEqual(ctx.exception.status_code, 409)
+        self.assertEqual(len(self.nft.mirror), 4)
+
+    def test_stable_version(self):
+        """
+        Test that the version doesn't change while the state doesn't, and that applying the current state writes nothing
+        """
+        state = self.nft.get_state()
+        devices = [(mac, device["mark"], device["bypass"], "test") for mac, device in state["devices"].items()]
+
+        result, groups = self.groups(devices, state["version"])
+
+        self.assertEqual(groups, {})
+        self.assertEqual(result["version"], state["version"])
+        self.assertEqual(self.nft.get_state()["version"], state["version"])
+
+class TestHeartbeat(unittest.TestCase):
+    """
+    Test cases for the refresh of active devices
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+        self.nft.session_timeout = 600
+        self.nft.connect_user("00:00:00:00:00:01", 3, True, "test")
+        self.nft.connect_user("00:00:00:00:00:02", 3, False, "test")
+        self.transactions = []
+        execute_json_cmd = self.nft._execute_json_cmd
+        def execute(cmds, read=False):
+            if not read:
+                self.transactions.append(cmds)
+                if "00:00:00:00:00:02" in json.dumps(cmds):
+                    raise NftablesException(1, "Error: refused\n")
+            return execute_json_cmd(cmds, read)
+        self.nft._execute_json_cmd = execute
+
+    def test_refresh_cmds(self):
+        """
+        Test that the map, auth and bypass elements of a device are all replaced, keeping its counters
+        """
+        cmds = self.nft._refresh_cmds("00:00:00:00:00:01", 3, True, {"packets": 5, "bytes": 300})
+
+        # Deleting an element that is not there fails, so the auth and bypass elements are added before being deleted
+        self.assertEqual([(op, cmd[op]["element"]["name"]) for cmd in cmds for op in cmd], [
+            ("delete", "netcontrol-mac2mark"), ("add", "netcontrol-mac2mark"),
+            ("add", "netcontrol-auth"), ("delete", "netcontrol-auth"), ("add", "netcontrol-auth"),
+            ("add", "netcontrol-bypass"), ("delete", "netcontrol-bypass"), ("add", "netcontrol-bypass"),
+        ])
+        self.assertEqual(cmds[1]["add"]["element"]["elem"], [[{"elem": {"val": "00:00:00:00:00:01", "counter": {"packets": 5, "bytes": 300}}}, 3]])
+
+    def test_heartbeat(self):
+        """
+        Test that connected devices are refreshed, expired ones connected again, and failures reported apart
+        """
+        result = self.nft.heartbeat([
+            ("00:00:00:00:00:01", 3, True, "refreshed"),
+            ("00:00:00:00:00:02", 3, False, "failing"),
+            ("00:00:00:00:00:03", 4, False, "expired"),
+        ])
+
+        self.assertEqual(result["refreshed"], ["00:00:00:00:00:01", "00:00:00:00:00:03"])
+        self.assertEqual(list(result["failed"]), ["00:00:00:00:00:02"])
+        # The first transaction held every group
+        groups = json.dumps(self.transactions[0])
+        self.assertIn('"delete": {"element": {"family": "ip", "table": "insalan", "name": "netcontrol-bypass"', groups)
+        self.assertIn("00:00:00:00:00:03", groups)
+        self.assertEqual(self.nft.mirror.get("00:00:00:00:00:03"), (4, False))
+
+    def test_no_timeout(self):
+        """
+        Test that without a session timeout, connected devices are not written again
+        """
+        self.nft.session_timeout = None
+        result = self.nft.heartbeat([("00:00:00:00:00:01", 3, True, "test")])
+
+        self.assertEqual(result, {"refreshed": ["00:00:00:00:00:01"], "failed": {}})
+        self.assertEqual(self.transactions, [])
+
+class FailingSocket:
+    """
+    Notification socket whose first read fails, and whose next ones block
+    """
+    def __init__(self, error=None):
+        self.errors = [] if error is None else [error]
+        self.closed = False
+
+    def recv(self, size):
+        if len(self.errors) > 0:
+            raise self.errors.pop()
+        threading.Event().wait()
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.closed = True
+
+ARP_HEADER = "IP address       HW type     Flags       HW address            Mask     Device\n"
+
+class TestArpIndex(unittest.TestCase):
+    """
+    Test cases for the index of /proc/net/arp
+    """
+
+    def _table(self, *lines: str) -> mock.MagicMock:
+        return mock.mock_open(read_data=ARP_HEADER + "".join(line + "\n" for line in lines))
+
+    def test_parse(self):
+        """
+        Test that incomplete entries are ignored, and that a MAC address is indexed with its first IP
+        """
+        table = self._table(
+            "10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0",
+            "10.0.0.2         0x1         0x0         00:00:00:00:00:00     *        eth0",
+            "10.0.0.3         0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0",
+        )
+        with mock.patch("netcontrol.arp.open", table, create=True):
+            by_ip, by_mac = ArpIndex().snapshot()
+
+        self.assertEqual(by_ip, {"10.0.0.1": "aa:bb:cc:dd:ee:ff", "10.0.0.3": "aa:bb:cc:dd:ee:ff"})
+        self.assertEqual(by_mac, {"aa:bb:cc:dd:ee:ff": "10.0.0.1"})
+
+    def test_recent_parse_reused(self):
+        """
+        Test that lookups of known entries share a single parse
+        """
+        index = ArpIndex()
+        table = self._table("10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0")
+        with mock.patch("netcontrol.arp.open", table, create=True):
+            self.assertEqual(index.lookup_mac("10.0.0.1"), "aa:bb:cc:dd:ee:ff")
+            self.assertEqual(index.lookup_ip("aa:bb:cc:dd:ee:ff"), "10.0.0.1")
+
+        self.assertEqual(table.call_count, 1)
+
+    def test_miss_parses_again(self):
+        """
+        Test that a missing IP forces a new parse, which finds an entry added since the last one
+        """
+        index = ArpIndex()
+        with mock.patch("netcontrol.arp.open", self._table(), create=True):
+            index.snapshot()
+        
+        table = self._table("10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0")
+        with mock.patch("netcontrol.arp.open", table, create=True):
+            self.assertEqual(index.lookup_mac("10.0.0.1"), "aa:bb:cc:dd:ee:ff")
+
+        self.assertEqual(table.call_count, 1)
+
+    def test_miss_not_parsed_twice(self):
+        """
+        Test that an IP missing from a parse made during the lookup is not found, without parsing again
+        """
+        index = ArpIndex()
+        table = self._table("10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0")
+        with mock.patch("netcontrol.arp.open", table, create=True):
+            self.assertIsNone(index.lookup_mac("10.0.0.2"))
+
+        self.assertEqual(table.call_count, 1)
+
+class TestNeighbourWatch(unittest.TestCase):
+    """
+    Test cases for the recovery of the neighbour notifications
+    """
+
+    def watch(self, error, neighbours):
+        """
+        Starts an index whose socket fails once, and waits until the neighbour table was loaded as many times as given
+        """
+        sockets = [FailingSocket(error), FailingSocket()]
+        loaded = threading.Semaphore(0)
+        def get_neighbours():
+            if len(neighbours) == 1:
+                # The watch resynchronized, it gets the table once _load and _resync are done with it
+                threading.Timer(0.05, loaded.release).start()
+            else:
+                loaded.release()
+            return neighbours.pop(0)
+        with mock.patch("netcontrol.netlink.open_socket", side_effect=sockets), \
+            mock.patch("netcontrol.netlink.get_neighbours", side_effect=get_neighbours), \
+            mock.patch("netcontrol.arp.WATCH_RETRY_DELAY", 0):
+            index = NeighbourIndex(logger)
+            for _ in range(2):
+                self.assertTrue(loaded.acquire(timeout=1))
+        return index, sockets
+
+    def test_reopen_on_error(self):
+        """
+        Test that a failing socket is reopened and the table loaded again, instead of ending the watch
+        """
+        index, sockets = self.watch(OSError(9, "Bad file descriptor"), [[], [("10.0.0.1", "aa:bb:cc:dd:ee:ff")]])
+
+        self.assertTrue(sockets[0].closed)
+        self.assertIs(index.socket, sockets[1])
+        self.assertEqual(index.lookup_mac("10.0.0.1"), "aa:bb:cc:dd:ee:ff")
+
+    def test_reload_on_overflow(self):
+        """
+        Test that lost notifications only cause a reload of the table, on the same socket
+        """
+        index, sockets = self.watch(OSError(105, "No buffer space available"), [[], [("10.0.0.1", "aa:bb:cc:dd:ee:ff")]])
+
+        self.assertFalse(sockets[0].closed)
+        self.assertIs(index.socket, sockets[0])
+
+    def test_snapshot_isolated(self):
+        """
+        Test that a snapshot is not changed by the notifications received after it was taken
+        """
+        with mock.patch("netcontrol.netlink.open_socket", return_value=FailingSocket()), \
+            mock.patch("netcontrol.netlink.get_neighbours", return_value=[("10.0.0.1", "aa:bb:cc:dd:ee:ff")]):
+            index = NeighbourIndex(logger)
+        by_ip, by_mac = index.snapshot()
+
+        index._update("10.0.0.1", None)
+
+        self.assertEqual(by_ip, {"10.0.0.1": "aa:bb:cc:dd:ee:ff"})
+        self.assertEqual(by_mac, {"aa:bb:cc:dd:ee:ff": "10.0.0.1"})
+        self.assertIsNone(index.lookup_mac("10.0.0.1"))
+
+class TestAddressWatch(unittest.TestCase):
+    """
+    Test cases for the recovery of the address notifications
+    """
+
+    def watch(self, error):
+        """
+        Starts watching the addresses with a socket which fails once, and waits until they were refreshed
+        """
+        sockets = [FailingSocket(error), FailingSocket()]
+        changed = threading.Semaphore(0)
+        with mock.patch("netcontrol.netlink.open_socket", side_effect=sockets) as mock_open_socket, \
+            mock.patch("netcontrol.netlink.get_addresses", return_value=[("lo", "127.0.0.1", 8)]), \
+            mock.patch("netcontrol.netlink.WATCH_RETRY_DELAY", 0):
+            addresses = Addresses(logger)
+            addresses.watch(changed.release)
+            self.assertTrue(changed.acquire(timeout=1))
+        return addresses, sockets, mock_open_socket
+
+    def test_reopen_on_error(self):
+        """
+        Test that a failing socket is reopened and the addresses read again, instead of ending the watch
+        """
+        addresses, sockets, mock_open_socket = self.watch(OSError(9, "Bad file descriptor"))
+
+        self.assertTrue(sockets[0].closed)
+        self.assertEqual(mock_open_socket.call_count, 2)
+        self.assertEqual(addresses.get(), [("lo", "127.0.0.1", 8)])
+
+    def test_refresh_on_overflow(self):
+        """
+        Test that lost notifications only cause the addresses to be read again, on the same socket
+        """
+        addresses, sockets, mock_open_socket = self.watch(OSError(105, "No buffer space available"))
+
+        self.assertFalse(sockets[0].closed)
+        self.assertEqual(mock_open_socket.call_count, 1)
+        self.assertEqual(addresses.get(), [("lo", "127.0.0.1", 8)])
+
+class TestProber(unittest.TestCase):
+    """
+    Test cases for the choice of the IPs that are probed
+    """
+
+    def setUp(self):
+        index = mock.Mock()
+        index.snapshot.return_value = ({"10.1.2.3": "aa:bb:cc:dd:ee:ff", "192.168.1.5": "00:11:22:33:44:55"}, {})
+        addresses = mock.Mock()
+        addresses.get.return_value = [("lo", "127.0.0.1", 8), ("eth1", "192.168.1.1", 24)]
+        self.prober = Prober(logger, index, 1, "10.0.0.0/8", addresses)
+
+    @mock.patch("netcontrol.arp.socket.socket")
+    def test_probe_local(self, mock_socket):
+        """
+        Test that the IPs of the LAN and of the gate's subnets are probed
+        """
+        self.assertEqual(self.prober.resolve("10.1.2.3"), "aa:bb:cc:dd:ee:ff")
+        self.assertEqual(self.prober.resolve("192.168.1.5"), "00:11:22:33:44:55")
+        self.assertEqual(mock_socket.call_count, 2)
+
+    @mock.patch("netcontrol.arp.socket.socket")
+    def test_no_probe_outside(self, mock_socket):
+        """
+        Test that other IPs, loopback and the gate's own addresses are a miss without any probe
+        """
+        for ip in ["8.8.8.8", "127.0.0.1", "192.168.1.1", "example.com"]:
+            self.assertIsNone(self.prober.resolve(ip))
+        mock_socket.assert_not_called()
+
+class TestGetMac(unittest.TestCase):
+    """
+    Test cases for the order of the lookups of a MAC address
+    """
+
+    def setUp(self):
+        leases = mock.Mock()
+        leases.lookup_mac.return_value = "00:00:00:00:00:01"
+        self.arp = Arp(logger, 0, leases)
+        self.arp.index = mock.Mock()
+        self.arp.index.lookup_mac.return_value = None
+        self.arp.prober = mock.Mock()
+
+    def test_probe_before_lease(self):
+        """
+        Test that a probed neighbour wins over a possibly stale lease
+        """
+        self.arp.prober.resolve.return_value = "00:00:00:00:00:02"
+
+        self.assertEqual(self.arp.get_mac("10.0.0.1"), {"mac": "00:00:00:00:00:02"})
+        self.arp.leases.lookup_mac.assert_not_called()
+
+    def test_lease_last_resort(self):
+        """
+        Test that the lease is used when the probe finds nothing
+        """
+        self.arp.prober.resolve.return_value = None
+
+        self.assertEqual(self.arp.get_mac("10.0.0.1"), {"mac": "00:00:00:00:00:01"})
+
+class TestDeviceInfo(unittest.TestCase):
+    """
+    Test cases for the information about a device
+    """
+
+    def test_lookups_off_event_loop(self):
+        """
+        Test that the IP and hostname lookups, which may read files or probe, run outside of the event loop
+        """
+        threads = []
+        def get_ip(mac):
+            threads.append(threading.current_thread())
+            return {"mac": mac, "ip": "172.16.1.10"}
+        arp = mock.Mock(get_ip=mock.Mock(side_effect=get_ip))
+        leases = mock.Mock(get_hostname=mock.Mock(side_effect=lambda mac: threads.append(threading.current_thread()) or "computer"))
+        snmp = mock.Mock(get_switch=mock.AsyncMock(return_value=("172.16.1.21", 3)))
+        variables = mock.Mock(vlans=mock.Mock(return_value={1: "v001-management"}))
+        devices = Devices(logger, variables, snmp, arp, leases)
+        devices.switches = {"172.16.1.21": "Hydrogen-1"}
+
+        info = asyncio.run(devices.get_device_info("aa:bb:cc:dd:ee:ff"))
+
+        self.assertEqual(info["ip"], "172.16.1.10")
+        self.assertEqual(info["hostname"], "computer")
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+class TestAdoptLimits(unittest.TestCase):
+    """
+    Test cases for the limits read back from a gate left in place by a previous run
+    """
+
+    def setUp(self):
+        self.nft = MockedNft(logger)
+
+    @staticmethod
+    def rule(chain, expr):
+        return {"rule": {"family": "ip", "table": "insalan", "chain": chain, "handle": 1, "expr": expr}}
+
+    @staticmethod
+    def chain(name):
+        return {"chain": {"family": "ip", "table": "insalan", "name": name, "handle": 1}}
+
+    @staticmethod
+    def mark(key, mark):
+        return {"match": {"op": "==", "left": {key: {"key": "mark"}}, "right": mark}}
+
+    @staticmethod
+    def limit(rate, unit=None, burst=None):
+        limit = {"rate": rate, "per": "second", "inv": True}
+        if unit is not None:
+            limit["rate_unit"] = unit
+        if burst is not None:
+            limit["burst"] = burst
+        return {"limit": limit}
+
+    @staticmethod
+    def update(meter, limit):
+        return {"set": {"op": "update", "elem": {"payload": {"protocol": "ether", "field": "saddr"}}, "set": f"@{meter}", "stmt": [limit]}}
+
+    def test_adopt_shaping(self):
+        """
+        Test that mark and device limits are read back, whatever unit nftables lists them in
+        """
+        self.nft._adopt_limits([
+            self.chain("netcontrol-shaping"),
+            self.rule("netcontrol-shaping", [self.mark("meta", {"set": [5, 6]}), {"mangle": {}}]),
+            self.rule("netcontrol-shaping", [self.mark("meta", 5), self.update("netcontrol-shaping-up-5", self.limit(500, "kbytes")), {"drop": None}]),
+            self.rule("netcontrol-shaping", [self.mark("ct", 5), self.update("netcontrol-shaping-down-5", self.limit(500, "kbytes")), {"drop": None}]),
+            self.rule("netcontrol-shaping", [self.mark("meta", 5), self.limit(2, "mbytes"), {"drop": None}]),
+            self.rule("netcontrol-shaping", [self.mark("meta", 6), self.limit(100, "kbytes"), {"drop": None}]),
+        ])
+
+        self.assertEqual(self.nft.shaping, [(5, 2048, 500), (6, 100, None)])
+        self.assertIn(("set", "netcontrol-shaping-up-5"), self.nft._gate_objects())
+
+    def test_adopt_portal_limit(self):
+        """
+        Test that the portal rate limit set at runtime is read back
+        """
+        self.nft._adopt_limits([
+            self.chain("netcontrol-nat"),
+            self.rule("netcontrol-nat", [self.mark("meta", 0), self.update("netcontrol-portal-meter", self.limit(5, burst=8)), {"drop": None}]),
+            self.rule("netcontrol-nat", [self.mark("meta", 0), {"redirect": {"port": 80}}]),
+        ])
+
+        self.assertEqual(self.nft.portal_limit, {"rate": 5, "burst": 8})
+
+    def test_adopt_unlimited_portal(self):
+        """
+        Test that a portal without a meter rule is adopted as unlimited
+        """
+        self.nft._adopt_limits([
+            self.chain("netcontrol-nat"),
+            {"set": {"family": "ip", "table": "insalan", "name": "netcontrol-portal-meter", "handle": 2}},
+            self.rule("netcontrol-nat", [self.mark("meta", 0), {"redirect": {"port": 80}}]),
+        ])
+
+        self.assertEqual(self.nft.portal_limit["rate"], 0)
+
+    def test_portal_without_meter(self):
+        """
+        Test that a gate predating the portal meter gets the configured portal rate limit
+        """
+        self.nft._adopt_limits([
+            self.chain("netcontrol-nat"),
+            self.rule("netcontrol-nat", [self.mark("meta", 0), {"redirect": {"port": 80}}]),
+        ])
+
+        self.assertEqual(self.nft.portal_limit, {"rate": 10, "burst": 20})
+
+    def test_no_gate(self):
+        """
+        Test that the configured limits are kept when there is no gate to adopt
+        """
+        self.nft._adopt_limits([])
+
+        self.assertEqual(self.nft.shaping, [])
+        self.assertEqual(self.nft.portal_limit, {"rate": 10, "burst": 20})
+
+class TestReconciliation(unittest.TestCase):
+    """
+    Test cases for the comparison of a gate left in place by a previous run to the wanted one
+    """
+
+    @staticmethod
+    def mac2mark(stmt):
+        definition = {"family": "ip", "table": "insalan", "name": "netcontrol-mac2mark", "handle": 1, "type": "ether_addr", "map": "mark"}
+        if stmt is not None:
+            definition["stmt"] = stmt
+        return {"map": definition}
+
+    def test_adopt_counted_map(self):
+        """
+        Test that a map counting the traffic of its elements is adopted
+        """
+        changed, _ = MockedNft(logger)._render_reconciliation([self.mac2mark([{"counter": None}])])
+
+        self.assertEqual(changed, "")
+
+    def test_recreate_uncounted_map(self):
+        """
+        Test that a map without counters is recreated, as the counters of its elements would always be zero
+        """
+        changed, _ = MockedNft(logger)._render_reconciliation([self.mac2mark(None)])
+
+        self.assertEqual(changed, "delete map insalan netcontrol-mac2mark\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,4 +14,48 @@ class Variables:
         for vlan in self.data["vlans"]:
             vlans[vlan["id"]] = vlan["name"]
         
-        return vlans
\ No newline at end of file
+        return vlans
+    
+    def flowtable(self) -> dict:
+        """
+        Flowtable configuration: "devices" lists the interfaces to offload forwarded traffic on (no flowtable if empty),
+        "enabled" tells whether traffic is offloaded at startup.
+        """
+        return {"devices": [], "enabled": True} | self.data.get("flowtable", {})
+    
+    def session_timeout(self) -> int | None:
+        """
+        Lifetime in seconds of authenticated devices in the sets, refreshed by heartbeats (no expiry if unset or 0).
+        """
+        return self.data.get("session_timeout") or None
+    
+    def portal_limit(self) -> dict:
+        """
+        Rate of new HTTP connections each unauthenticated device may open towards the gate:
+        "rate" per second with "burst" extra connections, the others are dropped (no limit if rate is 0).
+        """
+        return {"rate": 10, "burst": 20} | self.data.get("portal_limit", {})
+    
+    def game_priority(self) -> dict:
+        """
+        Marking of packets from prioritized marks and devices: "dscp" class (e.g. "cs4") and/or "meta_priority" (e.g. "1:10"), None to leave them untouched.
+        """
+        return {"dscp": "cs4", "meta_priority": None} | self.data.get("game_priority", {})
+    
+    def bypass_mark(self) -> int:
+        """
+        Mark given to the packets of devices with bypass towards the bypass destinations.
+        """
+        return self.data.get("bypass_mark", 1024)
+    
+    def bypass_destinations_file(self) -> str | None:
+        """
+        File listing the bypass destinations, one address, prefix or range per line, loaded at startup.
+        """
+        return self.data.get("bypass_destinations_file")
+    
+    def hitless_restart(self) -> bool:
+        """
+        Whether the gate is left in place when netcontrol stops, to be adopted when it starts again.
+        """
+        return self.data.get("hitless_restart", False)